@@ -0,0 +1,241 @@
+"""
+
+    Author  : Andrew Emerick
+    e-mail  : aemerick11@gmail.com
+    year    : 2020
+
+    LICENSE :GPLv3
+
+    asyncio front end for RoutingService (see service.py).
+
+    Routing is CPU bound, so it is run in an executor. By default this is a
+    thread pool on the given service, which keeps one copy of each map and
+    lets an abandoned search be stopped right away, but (because of the GIL)
+    only runs about one search at a time however many workers it has. To
+    route on several cores, give a `service_factory` instead: each worker
+    process then builds its own RoutingService (and so its own map pool, so
+    memory use is multiplied by the number of workers), and searches are only
+    stopped by the `timeout` deadline, since an explicit cancel can not reach
+    another process. Identical requests
+    that arrive while one is already being computed (e.g. many people
+    opening the same shared link) are collapsed onto one shared future
+    rather than each doing the full search. Each caller awaits the shared
+    future through `asyncio.shield`, so one caller going away does not
+    cancel the work for the rest; the computation itself is only cancelled
+    once no one is waiting on it anymore.
+
+    Each computation gets a CancellationToken (see cancellation.py), which
+    is cancelled when it is abandoned, so the search itself stops at the
+    next hop and frees up its worker. An optional per-request `timeout`
+    sets a deadline on the token.
+
+    Example:
+
+        > router = AsyncRouter(RoutingService())
+        > result = await router.route(lat, long, {'distance' : 16000.0}, seed = 1)
+
+        > # on 4 cores
+        > router = AsyncRouter(None, service_factory = RoutingService, max_workers = 4)
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+
+from planit.autotrail.cancellation import CancellationToken
+
+
+#
+# Helpers for running the service in other processes
+#
+_worker_service = None
+
+def _init_service_worker(service_factory):
+    """
+    Process pool initializer. Makes this process' own service.
+    """
+    global _worker_service
+    _worker_service = service_factory()
+
+    return
+
+def _service_worker(name, *args, **kwargs):
+    """
+    Call method `name` of this process' service.
+    """
+    return getattr(_worker_service, name)(*args, **kwargs)
+
+
+class _InFlight():
+    """
+    A computation in progress and the number of callers waiting on it.
+    """
+
+    __slots__ = ('future', 'token', 'waiters')
+
+    def __init__(self, future, token):
+        self.future  = future
+        self.token   = token
+        self.waiters = 0
+
+
+class AsyncRouter():
+    """
+    Async wrapper around a RoutingService with in-flight request coalescing
+    and cancellation.
+    """
+
+    def __init__(self, service, executor = None, max_workers = 4, timeout = None,
+                       service_factory = None):
+        """
+        Parameters:
+        -----------
+        service     : (RoutingService) service to run requests on. Not used
+                      if `service_factory` is given (can be None).
+        executor    : (Optional, concurrent.futures.Executor) executor to run
+                      routing in. Default : ThreadPoolExecutor with `max_workers`
+                      (ProcessPoolExecutor if `service_factory` is given)
+        max_workers : (Optional, int) number of workers for the default executor.
+                      Default : 4
+        timeout     : (Optional, float) time limit (s) for each computation. Searches
+                      past this return partial results. Default : None
+        service_factory : (Optional, callable) picklable function returning a
+                      RoutingService. If given, routing runs in worker processes
+                      that each call this once to make their own service (see
+                      above). Default : None
+        """
+
+        self.service  = service
+        self.timeout  = timeout
+        self.service_factory = service_factory
+
+        if executor is None:
+            if service_factory is None:
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers = max_workers)
+            else:
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers = max_workers,
+                                                                  initializer = _init_service_worker,
+                                                                  initargs = (service_factory,))
+        self.executor = executor
+
+        self._inflight = {}
+        self._counts   = {'requests' : 0, 'computed' : 0, 'coalesced' : 0,
+                          'cancelled' : 0, 'abandoned' : 0}
+
+        return
+
+    async def route(self, lat, long, target_values, region = None, seed = None, **kwargs):
+        """
+        Async `RoutingService.route`.
+        """
+        return await self._run('route', lat, long, target_values,
+                               region = region, seed = seed, **kwargs)
+
+    async def route_range(self, lat, long, target_values_range, region = None, seed = None, **kwargs):
+        """
+        Async `RoutingService.route_range`.
+        """
+        return await self._run('route_range', lat, long,
+                               target_values_range, region = region, seed = seed, **kwargs)
+
+    async def requery(self, lat, long, target_values, previous, region = None, seed = None, **kwargs):
+        """
+        Async `RoutingService.requery`.
+        """
+        return await self._run('requery', lat, long, target_values,
+                               previous, region = region, seed = seed, **kwargs)
+
+    async def nearest(self, lat, long, k = 1, region = None):
+        """
+        Async `RoutingService.nearest`.
+        """
+        return await self._run('nearest', lat, long, k = k, region = region,
+                               cancellable = False)
+
+    @staticmethod
+    def request_key(name, *args, **kwargs):
+        """
+        Key identifying identical requests.
+        """
+
+        def _freeze(x):
+            if isinstance(x, dict):
+                return tuple(sorted((k, _freeze(v)) for k, v in x.items()))
+            elif isinstance(x, (list, tuple)):
+                return tuple(_freeze(v) for v in x)
+            return repr(x)
+
+        return (name, _freeze(args), _freeze(kwargs))
+
+    async def _run(self, name, *args, cancellable = True, **kwargs):
+        """
+        Run service method `name` in the executor, or wait on the identical
+        request already running. If `cancellable`, the method is given a
+        CancellationToken as `cancel`.
+        """
+
+        key  = self.request_key(name, *args, **kwargs)
+        loop = asyncio.get_running_loop()
+
+        self._counts['requests'] += 1
+
+        entry = self._inflight.get(key, None)
+        if entry is None:
+            token  = CancellationToken(timeout = self.timeout)
+            if cancellable:
+                kwargs['cancel'] = token
+
+            if self.service_factory is None:
+                function = functools.partial(getattr(self.service, name), *args, **kwargs)
+            else:
+                function = functools.partial(_service_worker, name, *args, **kwargs)
+
+            future = loop.run_in_executor(self.executor, function)
+            entry  = _InFlight(future, token)
+            self._inflight[key] = entry
+            future.add_done_callback(functools.partial(self._done, key, entry))
+            self._counts['computed'] += 1
+        else:
+            self._counts['coalesced'] += 1
+
+        entry.waiters += 1
+        try:
+            return await asyncio.shield(entry.future)
+
+        except asyncio.CancelledError:
+            self._counts['cancelled'] += 1
+            raise
+
+        finally:
+            entry.waiters -= 1
+
+            # no one left who wants this result
+            if (entry.waiters == 0) and not entry.future.done():
+                self._counts['abandoned'] += 1
+                entry.token.cancel()    # stop a search that is already running
+                entry.future.cancel()   # or one that has not started
+                self._forget(key, entry)
+
+    def _done(self, key, entry, future):
+        self._forget(key, entry)
+        return
+
+    def _forget(self, key, entry):
+        if self._inflight.get(key, None) is entry:
+            del self._inflight[key]
+        return
+
+    def stats(self):
+        """
+        Request counters. `coalesced` requests were served by another
+        request's computation.
+        """
+
+        result = dict(self._counts)
+        result['in_flight'] = len(self._inflight)
+
+        return result
+
+    def shutdown(self, wait = True):
+        self.executor.shutdown(wait = wait)
+        return
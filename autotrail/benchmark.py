@@ -0,0 +1,571 @@
+"""
+
+    Author  : Andrew Emerick
+    e-mail  : aemerick11@gmail.com
+    year    : 2020
+
+    LICENSE :GPLv3
+
+    Reproducible routing benchmarks. Runs fixed request sets on synthetic
+    fixture maps (see `synthetic.py`, so no network or elevation data is
+    needed) through `multi_find_route` and `find_route_constraint_range`
+    and records:
+
+        - latency percentiles per request set
+        - routes / sec
+        - route finding hops and iterations (and per second)
+        - peak RSS
+        - fractional error distributions for each target value
+
+    as JSON. Results can be compared against a stored baseline to flag
+    regressions.
+
+    Usage:
+
+        python benchmark.py run [output.json] [--baseline baseline.json]
+        python benchmark.py compare results.json baseline.json
+        python benchmark.py distances [--points N] [--repeat N]
+
+    `compare` prints the change in routes, hops and iterations per second
+    and p50 latency for each request set, then any regressions. To measure
+    a change, `run` on the old and new trees with the same --seed and
+    --fixtures directory (so both use identical maps and requests), then
+    `compare new.json old.json`.
+
+    Replaces the old (hand-run) largetestrun.py. Its target sets are kept
+    below (TARGET_SETS).
+"""
+
+import numpy as np
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+
+from planit.autotrail import synthetic
+from planit.autotrail.profiling import ProfileStats
+
+
+du = 1609.34 # mi to meters
+eu = 0.3048  # ft to meters
+
+#
+# target sets from the original large test run
+#
+TARGET_SETS = {'CA_1' : {'distance' : 14*du, 'elevation_gain' : 5000.0*eu},
+               'CA_2' : {'distance' : 24*du, 'elevation_gain' : 9000.0*eu},
+               'CO_1' : {'distance' :  6*du, 'elevation_gain' : 3000.0*eu},
+               'CO_2' : {'distance' :  4*du, 'elevation_gain' :  500.0*eu},
+               'WA_1' : {'distance' : 12*du, 'elevation_gain' : 4000.0*eu},
+               'WA_2' : {'distance' : 24*du, 'elevation_gain' : 10000.0*eu},
+               'WA_3' : {'distance' :  8*du, 'elevation_gain' : 2000.0*eu}}
+
+#
+# fixture maps (arguments to synthetic.synthetic_trailmap)
+#
+FIXTURES = {'grid_10k'      : {'kind' : 'grid',      'n_edges' : 10000, 'seed' : 101},
+            'geometric_10k' : {'kind' : 'geometric', 'n_edges' : 10000, 'seed' : 202},
+            'grid_1k'       : {'kind' : 'grid',      'n_edges' : 1000,  'seed' : 303}}
+
+#
+# request sets: which map, which targets, how to call
+#
+REQUEST_SETS = [
+    {'name' : 'multi_grid',      'fixture' : 'grid_10k',      'method' : 'multi',
+     'targets' : ['CO_1', 'CO_2', 'WA_3', 'WA_1'], 'n_starts' : 3,
+     'kwargs' : {'n_routes' : 5, 'iterations' : 10}},
+
+    {'name' : 'multi_geometric', 'fixture' : 'geometric_10k', 'method' : 'multi',
+     'targets' : ['CO_1', 'CO_2', 'WA_3', 'CA_1'], 'n_starts' : 3,
+     'kwargs' : {'n_routes' : 5, 'iterations' : 10}},
+
+    {'name' : 'range_grid',      'fixture' : 'grid_10k',      'method' : 'range',
+     'targets' : ['CO_1', 'WA_3'], 'n_starts' : 2, 'range_width' : 0.2,
+     'kwargs' : {'n_routes' : 5, 'n_constraints' : 3, 'iterations' : 5}},
+
+    {'name' : 'multi_small',     'fixture' : 'grid_1k',       'method' : 'multi',
+     'targets' : ['CO_2'], 'n_starts' : 5,
+     'kwargs' : {'n_routes' : 5, 'iterations' : 10}},
+]
+
+QUICK_FIXTURES = ['grid_1k']
+
+# default thresholds for flagging regressions relative to baseline
+LATENCY_TOLERANCE = 0.25  # fractional increase in p50 / p90 latency
+ERROR_TOLERANCE   = 0.05  # absolute increase in median |fractional error|
+
+
+def peak_rss():
+    """
+    Peak resident set size of this process (MB).
+    """
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if sys.platform == 'darwin': # bytes rather than kB
+        rss = rss / 1024.0
+
+    return rss / 1024.0
+
+
+def load_fixture_map(name, fixture_dir = None):
+    """
+    Load fixture map `name`, generating it (and saving it in `fixture_dir`
+    if given) if it does not yet exist.
+    """
+
+    params = FIXTURES[name]
+
+    if not (fixture_dir is None):
+        outname = os.path.join(fixture_dir, name + '.pickle')
+        if os.path.isfile(outname):
+            return synthetic.load_fixture(outname)
+
+    tmap = synthetic.synthetic_trailmap(**params)
+
+    if not (fixture_dir is None):
+        if not os.path.isdir(fixture_dir):
+            os.makedirs(fixture_dir)
+        synthetic.save_fixture(tmap, outname)
+
+    return tmap
+
+
+def start_nodes(tmap, n, seed = 0):
+    """
+    Deterministically choose `n` start nodes in the largest connected
+    component, the first being the node closest to the map center.
+    """
+
+    labels  = np.array([tmap.component_label(x) for x in tmap.nodes])
+    nodes   = np.array(list(tmap.nodes))
+    values, counts = np.unique(labels, return_counts=True)
+    nodes   = nodes[labels == values[np.argmax(counts)]]
+
+    lat  = np.array([tmap.nodes[x]['lat'] for x in nodes])
+    long = np.array([tmap.nodes[x]['long'] for x in nodes])
+
+    center = tmap.great_circle_distance(np.average(lat), np.average(long), lat, long)
+    order  = np.argsort(center)
+
+    # rest picked randomly from the inner part of the map
+    rng    = np.random.RandomState(seed)
+    inner  = order[1:max(len(order)//4, n)]
+    picks  = [order[0]] + list(rng.choice(inner, size=min(n-1,len(inner)), replace=False))
+
+    return [int(nodes[i]) for i in picks]
+
+
+def fractional_errors(totals, target_values):
+    """
+    Fractional error (total / target - 1) in each target value for each route.
+    """
+
+    errors = {}
+    for k in target_values:
+        if k in ['min_grade', 'max_grade']:
+            continue
+        errors[k] = [ (t[k] / target_values[k]) - 1.0 for t in totals if not (t is None)]
+
+    return errors
+
+
+def _percentiles(values, pct = (50, 90, 99)):
+
+    if len(values) == 0:
+        return {'p%i'%p : None for p in pct}
+
+    return {'p%i'%p : float(np.percentile(values, p)) for p in pct}
+
+
+def _format(value, fmt):
+    """
+    `fmt % value`, or 'n/a' if there is no value (e.g. no requests ran).
+    """
+
+    return 'n/a' if value is None else fmt%(value)
+
+
+def _distribution(values):
+    """
+    Summary of a fractional error distribution.
+    """
+
+    values = np.asarray(values, dtype=float)
+
+    if len(values) == 0:
+        return {'n' : 0}
+
+    summary = {'n'           : int(len(values)),
+               'mean'        : float(np.mean(values)),
+               'median'      : float(np.median(values)),
+               'median_abs'  : float(np.median(np.abs(values))),
+               'within_10pc' : float(np.sum(np.abs(values) <= 0.1) / len(values))}
+    summary.update( _percentiles(values, pct = (10, 50, 90)) )
+
+    return summary
+
+
+def run_request_set(tmap, request_set, seed = 0, n_repeat = 1):
+    """
+    Run all requests in a request set and gather latency, throughput, and
+    error statistics.
+
+    Parameters:
+    -----------
+    tmap         : (TrailMap) fixture map
+    request_set  : (dict) request set (see REQUEST_SETS)
+    seed         : (Optional, int) random seed. Default : 0
+    n_repeat     : (Optional, int) number of times to repeat each request. Default : 1
+
+    Returns:
+    -----------
+    result       : (dict) JSON friendly results
+    """
+
+    starts = start_nodes(tmap, request_set['n_starts'], seed = seed)
+
+    latencies = []
+    n_found   = 0
+    n_failed  = 0
+    errors    = {}
+
+    # per request counters (hops, iterations, ...) from the routing profiler
+    profile   = ProfileStats()
+    profiling = getattr(tmap, '_profiling', False)
+    tmap.enable_profiling(callback = profile.merge)
+
+    wall_start = time.perf_counter()
+
+    for repeat in range(n_repeat):
+        for target_name in request_set['targets']:
+            target_values = TARGET_SETS[target_name]
+
+            if request_set['method'] == 'range':
+                width = request_set.get('range_width', 0.2)
+                request_targets = {k : (v*(1.0-0.5*width), v*(1.0+0.5*width)) for k,v in target_values.items()}
+            else:
+                request_targets = dict(target_values)
+
+            for i, start_node in enumerate(starts):
+                request_seed = seed + 1000*repeat + i
+
+                t0 = time.perf_counter()
+                if request_set['method'] == 'range':
+                    totals, routes, scores = tmap.find_route_constraint_range(start_node, request_targets,
+                                                                              rng = request_seed,
+                                                                              **request_set['kwargs'])
+                else:
+                    totals, routes, scores = tmap.multi_find_route(start_node, request_targets,
+                                                                   rng = request_seed,
+                                                                   **request_set['kwargs'])
+                latencies.append(time.perf_counter() - t0)
+
+                found     = [t for t in totals if not (t is None)]
+                n_found  += len(found)
+                n_failed += len(totals) - len(found)
+
+                for k, v in fractional_errors(found, target_values).items():
+                    errors[k] = errors.get(k, []) + v
+
+    wall_time = time.perf_counter() - wall_start
+
+    if not profiling:
+        tmap.disable_profiling()
+
+    hops       = int(profile.counts.get('hops', 0))
+    iterations = int(profile.counts.get('iterations', 0))
+
+    result = {'method'           : request_set['method'],
+              'fixture'          : request_set['fixture'],
+              'n_requests'       : len(latencies),
+              'n_routes'         : n_found,
+              'n_failed'         : n_failed,
+              'wall_time'        : wall_time,
+              'routes_per_sec'   : n_found / wall_time if wall_time > 0 else None,
+              'latency'          : _percentiles(latencies),
+              'latency_mean'     : float(np.mean(latencies)) if len(latencies) > 0 else None,
+              'hops'             : hops,
+              'iterations'       : iterations,
+              'hops_per_sec'     : hops / wall_time if wall_time > 0 else None,
+              'iterations_per_sec' : iterations / wall_time if wall_time > 0 else None,
+              'phase_times'      : dict(profile.times),
+              'errors'           : {k : _distribution(v) for k,v in errors.items()}}
+
+    return result
+
+
+def run(fixture_dir = None, request_sets = None, seed = 0, n_repeat = 1, quick = False, verbose = True):
+    """
+    Run the benchmark suite.
+
+    Parameters:
+    -----------
+    fixture_dir  : (Optional, str) directory to cache fixture maps in. Default : None
+    request_sets : (Optional, list) names of request sets to run. Default : all
+    seed         : (Optional, int) random seed. Default : 0
+    n_repeat     : (Optional, int) times to repeat each request. Default : 1
+    quick        : (Optional, bool) only run request sets on the small fixtures. Default : False
+    verbose      : (Optional, bool) print progress. Default : True
+
+    Returns:
+    -----------
+    results      : (dict) JSON friendly results
+    """
+
+    results = {'meta' : {'timestamp'  : time.strftime('%Y-%m-%dT%H:%M:%S'),
+                         'python'     : platform.python_version(),
+                         'numpy'      : np.__version__,
+                         'platform'   : platform.platform(),
+                         'seed'       : seed,
+                         'n_repeat'   : n_repeat},
+               'fixtures' : {},
+               'requests' : {}}
+
+    selected = [r for r in REQUEST_SETS if (request_sets is None) or (r['name'] in request_sets)]
+    if quick:
+        selected = [r for r in selected if r['fixture'] in QUICK_FIXTURES]
+
+    maps = {}
+    for request_set in selected:
+        name = request_set['fixture']
+
+        if not (name in maps):
+            t0 = time.perf_counter()
+            maps[name] = load_fixture_map(name, fixture_dir)
+            results['fixtures'][name] = {'n_nodes'   : maps[name].number_of_nodes(),
+                                         'n_edges'   : maps[name].number_of_edges(),
+                                         'load_time' : time.perf_counter() - t0}
+
+        if verbose:
+            print("Running %s on %s"%(request_set['name'], name))
+
+        results['requests'][request_set['name']] = run_request_set(maps[name], request_set,
+                                                                   seed = seed, n_repeat = n_repeat)
+
+        if verbose:
+            r = results['requests'][request_set['name']]
+            print("    p50 = %s s   p90 = %s s   %s routes/s"%(_format(r['latency']['p50'], '%.3f'),
+                                                              _format(r['latency']['p90'], '%.3f'),
+                                                              _format(r['routes_per_sec'], '%.2f')))
+            print("    %i hops (%s / s)   %i iterations (%s / s)"%(r['hops'], _format(r['hops_per_sec'], '%.1f'),
+                                                                 r['iterations'], _format(r['iterations_per_sec'], '%.2f')))
+
+    results['peak_rss_mb'] = peak_rss()
+
+    return results
+
+
+def compare(results, baseline, latency_tolerance = LATENCY_TOLERANCE,
+                               error_tolerance = ERROR_TOLERANCE):
+    """
+    Compare results to baseline results. Flags:
+
+        - p50 / p90 latency increases larger than `latency_tolerance` (fractional)
+        - routes / sec decreases larger than `latency_tolerance` (fractional)
+        - median |fractional error| increases larger than `error_tolerance`
+        - more failed routes
+        - peak RSS increase larger than `latency_tolerance` (fractional)
+
+    Returns:
+    -----------
+    regressions : (list) of strings describing each regression. Empty if none.
+    """
+
+    regressions = []
+
+    for name, r in results['requests'].items():
+        if not (name in baseline['requests']):
+            continue
+        b = baseline['requests'][name]
+
+        for p in ['p50', 'p90']:
+            new, old = r['latency'][p], b['latency'][p]
+            if (new is None) or (old is None):
+                continue
+            if new > old * (1.0 + latency_tolerance):
+                regressions.append("%s: %s latency %.4f s -> %.4f s"%(name, p, old, new))
+
+        new, old = r['routes_per_sec'], b['routes_per_sec']
+        if not (new is None or old is None) and new < old * (1.0 - latency_tolerance):
+            regressions.append("%s: routes/sec %.3f -> %.3f"%(name, old, new))
+
+        if r['n_failed'] > b['n_failed']:
+            regressions.append("%s: failed routes %i -> %i"%(name, b['n_failed'], r['n_failed']))
+
+        for k, dist in r['errors'].items():
+            if not (k in b['errors']) or dist['n'] == 0 or b['errors'][k]['n'] == 0:
+                continue
+            new, old = dist['median_abs'], b['errors'][k]['median_abs']
+            if new > old + error_tolerance:
+                regressions.append("%s: median |%s error| %.3f -> %.3f"%(name, k, old, new))
+
+    new, old = results.get('peak_rss_mb', None), baseline.get('peak_rss_mb', None)
+    if not (new is None or old is None) and new > old * (1.0 + latency_tolerance):
+        regressions.append("peak RSS %.1f MB -> %.1f MB"%(baseline['peak_rss_mb'], results['peak_rss_mb']))
+
+    return regressions
+
+
+def speedups(results, baseline):
+    """
+    Throughput and latency of `results` relative to `baseline` for each
+    request set in both.
+
+    Returns:
+    -----------
+    lines : (list) of strings, one per request set and quantity, as
+            'old -> new (ratio x)'. Ratios are new / old for the per second
+            rates and old / new for p50 latency, so > 1 is faster.
+    """
+
+    lines = []
+
+    for name, r in results['requests'].items():
+        if not (name in baseline['requests']):
+            continue
+        b = baseline['requests'][name]
+
+        for k, label, fmt in [('routes_per_sec', 'routes/s', '%.3f'),
+                              ('hops_per_sec', 'hops/s', '%.2f'),
+                              ('iterations_per_sec', 'iterations/s', '%.3f')]:
+            new, old = r.get(k, None), b.get(k, None)
+            ratio = None if (new is None or old is None or old == 0) else new / old
+            lines.append("%s: %s %s -> %s (%s x)"%(name, label, _format(old, fmt),
+                                                  _format(new, fmt), _format(ratio, '%.2f')))
+
+        new, old = r['latency']['p50'], b['latency']['p50']
+        ratio = None if (new is None or old is None or new == 0) else old / new
+        lines.append("%s: p50 latency %s s -> %s s (%s x)"%(name, _format(old, '%.3f'),
+                                                           _format(new, '%.3f'), _format(ratio, '%.2f')))
+
+    return lines
+
+
+def distance_benchmark(n_points = 200, n_tracks = 200, seed = 0, verbose = True):
+    """
+    Microbenchmark of `process_gpx_data.gpx_distances` (vectorized) against
+    calling `gpxpy.geo.distance` point-by-point, on random-walk tracks of
+    `n_points` (lat, long, elevation) points. Typical ingest edges have tens
+    to hundreds of points.
+
+    Returns:
+    ----------
+    result   : dictionary with time (s) per track for each and the maximum
+               fractional difference between the two.
+    """
+
+    import gpxpy
+    from planit.autotrail import process_gpx_data as gpx_process
+
+    rng    = np.random.default_rng(seed)
+    tracks = []
+    for i in range(n_tracks):
+        steps = rng.normal(0.0, [2.0E-4, 2.0E-4, 2.0], size = (n_points, 3))
+        tracks.append(np.array([40.0, -105.3, 1800.0]) + np.cumsum(steps, axis=0))
+
+    lists = [[tuple(x) for x in t] for t in tracks]
+
+    start = time.perf_counter()
+    loop  = [np.array([gpxpy.geo.distance(p[i][0],p[i][1],p[i][2], p[i-1][0],p[i-1][1],p[i-1][2])
+                       for i in range(1, len(p))]) for p in lists]
+    loop_time = (time.perf_counter() - start) / n_tracks
+
+    start = time.perf_counter()
+    vec   = [gpx_process.gpx_distances(t) for t in tracks]
+    vec_time = (time.perf_counter() - start) / n_tracks
+
+    max_diff = max(np.max(np.abs(a - b) / np.maximum(a, 1.0E-10)) for a, b in zip(loop, vec))
+
+    result = {'n_points' : n_points, 'n_tracks' : n_tracks,
+              'loop_time' : loop_time, 'vectorized_time' : vec_time,
+              'speedup' : loop_time / vec_time, 'max_fractional_difference' : float(max_diff)}
+
+    if verbose:
+        print("gpx_distances (%i points): loop %.3g s  vectorized %.3g s  speedup %.1fx  max diff %.2E"%(
+              n_points, loop_time, vec_time, result['speedup'], max_diff))
+
+    return result
+
+
+def save_results(results, outname):
+    with open(outname, 'w') as outfile:
+        json.dump(results, outfile, indent=2, sort_keys=True)
+    return
+
+
+def load_results(inname):
+    with open(inname, 'r') as infile:
+        return json.load(infile)
+
+
+def main(argv = None):
+
+    parser = argparse.ArgumentParser(description="TrailMap routing benchmarks")
+    subparsers = parser.add_subparsers(dest='command')
+
+    run_parser = subparsers.add_parser('run', help='run benchmarks')
+    run_parser.add_argument('output', nargs='?', default='benchmark_results.json')
+    run_parser.add_argument('--baseline', default=None, help='baseline JSON to compare to')
+    run_parser.add_argument('--fixtures', default='./benchmark_fixtures', help='fixture map directory')
+    run_parser.add_argument('--requests', nargs='*', default=None, help='request sets to run')
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--repeat', type=int, default=1)
+    run_parser.add_argument('--quick', action='store_true', help='small fixtures only')
+
+    compare_parser = subparsers.add_parser('compare', help='compare results to baseline')
+    compare_parser.add_argument('results')
+    compare_parser.add_argument('baseline')
+
+    distance_parser = subparsers.add_parser('distances', help='gpx_distances microbenchmark')
+    distance_parser.add_argument('--points', type=int, default=200, help='points per track')
+    distance_parser.add_argument('--repeat', type=int, default=200, help='number of tracks')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        results = run(fixture_dir = args.fixtures, request_sets = args.requests,
+                      seed = args.seed, n_repeat = args.repeat, quick = args.quick)
+        save_results(results, args.output)
+        print("Peak RSS: %s MB. Results written to %s"%(_format(results['peak_rss_mb'], '%.1f'), args.output))
+
+        baseline = args.baseline
+
+    elif args.command == 'distances':
+        distance_benchmark(n_points = args.points, n_tracks = args.repeat)
+        return 0
+
+    elif args.command == 'compare':
+        results  = load_results(args.results)
+        baseline = args.baseline
+
+    else:
+        parser.print_help()
+        return 0
+
+    if baseline is None:
+        return 0
+
+    baseline_results = load_results(baseline)
+
+    print("Relative to %s:"%(baseline))
+    for x in speedups(results, baseline_results):
+        print("    " + x)
+
+    regressions = compare(results, baseline_results)
+
+    if len(regressions) > 0:
+        print("REGRESSIONS relative to %s:"%(baseline))
+        for x in regressions:
+            print("    " + x)
+        return 1
+
+    print("No regressions relative to %s"%(baseline))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""
+
+    Author  : Andrew Emerick
+    e-mail  : aemerick11@gmail.com
+    year    : 2020
+
+    LICENSE :GPLv3
+
+    Cooperative cancellation for route searches. A CancellationToken is
+    passed into `find_route`, `get_intermediate_node`, and `multi_find_route`
+    (as `cancel`), which check it at hop / retry / iteration boundaries and
+    return early with whatever they have so far. A token can be cancelled
+    explicitly (e.g. when an HTTP client goes away), carry a deadline, or both.
+
+    Example:
+
+        > token = CancellationToken(timeout = 2.0)
+        > totals, routes, errors = tmap.multi_find_route(start, targets, cancel = token)
+        > token.cancelled   # True if the search was cut short
+"""
+
+import threading
+import time
+
+
+class CancellationToken():
+    """
+    Thread-safe cancel flag with an optional deadline.
+    """
+
+    def __init__(self, timeout = None, deadline = None):
+        """
+        Parameters:
+        -----------
+        timeout  : (Optional, float) seconds from now until the token expires.
+                   Default : None
+        deadline : (Optional, float) absolute `time.monotonic()` deadline. If both
+                   are given, the earlier is used. Default : None
+        """
+
+        if not (timeout is None):
+            expires  = time.monotonic() + timeout
+            deadline = expires if (deadline is None) else min(deadline, expires)
+
+        self.deadline = deadline
+        self._event   = threading.Event()
+
+        return
+
+    def cancel(self):
+        """
+        Cancel everything using this token.
+        """
+        self._event.set()
+        return
+
+    @property
+    def cancelled(self):
+        """
+        True if cancelled or past the deadline.
+        """
+
+        if self._event.is_set():
+            return True
+
+        if (not (self.deadline is None)) and (time.monotonic() >= self.deadline):
+            self._event.set()
+            return True
+
+        return False
+
+    def remaining(self):
+        """
+        Seconds left until the deadline (None if no deadline, 0 if cancelled).
+        """
+
+        if self.cancelled:
+            return 0.0
+
+        if self.deadline is None:
+            return None
+
+        return max(self.deadline - time.monotonic(), 0.0)
+
+    def __getstate__(self):
+        # only the deadline survives being sent to another process. monotonic
+        # clocks are system wide on the platforms we run on.
+        return {'deadline' : self.deadline, 'cancelled' : self._event.is_set()}
+
+    def __setstate__(self, state):
+        self.deadline = state['deadline']
+        self._event   = threading.Event()
+        if state['cancelled']:
+            self._event.set()
+        return
+
+
+def is_cancelled(token):
+    """
+    True if `token` is given and has been cancelled (None is never cancelled).
+    """
+    return (not (token is None)) and token.cancelled
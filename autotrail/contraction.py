@@ -0,0 +1,297 @@
+"""
+
+    Author  : Andrew Emerick
+    e-mail  : aemerick11@gmail.com
+    year    : 2020
+
+    LICENSE :GPLv3
+
+    Contraction hierarchy for fast, repeated point-to-point shortest path
+    queries on the static `distance` metric of a TrailMap.
+
+    The hierarchy is built once (offline) per region and pickled alongside the
+    TrailMap. Building is slow-ish (pure python), but queries only search the
+    small "upward" portion of the graph from each end and are typically
+    orders of magnitude faster than a full Dijkstra on a large region.
+
+    As elsewhere in TrailMap, this assumes that ALL edges are bi-directional
+    with the same distance in either direction.
+"""
+
+import heapq
+
+
+class ContractionHierarchy():
+    """
+    Contraction hierarchy over a single static edge weight (default
+    `distance`) of a graph. Answers point-to-point distance and path queries.
+    """
+
+    def __init__(self, G, weight='distance', witness_settle_limit = 60):
+        """
+        Build the hierarchy from graph `G`.
+
+        Parameters:
+        ------------
+        G       : (networkx graph) graph to build hierarchy from. Edge data
+                  must contain `weight`.
+        weight  : (Optional, str) edge attribute to use as the (static) metric.
+                  Default : 'distance'
+        witness_settle_limit : (Optional, int) max number of nodes to settle
+                               in each witness search while contracting. Smaller
+                               is faster to build but adds more shortcuts.
+                               Default : 60
+        """
+
+        self.weight = weight
+        self._witness_settle_limit = witness_settle_limit
+
+        self._rank   = {}      # node -> contraction order
+        self._up     = {}      # node -> list of (higher ranked node, weight)
+        self._middle = {}      # (u,v) (u < v) -> contracted node of shortcut
+
+        self._build(G)
+
+        return
+
+    @property
+    def num_shortcuts(self):
+        return len(self._middle)
+
+    def distance(self, source, target):
+        """
+        Shortest distance between `source` and `target`. Returns
+        `None` if they do not connect (or are not in the hierarchy).
+        """
+
+        result = self._query(source, target)
+
+        if result is None:
+            return None
+
+        return result[0]
+
+    def path(self, source, target):
+        """
+        Shortest path between `source` and `target` as an ordered list of
+        nodes in the original graph. Returns `None` if they do not connect.
+        """
+
+        result = self._query(source, target)
+
+        if result is None:
+            return None
+
+        _, meet, fparent, bparent = result
+
+        # up-path from source to the meeting node
+        upward = [meet]
+        while upward[-1] != source:
+            upward.append(fparent[upward[-1]])
+        upward = upward[::-1]
+
+        # and back down to the target
+        n = meet
+        while n != target:
+            n = bparent[n]
+            upward.append(n)
+
+        # expand shortcuts
+        nodes = [upward[0]]
+        for i in range(len(upward)-1):
+            nodes.extend(self._unpack(upward[i], upward[i+1])[1:])
+
+        return nodes
+
+    def _query(self, source, target):
+        """
+        Bidirectional upward Dijkstra. Returns (distance, meeting node,
+        forward parents, backward parents) or None if no path.
+        """
+
+        if not (source in self._rank) or not (target in self._rank):
+            return None
+
+        if source == target:
+            return 0.0, source, {}, {}
+
+        dist    = ({source : 0.0}, {target : 0.0})
+        parent  = ({}, {})
+        settled = (set(), set())
+        queue   = ([(0.0, source)], [(0.0, target)])
+
+        best      = float('inf')
+        meet      = None
+
+        while queue[0] or queue[1]:
+
+            # alternate directions, always advancing the smaller frontier
+            if not queue[1] or (queue[0] and queue[0][0][0] <= queue[1][0][0]):
+                side = 0
+            else:
+                side = 1
+
+            d, u = heapq.heappop(queue[side])
+
+            if u in settled[side]:
+                continue
+            settled[side].add(u)
+
+            if d >= best:
+                # nothing left in this direction can improve on best.
+                # drain it so the other direction can finish
+                del queue[side][:]
+                continue
+
+            other = 1 - side
+            if u in dist[other] and (d + dist[other][u]) < best:
+                best = d + dist[other][u]
+                meet = u
+
+            for v, w in self._up[u]:
+                nd = d + w
+                if nd < dist[side].get(v, float('inf')):
+                    dist[side][v]   = nd
+                    parent[side][v] = u
+                    heapq.heappush(queue[side], (nd, v))
+
+        if meet is None:
+            return None
+
+        return best, meet, parent[0], parent[1]
+
+    def _unpack(self, u, v):
+        """
+        Expand (possible) shortcut u-v into list of original nodes (u,...,v).
+        """
+
+        nodes = [u]
+        stack = [(u, v)]
+        while stack:
+            a, b = stack.pop()
+            key  = (a, b) if a < b else (b, a)
+
+            if key in self._middle:
+                m = self._middle[key]
+                # push in reverse so a-m is expanded before m-b
+                stack.append((m, b))
+                stack.append((a, m))
+            else:
+                nodes.append(b)
+
+        return nodes
+
+    def _build(self, G):
+        """
+        Contract all nodes in order of (lazily updated) edge difference.
+        """
+
+        # undirected adjacency with smallest weight among parallel edges
+        adj = {n : {} for n in G.nodes}
+        for u, v, d in G.edges(data=True):
+            if u == v:
+                continue
+            w = d[self.weight]
+            if w < adj[u].get(v, float('inf')):
+                adj[u][v] = w
+                adj[v][u] = w
+
+        contracted    = set()
+        deleted_count = {n : 0 for n in adj}
+
+        def _priority(n):
+            shortcuts = self._contract(n, adj, contracted, simulate=True)
+            degree    = len([x for x in adj[n] if not (x in contracted)])
+            return len(shortcuts) - degree + deleted_count[n]
+
+        queue = [(_priority(n), n) for n in adj]
+        heapq.heapify(queue)
+
+        order = 0
+        while queue:
+            p, n = heapq.heappop(queue)
+
+            if n in contracted:
+                continue
+
+            # lazy update - re-queue if priority has gotten worse
+            new_p = _priority(n)
+            if queue and new_p > queue[0][0]:
+                heapq.heappush(queue, (new_p, n))
+                continue
+
+            for (a, b, w) in self._contract(n, adj, contracted, simulate=False):
+                adj[a][b] = w
+                adj[b][a] = w
+                self._middle[(a, b) if a < b else (b, a)] = n
+
+            contracted.add(n)
+            self._rank[n] = order
+            order += 1
+
+            for x in adj[n]:
+                if not (x in contracted):
+                    deleted_count[x] += 1
+
+        # keep only edges going up in the hierarchy
+        for u in adj:
+            self._up[u] = [(v, w) for v, w in adj[u].items() if self._rank[v] > self._rank[u]]
+
+        return
+
+    def _contract(self, n, adj, contracted, simulate=False):
+        """
+        Find the shortcuts needed to contract node `n`. Returns list of
+        (u, v, weight) shortcuts. Graph is not modified here.
+        """
+
+        neighbors = [(x, w) for x, w in adj[n].items() if not (x in contracted)]
+        shortcuts = []
+
+        for i, (u, wu) in enumerate(neighbors):
+
+            targets = {v : wu + wv for v, wv in neighbors[i+1:]}
+            if len(targets) == 0:
+                continue
+
+            witness = self._witness_search(u, n, targets, max(targets.values()),
+                                           adj, contracted)
+
+            for v, via in targets.items():
+                if witness.get(v, float('inf')) > via:
+                    shortcuts.append((u, v, via))
+
+        return shortcuts
+
+    def _witness_search(self, source, avoid, targets, cutoff, adj, contracted):
+        """
+        Limited Dijkstra from `source` ignoring `avoid` and contracted nodes.
+        Returns dictionary of distances found.
+        """
+
+        dist    = {source : 0.0}
+        queue   = [(0.0, source)]
+        settled = 0
+        remaining = len(targets)
+
+        while queue and settled < self._witness_settle_limit and remaining > 0:
+            d, u = heapq.heappop(queue)
+
+            if d > dist.get(u, float('inf')):
+                continue
+            if d > cutoff:
+                break
+
+            settled += 1
+            if u in targets:
+                remaining -= 1
+
+            for v, w in adj[u].items():
+                if (v == avoid) or (v in contracted):
+                    continue
+                nd = d + w
+                if nd < dist.get(v, float('inf')):
+                    dist[v] = nd
+                    heapq.heappush(queue, (nd, v))
+
+        return dist
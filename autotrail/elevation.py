@@ -0,0 +1,546 @@
+"""
+
+    Author  : Andrew Emerick
+    e-mail  : aemerick11@gmail.com
+    year    : 2020
+
+    LICENSE :GPLv3
+
+    Elevation providers. Anything that can give elevations for arrays of
+    (lat, long) coordinates can be used to build maps (see
+    `process_gpx_data.get_elevations`):
+
+        SRTMProvider   : NASA SRTM data through the (patched) `srtm` package.
+                         Needs Earthdata credentials and samples one point
+                         at a time.
+        RasterProvider : local DEM tiles (GeoTIFF, HGT, ...) through `rasterio`.
+                         Runs offline. Reads a window around the region once
+                         (kept in an LRU under a byte budget) and interpolates
+                         whole coordinate arrays at a time.
+        TileStore      : 1x1 degree SRTM-style tiles decoded once to int16 grids
+                         on disk and memory mapped, with an LRU of open tiles
+                         under a byte budget. Tiles come from .hgt files or the
+                         srtm package (SRTMProvider(tile_cache = ...)).
+
+    Example:
+
+        > provider = RasterProvider(['N40W106.hgt', 'N40W105.hgt'])
+        > provider.prepare(ll, rr)     # optional, read the region up front
+        > elevations = provider.get_elevations(lat, long)
+"""
+
+import numpy as np
+import collections
+import glob
+import os
+import threading
+import zipfile
+
+
+class ElevationProvider():
+    """
+    Interface for elevation data. Subclasses need to implement
+    `get_elevations`. Providers are pickled to the processes that build maps
+    in parallel (see `osm_process.compute_osm_edge_properties`), so anything
+    that can not be (locks, modules, open data) should be left out of the
+    pickled state and re-made on load.
+    """
+
+    def get_elevations(self, lat, long):
+        """
+        Elevations (m) at each (lat, long).
+
+        Parameters:
+        -----------
+        lat, long  : (arrays) coordinates in degrees
+
+        Returns:
+        ----------
+        elevations : float array with NaN where there is no data
+        """
+        raise NotImplementedError
+
+    def get_elevation(self, lat, long):
+        """
+        Elevation (m) at a single point, or None if there is no data.
+        """
+
+        value = self.get_elevations(np.array([lat]), np.array([long]))[0]
+
+        return None if np.isnan(value) else float(value)
+
+    def prepare(self, ll, rr):
+        """
+        Optionally load anything needed for the bounding box ll = (lat,long)
+        to rr = (lat,long) ahead of time. Does nothing by default.
+        """
+        return
+
+
+class SRTMProvider(ElevationProvider):
+    """
+    SRTM elevations (1 arcsecond) from the `srtm` package, which downloads
+    and caches tiles as needed.
+    """
+
+    def __init__(self, version = "v3.1a", credentials_file = None,
+                       tile_cache = None, max_bytes = 512*1024**2):
+        """
+        Parameters:
+        -----------
+        version          : (Optional, str) srtm version. Default : "v3.1a"
+        credentials_file : (Optional, str) file with "user,password" for Earthdata.
+                           Default : eduser.secret in this directory
+        tile_cache       : (Optional, str) directory to keep decoded tiles in. If
+                           given, lookups go through a TileStore (bilinear, batched
+                           by tile) instead of point by point through srtm. Default : None
+        max_bytes        : (Optional, int) TileStore open tile budget. Default : 512 MB
+        """
+
+        import srtm
+
+        # to re-make this in other processes (see __getstate__)
+        self._args = (version, credentials_file, tile_cache, max_bytes)
+
+        if credentials_file is None:
+            credentials_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'eduser.secret')
+
+        _eduser, _edpass = open(credentials_file).read().strip().split(',')
+
+        self._data = srtm.data.GeoElevationData( version = version,   # srtm version
+                                                 batch_mode = False, # should not need to set True for this usecase
+                                                 fallback = False,   # do not fallback to lowres data
+                                                 EDuser = _eduser,   # user id
+                                                 EDpass = _edpass    # password
+                                               )
+
+        self._tiles = None
+        if not (tile_cache is None):
+            self._tiles = TileStore(tile_cache, source = self.tile_data, max_bytes = max_bytes)
+
+        return
+
+    def __getstate__(self):
+        # srtm data and open tiles are re-made (and re-loaded) on the other side
+        return {'_args' : self._args}
+
+    def __setstate__(self, state):
+        self.__init__(*state['_args'])
+        return
+
+    def get_elevation(self, lat, long):
+        if not (self._tiles is None):
+            return self._tiles.get_elevation(lat, long)
+        return self._data.get_elevation(lat, long)
+
+    def get_elevations(self, lat, long):
+
+        if not (self._tiles is None):
+            return self._tiles.get_elevations(lat, long)
+
+        values = [self._data.get_elevation(a, b) for (a, b) in zip(lat, long)]
+
+        return np.array([np.nan if v is None else v for v in values], dtype=float)
+
+    def tile_data(self, south, west):
+        """
+        Raw .hgt bytes of the tile with lower left corner (south, west),
+        downloaded by `srtm` if needed, or None if there is no tile. The srtm
+        package's own (unbounded) in-memory copy is dropped.
+        """
+
+        tile = self._data.get_file(south + 0.5, west + 0.5)
+        if tile is None:
+            return None
+
+        files = getattr(self._data, 'files', {})
+        for k in [k for k, v in files.items() if v is tile]:
+            del files[k]
+
+        return tile.data
+
+
+class RasterProvider(ElevationProvider):
+    """
+    Elevations from local DEM rasters in lat / long (e.g. EPSG:4326 GeoTIFF
+    or SRTM .hgt tiles). For each region, a window covering the region is
+    read from each overlapping raster once (unless already covered by a
+    window in memory) and kept in an LRU with a total byte budget.
+    Elevations are bilinearly interpolated between pixel centers.
+    """
+
+    def __init__(self, paths, pad = 0.01, max_bytes = 512*1024**2):
+        """
+        Parameters:
+        -----------
+        paths  : (str or list of str) raster files, or a directory / glob pattern
+                 (directories are searched for .tif, .tiff, and .hgt files)
+        pad    : (Optional, float) extra margin (degrees) read around each
+                 requested bounding box. Default : 0.01
+        max_bytes : (Optional, int) budget for windows kept in memory. Default : 512 MB
+        """
+
+        import rasterio
+        self._rasterio = rasterio
+
+        if isinstance(paths, str):
+            if os.path.isdir(paths):
+                paths = sum([glob.glob(os.path.join(paths, '*' + ext)) for ext in ['.tif','.tiff','.hgt']], [])
+            else:
+                paths = glob.glob(paths)
+
+        self.paths     = sorted(paths)
+        self.pad       = pad
+        self.max_bytes = max_bytes
+
+        # (path, bounds) -> (bounds, transform, array) of windows in memory,
+        # least recently used first
+        self._windows = collections.OrderedDict()
+        self._nbytes  = 0
+        self._lock    = threading.RLock()
+
+        # raster bounds (west, south, east, north), checked to be lat / long
+        self._bounds = {}
+        for path in self.paths:
+            with rasterio.open(path) as src:
+                if not (src.crs is None) and not src.crs.is_geographic:
+                    raise ValueError("RasterProvider needs lat / long rasters. %s is %s"%(path, src.crs))
+                self._bounds[path] = tuple(src.bounds)
+
+        return
+
+    def prepare(self, ll, rr):
+        """
+        Read windows covering the bounding box ll = (lat,long) to rr = (lat,long)
+        from all overlapping rasters, unless already covered by a window in
+        memory.
+        """
+
+        west, south = ll[1] - self.pad, ll[0] - self.pad
+        east, north = rr[1] + self.pad, rr[0] + self.pad
+
+        with self._lock:
+            for path in self.paths:
+                b = self._bounds[path]
+                if (b[0] >= east) or (b[2] <= west) or (b[1] >= north) or (b[3] <= south):
+                    continue
+
+                box = (max(west, b[0]), max(south, b[1]), min(east, b[2]), min(north, b[3]))
+
+                covered = None
+                for key, (bounds, _, _) in self._windows.items():
+                    if (key[0] == path) and (bounds[0] <= box[0]) and (bounds[1] <= box[1]) and\
+                       (bounds[2] >= box[2]) and (bounds[3] >= box[3]):
+                        covered = key
+                        break
+
+                if not (covered is None):
+                    self._windows.move_to_end(covered)
+                    continue
+
+                with self._rasterio.open(path) as src:
+                    window = self._rasterio.windows.from_bounds(*box, transform = src.transform)
+                    window = window.round_offsets(op='floor').round_lengths(op='ceil')
+                    window = window.intersection(self._rasterio.windows.Window(0, 0, src.width, src.height))
+
+                    data = src.read(1, window = window, out_dtype = 'float32')
+                    if not (src.nodata is None):
+                        data[data == src.nodata] = np.nan
+
+                    transform = src.window_transform(window)
+                    bounds    = self._rasterio.windows.bounds(window, src.transform)
+
+                self._windows[(path, bounds)] = (bounds, transform, data)
+                self._nbytes += data.nbytes
+
+                # evict least recently used, but always keep this one
+                while (self._nbytes > self.max_bytes) and (len(self._windows) > 1):
+                    _, (_, _, old) = self._windows.popitem(last = False)
+                    self._nbytes -= old.nbytes
+
+        return
+
+    def __getstate__(self):
+        # windows are re-read as needed on the other side
+        state = dict(self.__dict__)
+        for k in ['_rasterio', '_lock']:
+            state.pop(k)
+        state['_windows'] = collections.OrderedDict()
+        state['_nbytes']  = 0
+        return state
+
+    def __setstate__(self, state):
+        import rasterio
+
+        self.__dict__.update(state)
+        self._rasterio = rasterio
+        self._lock     = threading.RLock()
+
+        return
+
+    def clear(self):
+        """
+        Drop all windows read so far.
+        """
+        with self._lock:
+            self._windows = collections.OrderedDict()
+            self._nbytes  = 0
+        return
+
+    def get_elevations(self, lat, long):
+
+        lat  = np.asarray(lat, dtype=float)
+        long = np.asarray(long, dtype=float)
+
+        elevations = np.full(np.shape(lat), np.nan)
+        if np.size(lat) == 0:
+            return elevations
+
+        with self._lock:
+            todo = self._interpolate(lat, long, elevations)
+
+            # read in anything that is not already loaded and try again
+            if np.any(todo):
+                self.prepare((np.min(lat[todo]), np.min(long[todo])),
+                             (np.max(lat[todo]), np.max(long[todo])))
+                self._interpolate(lat, long, elevations, todo)
+
+        return elevations
+
+    def _interpolate(self, lat, long, elevations, select = None):
+        """
+        Fill `elevations` for points inside the loaded windows. Returns mask
+        of points that were not in any window.
+        """
+
+        todo = np.ones(np.shape(lat), dtype=bool) if select is None else select.copy()
+
+        used = []
+        for key, ((west, south, east, north), transform, data) in reversed(self._windows.items()):
+            inside = todo & (long >= west) & (long <= east) & (lat >= south) & (lat <= north)
+            if not np.any(inside):
+                continue
+            used.append(key)
+
+            # fractional pixel positions, relative to pixel centers
+            # (north-up rasters, no rotation)
+            col = (long[inside] - transform.c) / transform.a - 0.5
+            row = (lat[inside]  - transform.f) / transform.e - 0.5
+
+            ny, nx = np.shape(data)
+            col = np.clip(col, 0, max(nx - 1.000001, 0))
+            row = np.clip(row, 0, max(ny - 1.000001, 0))
+
+            i  = row.astype(int)
+            j  = col.astype(int)
+            i1 = np.minimum(i + 1, ny - 1)
+            j1 = np.minimum(j + 1, nx - 1)
+            fy = row - i
+            fx = col - j
+
+            elevations[inside] = (data[i,j]*(1-fy)*(1-fx) + data[i1,j]*fy*(1-fx) +
+                                  data[i,j1]*(1-fy)*fx    + data[i1,j1]*fy*fx)
+
+            todo[inside] = False
+
+        for key in used:
+            self._windows.move_to_end(key)
+
+        return todo
+
+
+def hgt_name(south, west):
+    """
+    SRTM tile name (e.g. 'N40W106') for the tile with lower left corner
+    (south, west) in integer degrees.
+    """
+    return "%s%02i%s%03i"%('N' if south >= 0 else 'S', abs(south),
+                           'E' if west >= 0 else 'W', abs(west))
+
+
+def hgt_directory_source(directory):
+    """
+    TileStore source reading NAME.hgt (or NAME.hgt.zip) tiles from `directory`.
+    """
+
+    def _source(south, west):
+        path = os.path.join(directory, hgt_name(south, west) + '.hgt')
+
+        if os.path.isfile(path):
+            with open(path, 'rb') as infile:
+                return infile.read()
+
+        if os.path.isfile(path + '.zip'):
+            with zipfile.ZipFile(path + '.zip') as archive:
+                return archive.read(archive.namelist()[0])
+
+        return None
+
+    return _source
+
+
+class TileStore(ElevationProvider):
+    """
+    Elevations from 1x1 degree SRTM-style (.hgt) tiles. Each tile is decoded
+    once from its source into an int16 grid saved in `cache_dir`, and opened
+    from there as a read-only memory map. Open tiles are kept in an LRU
+    with a total byte budget, so memory stays bounded however many tiles
+    a job touches. Lookups are grouped by tile and bilinearly interpolated.
+    """
+
+    VOID = -32768   # SRTM no data value
+
+    def __init__(self, cache_dir, source = None, max_bytes = 512*1024**2):
+        """
+        Parameters:
+        -----------
+        cache_dir  : (str) directory for decoded tiles
+        source     : (Optional, callable or str) function (south, west) -> raw .hgt
+                     bytes (or None if no tile), or a directory of .hgt files.
+                     Default : None (only tiles already in `cache_dir`)
+        max_bytes  : (Optional, int) budget for open tiles. Default : 512 MB
+        """
+
+        if isinstance(source, str):
+            source = hgt_directory_source(source)
+
+        self.cache_dir = cache_dir
+        self.source    = source
+        self.max_bytes = max_bytes
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        self._open   = collections.OrderedDict() # (south, west) -> grid (or None)
+        self._nbytes = 0
+        self._lock   = threading.Lock()
+
+        self._counts = {'hits' : 0, 'opened' : 0, 'decoded' : 0, 'evicted' : 0}
+
+        return
+
+    def __getstate__(self):
+        # open tiles are re-opened (memory mapped) as needed on the other side
+        state = dict(self.__dict__)
+        state.pop('_lock')
+        state['_open']   = collections.OrderedDict()
+        state['_nbytes'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        return
+
+    def _path(self, south, west):
+        return os.path.join(self.cache_dir, hgt_name(south, west) + '.npy')
+
+    def _decode(self, south, west):
+        """
+        Decode the tile from its source into the cache. Returns False if
+        there is no such tile.
+        """
+
+        data = None if self.source is None else self.source(south, west)
+        if data is None:
+            return False
+
+        n    = int(np.sqrt(len(data) // 2))
+        grid = np.frombuffer(data, dtype='>i2', count = n*n).reshape(n, n).astype(np.int16)
+
+        # write then rename so other processes never see a partial tile
+        path = self._path(south, west)
+        temp = path + '.%i.tmp'%(os.getpid())
+        with open(temp, 'wb') as outfile:
+            np.save(outfile, grid)
+        os.replace(temp, path)
+
+        self._counts['decoded'] += 1
+
+        return True
+
+    def tile(self, south, west):
+        """
+        Memory mapped grid of the tile with lower left corner (south, west), or
+        None if there is no tile. Row 0 is the north edge.
+        """
+
+        key = (int(south), int(west))
+
+        with self._lock:
+            if key in self._open:
+                self._open.move_to_end(key)
+                self._counts['hits'] += 1
+                return self._open[key]
+
+            path = self._path(*key)
+            if os.path.isfile(path) or self._decode(*key):
+                grid = np.load(path, mmap_mode = 'r')
+                self._counts['opened'] += 1
+            else:
+                grid = None
+
+            self._open[key] = grid
+            self._nbytes   += 0 if grid is None else grid.nbytes
+
+            # evict least recently used, but always keep this one
+            while (self._nbytes > self.max_bytes) and (len(self._open) > 1):
+                _, old = self._open.popitem(last = False)
+                self._nbytes -= 0 if old is None else old.nbytes
+                self._counts['evicted'] += 1
+
+            return grid
+
+    def get_elevations(self, lat, long):
+
+        lat  = np.asarray(lat, dtype=float)
+        long = np.asarray(long, dtype=float)
+
+        elevations = np.full(np.shape(lat), np.nan)
+        if np.size(lat) == 0:
+            return elevations
+
+        south = np.floor(lat).astype(int)
+        west  = np.floor(long).astype(int)
+
+        tiles, inverse = np.unique(np.stack((south.ravel(), west.ravel()), axis=1),
+                                   axis = 0, return_inverse = True)
+        inverse = inverse.reshape(np.shape(lat))
+
+        for k, (s, w) in enumerate(tiles):
+            grid = self.tile(s, w)
+            if grid is None:
+                continue
+
+            select = inverse == k
+            n      = np.shape(grid)[0]
+
+            row = (s + 1.0 - lat[select]) * (n - 1)
+            col = (long[select] - w) * (n - 1)
+            row = np.clip(row, 0, n - 1.000001)
+            col = np.clip(col, 0, n - 1.000001)
+
+            i  = row.astype(int)
+            j  = col.astype(int)
+            fy = row - i
+            fx = col - j
+
+            corners = np.array([grid[i,j], grid[i+1,j], grid[i,j+1], grid[i+1,j+1]], dtype=float)
+            corners[corners == self.VOID] = np.nan
+
+            elevations[select] = (corners[0]*(1-fy)*(1-fx) + corners[1]*fy*(1-fx) +
+                                  corners[2]*(1-fy)*fx      + corners[3]*fy*fx)
+
+        return elevations
+
+    def stats(self):
+        """
+        Counters, number of open tiles, and their total bytes.
+        """
+
+        with self._lock:
+            result = dict(self._counts)
+            result['open']   = len(self._open)
+            result['nbytes'] = self._nbytes
+
+        return result
@@ -26,16 +26,18 @@ import numpy as np
 import pandas as pd
 import copy
 import os
+import threading
 
 #
 # Packages for handling geospatial data
 #
 import geopandas as geopd
 import gpxpy
-import srtm
 import shapely
 import networkx as nx
 
+from planit.autotrail.elevation import SRTMProvider, RasterProvider
+
 # FIX THIS
 
 try:
@@ -44,29 +46,59 @@ except:
     import pickle
 
 #
-# set up global lookup table for making elevation data
-# using NASA's Shuttle Radar Topography Mission data
-# at 1 arcsecond resolution
+# global lookup for elevation data. By default this uses NASA's Shuttle
+# Radar Topography Mission data at 1 arcsecond resolution. This is only
+# set up on first use (it needs credentials and takes a while), so that
+# processes that only route never touch it.
 #
+_elevation_data = None
+_elevation_lock = threading.Lock()
 
 def _load_elevations():
     """
     Helper function to generate global elevation
-    data class
+    data class. Uses local DEM rasters (see RasterProvider) if the
+    PLANIT_DEM environment variable is set to a directory or glob
+    pattern of them, otherwise SRTM. If PLANIT_TILE_CACHE is set to a
+    directory, SRTM tiles are decoded there once and memory mapped
+    (see TileStore). At most PLANIT_TILE_CACHE_MB (default 512) of tiles
+    (or DEM raster windows) are kept open.
     """
-    _curr_path = '/'.join(__file__.split('/')[:-1])
-    _eduser, _edpass = open(_curr_path + '/eduser.secret').read().strip().split(',')
-    ed = srtm.data.GeoElevationData( version = "v3.1a",  # srtm version
-                                                  batch_mode = False, # should not need to set True for this usecase
-                                                  fallback = False,   # do not fallback to lowres data
-                                                  EDuser = _eduser,   # user id
-                                                  EDpass = _edpass    # password
-                                                )
 
+    max_bytes = int(float(os.environ.get('PLANIT_TILE_CACHE_MB', 512)) * 1024**2)
+
+    if os.environ.get('PLANIT_DEM', None):
+        return RasterProvider(os.environ['PLANIT_DEM'], max_bytes = max_bytes)
+
+    return SRTMProvider(version = "v3.1a",
+                        tile_cache = os.environ.get('PLANIT_TILE_CACHE', None),
+                        max_bytes  = max_bytes)
+
+def get_elevation_provider():
+    """
+    The ElevationProvider (see elevation.py) used for all elevations,
+    loading the default one on first use.
+    """
+    global _elevation_data
+
+    if _elevation_data is None:
+        with _elevation_lock:
+            if _elevation_data is None:
+                _elevation_data = _load_elevations()
+
+    return _elevation_data
+
+def set_elevation_provider(provider):
+    """
+    Use `provider` (any ElevationProvider, see elevation.py) for all
+    elevations from now on. None goes back to the default on next use.
+    """
+    global _elevation_data
 
-    return ed
+    with _elevation_lock:
+        _elevation_data = provider
 
-_elevation_data = _load_elevations()
+    return
 
 
 def combine_gpx(segments):
@@ -140,100 +172,433 @@ setattr(shapely.geometry.LineString, "append", LineString_append)
 setattr(shapely.geometry.LineString, "prepend", LineString_prepend)
 
 
-def add_elevations(gpx, smooth=False):
+# along-track sampling intervals (m) averaged over when smoothing elevations.
+# these are the same (somewhat random) intervals srtm.py uses (see `_interval_samples`).
+SMOOTHING_DISTANCES = (35.0, 141.0, 241.0)
+
+# what to do when a whole track has no elevation data: 'nearest' looks for the
+# closest valid elevation around it, otherwise a fixed elevation (m). The
+# last resort is FALLBACK_ELEVATION.
+ELEVATION_FALLBACK = 'nearest'
+FALLBACK_ELEVATION = 1624.0 # hard code to Boulder cause. why the hell not (BAD)
+
+_repair_counts = {'points' : 0, 'repaired' : 0, 'segments' : 0, 'all_missing' : 0}
+_repair_lock   = threading.Lock()
+
+
+def _lookup_elevations(lat, long):
+    """
+    Raw elevations at each (lat, long) as a float array, with NaN
+    where there is no data.
     """
-    WARNING: ASSUMES ONLY A SINGLE TRACK AND SEGMENT IN GPX OBJECT
 
-    Given a gpxpy gpx object, adds in elevations to all points (overwriting
-    any existing values). Since the srtm elevation can sometimes return None
-    for certain points (unknown why) does some error checking to make sure
-    that points give valid elevation. Does interpolation / flattening to
-    fill in the None-ed points.
+    return np.asarray(get_elevation_provider().get_elevations(np.asarray(lat, dtype=float),
+                                                     np.asarray(long, dtype=float)), dtype=float)
 
-    Fails if all are None. Really hope this doesn't happen.
+
+def _along_track(lat, long):
+    """
+    Cumulative 2D distance (m) along a track.
     """
 
-    # this gives `None` in some cases (argh!)
-    _elevation_data.add_elevations(gpx, smooth=smooth) #, smooth=True)
+    flat = np.column_stack((lat, long, np.full(len(lat), np.nan)))
 
-    gpx_segment = gpx.tracks[0].segments[0]
+    return np.concatenate(([0.0], np.cumsum(gpx_distances(flat))))
+
+
+def _interval_samples(along, interval):
+    """
+    Indices of the track points sampled at `interval` (m) when smoothing,
+    picked the same way srtm.py does: the two ends, and each point where the
+    distance along the track passes the next threshold, which goes up by
+    `interval` each time a point is sampled.
+    """
+
+    index     = [0]
+    threshold = interval
+    for i in range(1, len(along) - 1):
+        if along[i] > threshold:
+            index.append(i)
+            threshold += interval
+    index.append(len(along) - 1)
+
+    return np.array(index)
+
+
+def _nearest_elevation(lat, long, radii = (100.0, 250.0, 500.0, 1000.0, 2000.0), n_angles = 16):
+    """
+    Average valid elevation on the smallest ring (radius in m) around the
+    center of the given points that has any, or None if none do.
+    """
+
+    lat0, long0 = np.average(lat), np.average(long)
+    angles      = np.linspace(0.0, 2.0*np.pi, n_angles, endpoint = False)
+
+    for r in radii:
+        dlat   = r / gpxpy.geo.ONE_DEGREE * np.sin(angles)
+        dlong  = r / gpxpy.geo.ONE_DEGREE * np.cos(angles) / np.cos(np.radians(lat0))
+        values = _lookup_elevations(lat0 + dlat, long0 + dlong)
+
+        if np.any(np.isfinite(values)):
+            return float(np.nanmean(values))
+
+    return None
+
+
+def get_elevations(latlong, smooth=False, fallback=None, ends=None):
+    """
+    Elevations along a track.
+
+    If `smooth`, this gives the same elevations as srtm.py's smoothing did:
+    for each of a few along-track intervals (SMOOTHING_DISTANCES) some track
+    points are sampled (see `_interval_samples`), the rest are linearly
+    interpolated along the track between them, and the results are averaged.
+    All sampled points are looked up in one batch. Missing values are
+    repaired (see `repair_elevations`).
+
+    Parameters:
+    ------------
+    latlong  : (N,2) array (or list of tuples) of (latitude, longitude)
+    smooth   : (Optional, bool) smooth elevations along the track. Default : False
+    fallback : (Optional, float or 'nearest') elevation to use if there are no
+               valid elevations along the whole track. 'nearest' uses the closest
+               valid elevation around the track (see `_nearest_elevation`),
+               falling back to FALLBACK_ELEVATION. Default : ELEVATION_FALLBACK
+    ends     : (Optional, tuple) already known elevations of the first and last
+               points (e.g. the nodes at either end of an edge, see
+               `get_point_elevations`), which are then not looked up again.
+               Default : None
+
+    Returns:
+    ------------
+    elevations : (N,) array of elevations (m)
+    """
+
+    latlong = np.asarray(latlong, dtype=float).reshape(-1,2)
+    lat, long = latlong[:,0], latlong[:,1]
+
+    if fallback is None:
+        fallback = ELEVATION_FALLBACK
+
+    if fallback == 'nearest':
+        def fallback():
+            value = _nearest_elevation(lat, long)
+            return FALLBACK_ELEVATION if value is None else value
+
+    if (ends is None) or (len(lat) < 2):
+        lookup = _lookup_elevations
+    else:
+        def lookup(lat, long):
+            # first and last points are the known ends
+            values = np.empty(len(lat))
+            values[[0,-1]]  = ends
+            values[1:-1]    = _lookup_elevations(lat[1:-1], long[1:-1])
+            return values
+
+    along = None
+    if not smooth or len(lat) < 2:
+        elevations = lookup(lat, long)
 
-    elevations = np.array([x.elevation for x in gpx_segment.points])
-
-    is_none = (elevations == None)
-    if all(is_none):
-        print("WARNING: Found a segment with all failed elevations. Setting to hard-coded value for now")
-        elevations = np.ones(len(elevations)) * 1624.0 # hard code to Boulder cause. why the hell not (BAD)
-        is_none = elevations == None
-        #raise RuntimeError
-
-    if any(is_none):
-        print("WARNING: Found a segment with some failed elevations. Trying to fix.")
-
-        not_none = np.logical_not(is_none)
-
-        # need to fix. just interpolate or copy
-        if elevations[0] is None:
-            # find first non-None
-            first = np.where(not_none)[0][0]
-            elevations[:first-1] = elevations[first]
-
-        if elevations[-1] is None:
-            last = np.where(not_none)[0][-1]
-            elevations[last:] = elevations[last]
-
-        # if that didn't fix them all, then we need to go in the
-        # array and check for more
-        is_none  = elevations == None
-        if any(is_none):
-            # more fixing needed
-            where_not_none = np.where(np.logical_not(is_none))[0]
-            for index in np.where(is_none)[0]:
-                if not (elevations[index] is None):
+    else:
+        along  = _along_track(lat, long)
+        length = along[-1]
+
+        if length <= 0.0:
+            elevations = lookup(lat, long)
+
+        else:
+            samples = [_interval_samples(along, dx) for dx in SMOOTHING_DISTANCES]
+            index   = np.unique(np.concatenate(samples))   # includes both ends
+
+            values        = np.full(len(lat), np.nan)
+            values[index] = lookup(lat[index], long[index])
+
+            elevations = np.zeros(len(lat))
+            for sample in samples:
+                # interpolate over missing samples, but not past the valid ends
+                sample = sample[np.isfinite(values[sample])]
+                if len(sample) == 0:
+                    elevations += np.nan
                     continue
 
-                prev_valid = where_not_none[ where_not_none < index][-1]
-                next_valid  = where_not_none[ where_not_none > index][0]
+                interp = np.interp(along, along[sample], values[sample])
+                interp[:sample[0]]    = np.nan
+                interp[sample[-1]+1:] = np.nan
+                elevations += interp
+
+            elevations = elevations / (1.0 * len(SMOOTHING_DISTANCES))
+
+    if np.any(np.isnan(elevations)) and (along is None) and (len(lat) > 1):
+        along = _along_track(lat, long)
 
-                # TO DO: Change this to an interpolation using distance (point-by-point)
-                # a      and not just an average
-                elevations[index] = np.average([elevations[prev_valid],elevations[next_valid]])
+    return repair_elevations(elevations, along = along, fallback = fallback)
+
+
+def get_point_elevations(lat, long, fallback=None):
+    """
+    Elevations of unconnected points (e.g. graph nodes) in one batched lookup.
+    Missing values cannot be interpolated, so each is replaced by the nearest
+    valid elevation around it (or `fallback`, see `get_elevations`).
+
+    Parameters:
+    ------------
+    lat, long : arrays of coordinates
+    fallback  : (Optional, float or 'nearest') as in `get_elevations`.
+                Default : ELEVATION_FALLBACK
+
+    Returns:
+    ------------
+    elevations : array of elevations (m)
+    """
+
+    lat  = np.asarray(lat, dtype=float)
+    long = np.asarray(long, dtype=float)
+
+    elevations = _lookup_elevations(lat, long)
+    missing    = np.where(np.isnan(elevations))[0]
+
+    with _repair_lock:
+        _repair_counts['points'] += len(elevations) - len(missing)
+
+    # (these are counted as repaired)
+    for i in missing:
+        elevations[i] = get_elevations([(lat[i],long[i])], fallback=fallback)[0]
+
+    return elevations
+
+
+def repair_elevations(elevations, along=None, fallback=None):
+    """
+    Fill in missing (None or NaN) elevations. The srtm data can sometimes
+    give None for certain points (unknown why). Missing points are linearly
+    interpolated in distance along the track between the valid points on
+    either side. Points at the ends take the nearest valid value.
+
+    Counts of repaired points are kept (see `elevation_repair_counts`).
+
+    Parameters:
+    ------------
+    elevations : (N,) elevations, with None or NaN where missing
+    along      : (Optional, array) cumulative distance along the track for each
+                 point. Default : None (points equally spaced)
+    fallback   : (Optional, float or callable) elevation (or function returning one)
+                 to use if all are missing. Default : FALLBACK_ELEVATION
+
+    Returns:
+    ------------
+    elevations : (N,) float array with no missing values
+    """
+
+    elevations = np.array(elevations, dtype=float) # None -> NaN
+
+    is_none = np.isnan(elevations)
+
+    with _repair_lock:
+        _repair_counts['points'] += len(elevations)
+
+    if not np.any(is_none):
+        return elevations
+
+    if np.all(is_none):
+        if fallback is None:
+            fallback = FALLBACK_ELEVATION
+        value = fallback() if callable(fallback) else fallback
+
+        # counted, and reported once per build (see `elevation_repair_counts`)
+        with _repair_lock:
+            _repair_counts['repaired']    += len(elevations)
+            _repair_counts['segments']    += 1
+            _repair_counts['all_missing'] += 1
+
+        return np.ones(len(elevations)) * value
+
+    if along is None:
+        along = np.arange(len(elevations), dtype=float)
+    along = np.asarray(along, dtype=float)
+
+    valid = np.logical_not(is_none)
+    elevations[is_none] = np.interp(along[is_none], along[valid], elevations[valid])
+
+    with _repair_lock:
+        _repair_counts['repaired'] += int(np.sum(is_none))
+        _repair_counts['segments'] += 1
+
+    return elevations
+
+
+def elevation_repair_counts(reset=False):
+    """
+    Counts of elevation points looked up ('points'), repaired ('repaired'),
+    tracks with any repairs ('segments'), and tracks with no valid elevations
+    at all ('all_missing') in this process since the last reset.
+    """
+
+    with _repair_lock:
+        result = dict(_repair_counts)
+        if reset:
+            for k in _repair_counts:
+                _repair_counts[k] = 0
+
+    return result
+
+
+def add_elevations(gpx, smooth=False):
+    """
+    WARNING: ASSUMES ONLY A SINGLE TRACK AND SEGMENT IN GPX OBJECT
+
+    Given a gpxpy gpx object, adds in elevations to all points (overwriting
+    any existing values). Wrapper around `get_elevations`, which should be
+    used directly if you do not already have a gpx object.
+    """
+
+    gpx_segment = gpx.tracks[0].segments[0]
+
+    elevations = get_elevations([(x.latitude,x.longitude) for x in gpx_segment.points], smooth=smooth)
 
     # copy back to gpx points
     for i in range(len(gpx_segment.points)):
         gpx_segment.points[i].elevation = elevations[i]
 
-    if any(elevations == None):
-        print("WARNING: Segment still has bad values for elevation after fixing")
-
     return gpx # just in case
 
 
+def _as_coordinate_array(points):
+    """
+    (N,3) float array of (latitude, longitude, elevation) from a list of
+    GPXTrackPoints, a list of (lat, long, elevation) tuples, or an (N,3)
+    array. Missing elevations become NaN.
+    """
+
+    if isinstance(points, np.ndarray):
+        return np.asarray(points, dtype=float)
+
+    if hasattr(points[0], 'latitude'):
+        points = [(x.latitude,x.longitude,x.elevation) for x in points]
+
+    return np.array(points, dtype=float)
+
+
 def gpx_distances(points):
     """
-    Compute distances between gpx points, either as list of
-    GPXTrackPoints from gpxpy OR list of tuples
+    Compute distances between consecutive gpx points, either as list of
+    GPXTrackPoints from gpxpy, list of (lat, long, elevation) tuples, or
+    an (N,3) array.
+
+    Vectorized version of calling `gpxpy.geo.distance` on each pair,
+    giving the same results: a flat-earth approximation including
+    elevation for nearby points, and haversine (without elevation) for
+    points more than 0.2 degrees apart. Elevation is ignored for pairs
+    missing either elevation.
     """
 
-    is_GPX = False
-    if not isinstance(points[0],tuple):
-        is_GPX=True
+    p = _as_coordinate_array(points)
 
-    if is_GPX:
-        p = [(x.latitude,x.longitude,x.elevation) for x in points]
-    else:
-        p = points
+    lat1, long1, ele1 = p[1:,0],  p[1:,1],  p[1:,2]
+    lat2, long2, ele2 = p[:-1,0], p[:-1,1], p[:-1,2]
+
+    dlat  = lat1 - lat2
+    dlong = long1 - long2
 
+    coef     = np.cos(np.radians(lat1))
+    distance = np.sqrt(dlat*dlat + (dlong*coef)**2) * gpxpy.geo.ONE_DEGREE
 
-    distance = np.zeros(len(p)-1)
-    for i in np.arange(1, len(p)):
-        distance[i-1] = gpxpy.geo.distance(p[i][0],p[i][1],p[i][2],
-                                           p[i-1][0],p[i-1][1],p[i-1][2])
+    dz = ele1 - ele2
+    dz[np.isnan(dz)] = 0.0
+    distance = np.sqrt(distance*distance + dz*dz)
 
+    far = (np.abs(dlat) > 0.2) | (np.abs(dlong) > 0.2)
+    if np.any(far):
+        rlat1, rlat2 = np.radians(lat1[far]), np.radians(lat2[far])
+        a = np.sin(0.5*(rlat1-rlat2))**2 +\
+            np.sin(0.5*np.radians(dlong[far]))**2 * np.cos(rlat1) * np.cos(rlat2)
+        distance[far] = 2.0 * np.arcsin(np.sqrt(a)) * gpxpy.geo.EARTH_RADIUS
 
     return np.abs(distance)
 
 
+def track_properties(coords):
+    """
+    Compute all of the edge properties TrailMap needs for routing from a
+    single, continuous track of (long, lat, elevation) coordinates oriented
+    from tail to head. Distances account for elevation.
+
+    NOTE: Elevation gain and elevation loss requires defining a direction
+          to travel on the trail. By convention the default direction
+          will be from the tail -> head, where the node number of tail <
+          the node number of head. So elevation_gain becomes
+          elevation_loss when travelling from head to tail!!
+
+    Parameters:
+    ------------
+    coords   : list of (long, lat, elevation) tuples (or (N,3) array)
+
+    Returns:
+    ------------
+    d        : dictionary of edge properties
+    """
+
+    d = {}
+
+    coords      = np.array(coords, dtype=float)
+    distances   = gpx_distances(coords[:,[1,0,2]])
+    elevations  = coords[:,2]
+    dz          = (elevations[1:] - elevations[:-1])  # change in elevations
+    grade       = dz / distances * 100.0            # percent grade!
+    grade[np.abs(distances) < 0.1] = 0.0            # prevent arbitary large grades for short segs with errors
+
+
+    d['geometry']         = shapely.geometry.LineString(coords)
+    d['distance']         = np.sum(distances)
+    d['elevation_gain']   = np.sum(dz[dz>0])            # see note above!
+    d['elevation_loss']   = np.abs(np.sum( dz[dz<0] ))  # store as pos val
+    d['elevation_change'] = d['elevation_gain'] + d['elevation_loss']
+    d['min_grade']        = np.min(grade)
+    d['max_grade']        = np.max(grade)
+    d['average_grade']    = np.average(grade, weights = distances) # weighted avg!!
+
+    #
+    # Average min and max grade give a BETTER estimate of the conceptual 'how steep is this trail'
+    # with average min meaning the typical steepest downhill (not the steepest possible downhill)
+    # and average max meaning the typical steepest uphill. Reason why its not absolute min/max of
+    # each is becase there could be short sections (e.g. a switchback corner) that is VERY steep.
+    # Want to generally be ok with super short steep sections and constrain more on the 'typical'
+    # grade of the route. If there are no descents, min grade is the average grade of everything
+    # less than the average (I know......) and max is average of everything above max
+    #
+    # This can give a better idea of "runnable"
+    #
+    if np.sum(distances[grade>0]) > 0:
+        d['average_max_grade']    = np.average(grade[grade>0], weights = distances[grade>0]) # weighted avg!!
+    elif np.sum(distances[grade>d['average_grade']]) > 0:
+        d['average_max_grade']    = np.average(grade[grade>d['average_grade']], weights=distances[grade>d['average_grade']])
+    else:
+        d['average_max_grade'] = d['average_grade']
+
+    if np.sum(distances[grade<0]) > 0:
+        d['average_min_grade']    = np.average(grade[grade<0], weights = distances[grade<0]) # w
+    elif np.sum(distances[grade<d['average_grade']]) > 0:
+        d['average_min_grade']    = np.average(grade[grade<d['average_grade']],weights=distances[grade<d['average_grade']])
+    else:
+        d['average_min_grade'] = d['average_grade']
+
+    d['min_altitude']     = np.min(elevations)
+    d['max_altitude']     = np.max(elevations)
+    d['average_altitude'] = np.average(0.5*(elevations[1:]+elevations[:-1]),weights=distances)
+    d['traversed_count']  = 0
+
+    # apparenlty geopandas uses fiona to do writing to file
+    # which DOESN"T support storing lists / np arrays into individual
+    # cells. The below is a workaround (and a sin).. converting to a string
+    #
+    # MAKING ELEVATIONS SAME LENGTH AS DISTANCES!!
+    #
+    d['elevations']  = ','.join(["%6.2E"%(a) for a in 0.5*(elevations[1:]+elevations[:-1])])
+    d['grades']      = ','.join(["%6.2E"%(a) for a in grade])
+    d['distances']   = ','.join(["%6.2E"%(a) for a in distances])
+
+    return d
+
+
 def traverse_merge_list(ni, merge_list, to_merge):
     """
     Recursive function traverse a list (`merge_list`) containing
@@ -494,7 +859,8 @@ def process_data(input_gdf,
 
     lat  = [n['lat'] for n in nodes]
     long = [n['long'] for n in nodes]
-    elev = [_elevation_data.get_elevation(x,y) for (x,y) in zip(lat,long)]
+    elevation_repair_counts(reset=True) # reported once elevations are all done
+    elev = [float(x) for x in get_point_elevations(lat, long)] # one batched lookup
     for i,val in enumerate(elev):
         nodes[i]['elevation'] = val
 
@@ -674,23 +1040,10 @@ def process_data(input_gdf,
         new_line = _gdf['geometry'][i].append(head_coords)
         new_line = new_line.prepend(tail_coords)
 
-        #
-        # Generate a GPX track object from this data to (easily) add in
-        # elevations.
-        #
-        gpx = gpxpy.gpx.GPX()
-        gpx_track = gpxpy.gpx.GPXTrack()
-        gpx.tracks.append(gpx_track)
-
-        gpx_segment = gpxpy.gpx.GPXTrackSegment()
-        gpx_track.segments.append(gpx_segment)
-
-        gpx_points  = [gpxpy.gpx.GPXTrackPoint(x[1],x[0]) for x in new_line.coords]
-        gpx_segment.points.extend(gpx_points)
-
         # add in elevation data
-        gpx = add_elevations(gpx, smooth=True)
-        gpx_segment = gpx.tracks[0].segments[0]
+        coords     = np.array([(x[0],x[1]) for x in new_line.coords])
+        elevations = get_elevations(coords[:,::-1], smooth=True)
+        points     = np.column_stack((coords[:,1], coords[:,0], elevations)) # lat, long, elevation
 
         # point-point distances and elevations
         #
@@ -701,15 +1054,14 @@ def process_data(input_gdf,
         #       elevation_loss when travelling from head to tail!!
         #
 
-        distances   = gpx_distances(gpx_segment.points)
-        elevations  = np.array([x.elevation for x in gpx_segment.points])
+        distances   = gpx_distances(points)
         dz          = (elevations[1:] - elevations[:-1])  # change in elevations
         grade       = dz / distances * 100.0            # percent grade!
         grade[np.abs(distances) < 0.1] = 0.0            # prevent arbitary large grades for short segs with errors
 
 
         # save with elevations
-        _gdf.at[i,'geometry']         = shapely.geometry.LineString([(x.longitude,x.latitude,x.elevation) for x in gpx_segment.points])
+        _gdf.at[i,'geometry']         = shapely.geometry.LineString(np.column_stack((coords, elevations)))
         _gdf.at[i,'distance']         = np.sum(distances)
         _gdf.at[i,'elevation_gain']   = np.sum(dz[dz>0])            # see note above!
         _gdf.at[i,'elevation_loss']   = np.abs(np.sum( dz[dz<0] ))  # store as pos val
@@ -734,6 +1086,11 @@ def process_data(input_gdf,
         all_grades[i]      = ','.join(["%6.2E"%(a) for a in grade])
         all_distances[i]   = ','.join(["%6.2E"%(a) for a in distances])
 
+    repairs = elevation_repair_counts(reset=True)
+    if repairs['repaired'] > 0:
+        print("Repaired %i of %i elevations in %i segments / nodes (%i with no data)"%(
+              repairs['repaired'], repairs['points'], repairs['segments'], repairs['all_missing']))
+
     _gdf.insert(5, 'elevations', all_elevations)
     _gdf.insert(5, 'grades', all_grades)
     _gdf.insert(5, 'distances', all_distances)
@@ -799,8 +1156,55 @@ def make_trail_map(segmented_gdf, trail_nodes, trail_edges,
     G.add_nodes_from(trail_nodes)
     # edges
     G.add_edges_from(trail_edges)
+    G.compute_components()
 
     if not (outname is None):
         save_graph(outname, G)
 
     return G
+
+
+def test_smoothing():
+    """
+    Regression test of `get_elevations(smooth=True)` against srtm.py's
+    smoothing (GeoElevationData.add_elevations(gpx, smooth=True)), which it
+    replaced. Expected values were computed with srtm.py 0.3.7 on the same
+    track and elevations, with and without a gap in the data.
+    """
+
+    from planit.autotrail.elevation import ElevationProvider
+
+    class _Analytic(ElevationProvider):
+        def __init__(self, gap = None):
+            self.gap = gap
+
+        def get_elevations(self, lat, long):
+            lat, long = np.asarray(lat, dtype=float), np.asarray(long, dtype=float)
+            values    = 1600.0 + 250.0*np.sin(lat*900.0) + 120.0*np.cos(long*700.0) +\
+                        30.0*np.sin((lat+long)*5000.0)
+            if not (self.gap is None):
+                values[(lat > self.gap[0]) & (lat < self.gap[1])] = np.nan
+            return values
+
+    # uneven spacing, from a few m up to ~150 m
+    latlong = [(40.0000, -105.3000), (40.0003, -105.2998), (40.0004, -105.2994), (40.0010, -105.2990),
+               (40.0011, -105.2989), (40.0019, -105.2981), (40.0021, -105.2970), (40.0030, -105.2966),
+               (40.0042, -105.2960), (40.0043, -105.2950), (40.0050, -105.2947), (40.0062, -105.2940)]
+
+    expected = {None               : [1421.715, 1423.693, 1410.86, 1412.39, 1409.849, 1480.836,
+                                      1561.783, 1727.156, 1917.058, 1868.87, 1809.566, 1557.389],
+                (40.0020, 40.0025) : [1421.715, 1423.693, 1410.86, 1412.39, 1411.423, 1494.999,
+                                      1605.666, 1727.156, 1917.058, 1868.87, 1809.566, 1557.389]}
+
+    try:
+        for gap, values in expected.items():
+            set_elevation_provider(_Analytic(gap))
+            elevations = get_elevations(latlong, smooth=True)
+
+            assert np.max(np.abs(elevations - np.array(values))) < 0.01, (gap, elevations)
+    finally:
+        set_elevation_provider(None)
+
+    print("Elevation smoothing test passed")
+
+    return
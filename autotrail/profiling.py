@@ -0,0 +1,120 @@
+"""
+
+    Author  : Andrew Emerick
+    e-mail  : aemerick11@gmail.com
+    year    : 2020
+
+    LICENSE :GPLv3
+
+    Lightweight, opt-in instrumentation to see where time goes during
+    route finding (and map processing). Phases are timed with monotonic
+    timers and aggregated along with simple event counters. When turned
+    off, the only cost is returning a shared do-nothing timer.
+"""
+
+import time
+
+
+class _NullTimer():
+    """
+    Do-nothing stand-in for a phase timer when profiling is off.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+NULL_TIMER = _NullTimer()
+
+
+class _PhaseTimer():
+    """
+    Context manager timing a single phase into a ProfileStats object.
+    """
+
+    __slots__ = ('_stats', '_phase', '_start')
+
+    def __init__(self, stats, phase):
+        self._stats = stats
+        self._phase = phase
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self._stats.add_time(self._phase, time.perf_counter() - self._start)
+        return False
+
+
+class ProfileStats():
+    """
+    Aggregated per-phase times (in s), number of calls per phase, and
+    event counters.
+    """
+
+    def __init__(self):
+
+        self.times  = {}
+        self.calls  = {}
+        self.counts = {}
+
+        return
+
+    def timer(self, phase):
+        """
+        Context manager to time `phase`:
+
+            > with stats.timer('dijkstra'):
+            >     ...
+        """
+        return _PhaseTimer(self, phase)
+
+    def add_time(self, phase, dt):
+        self.times[phase] = self.times.get(phase, 0.0) + dt
+        self.calls[phase] = self.calls.get(phase, 0) + 1
+        return
+
+    def count(self, name, n = 1):
+        self.counts[name] = self.counts.get(name, 0) + n
+        return
+
+    def merge(self, other):
+        """
+        Add in the results from another ProfileStats (e.g. from a worker).
+        """
+
+        for k, v in other.times.items():
+            self.times[k] = self.times.get(k, 0.0) + v
+        for k, v in other.calls.items():
+            self.calls[k] = self.calls.get(k, 0) + v
+        for k, v in other.counts.items():
+            self.counts[k] = self.counts.get(k, 0) + v
+
+        return self
+
+    def as_dict(self):
+        """
+        JSON-friendly dictionary of all results.
+        """
+        return {'times' : dict(self.times), 'calls' : dict(self.calls), 'counts' : dict(self.counts)}
+
+    def summary(self):
+        """
+        Human readable table of phases sorted by total time, then counters.
+        """
+
+        lines = ["%30s %12s %10s"%("Phase", "Time (s)", "Calls")]
+        for k in sorted(self.times, key=self.times.get, reverse=True):
+            lines.append("%30s %12.4f %10i"%(k, self.times[k], self.calls[k]))
+
+        for k in sorted(self.counts):
+            lines.append("%30s %12i"%(k, self.counts[k]))
+
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return self.summary()
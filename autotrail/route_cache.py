@@ -0,0 +1,512 @@
+"""
+
+    Author  : Andrew Emerick
+    e-mail  : aemerick11@gmail.com
+    year    : 2020
+
+    LICENSE :GPLv3
+
+    Cache for route finding results. Requests for nearly identical routes
+    (e.g. same trailhead with 10 vs 10.1 miles) map to the same entry by
+    bucketing target values to a configurable precision. Entries are keyed by:
+
+        (region, map version, start node, end node, bucketed targets,
+         routing parameters, seed)
+
+    so results are never served for a map that has since been rebuilt
+    (see `TrailMap.map_version`). Only seeded requests are cached, since
+    unseeded requests should give different routes each time. On a hit, cached routes are re-scored
+    against the exact targets requested.
+
+    The in-memory tier is LRU with a memory (bytes) limit and a time to live.
+    An optional disk tier keeps entries across restarts.
+
+    Example:
+
+        > cache  = RouteCache(max_bytes = 100*1024**2, ttl = 3600.0)
+        > totals, routes, errors = cache.multi_find_route(tmap, start_node,
+        >                                                 {'distance' : 16000.0},
+        >                                                 region = 'boulder', rng = 42)
+        > cache.stats()
+"""
+
+import numpy as np
+import collections
+import hashlib
+import os
+import threading
+import time
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+from planit.autotrail.cancellation import is_cancelled
+
+
+# default bucket sizes (absolute) for common targets. All others use
+# `relative_precision`
+DEFAULT_PRECISION = {'distance'       : 402.336, # 0.25 mi
+                     'elevation_gain' : 30.48,   # 100 ft
+                     'elevation_loss' : 30.48}
+
+# TrailMap settings that change routing results
+_ENGINE_SETTINGS = ['backtrack', '_dynamic_weighting', '_weight_precision',
+                    '_direction_sampling', '_default_weight_factors']
+
+# arguments that cannot be cached on
+_UNCACHEABLE = ['subgraph', 'return_stats']
+
+# arguments that do not change the result (not part of the key)
+UNKEYED_ARGUMENTS = ['rng', 'end_node', 'cancel']
+
+
+class RouteCache():
+    """
+    Two-tier (memory / disk) LRU + TTL cache of route finding results.
+    """
+
+    def __init__(self, max_bytes = 256*1024**2, ttl = 3600.0,
+                       precision = None, relative_precision = 0.02,
+                       disk_dir = None, disk_max_bytes = 2*1024**3,
+                       clock = time.time):
+        """
+        Parameters:
+        -----------
+        max_bytes          : (Optional, int) memory budget (pickled size) for the
+                             in-memory tier. Default : 256 MB
+        ttl                : (Optional, float) time to live of entries (s). None
+                             for no expiration. Default : 3600
+        precision          : (Optional, dict) bucket size for each target value.
+                             Updates `DEFAULT_PRECISION`. Default : None
+        relative_precision : (Optional, float) fractional bucket size for targets
+                             not in `precision`. Default : 0.02
+        disk_dir           : (Optional, str) directory for disk tier. None for
+                             no disk tier. Default : None
+        disk_max_bytes     : (Optional, int) size limit for disk tier. Default : 2 GB
+        clock              : (Optional, callable) time function. Default : time.time
+        """
+
+        self.max_bytes          = max_bytes
+        self.ttl                = ttl
+        self.precision          = dict(DEFAULT_PRECISION)
+        if not (precision is None):
+            self.precision.update(precision)
+        self.relative_precision = relative_precision
+
+        self.disk_dir           = disk_dir
+        self.disk_max_bytes     = disk_max_bytes
+        if not (disk_dir is None) and not os.path.isdir(disk_dir):
+            os.makedirs(disk_dir)
+
+        self._clock   = clock
+        self._lock    = threading.RLock()
+        self._entries = collections.OrderedDict() # key -> (expires, region, version, bytes)
+        self._bytes   = 0
+
+        # sizes of disk tier files, kept up to date on put / remove so the
+        # directory is only scanned here and when over the size limit
+        self._disk_sizes = {}
+        self._disk_bytes = 0
+        if not (disk_dir is None):
+            self._disk_scan()
+
+        self._counts  = {k : 0 for k in ['hits', 'misses', 'memory_hits', 'disk_hits',
+                                         'puts', 'evictions', 'expirations',
+                                         'invalidations', 'uncacheable']}
+
+        return
+
+    #
+    # keys
+    #
+    def bucket(self, key, value):
+        """
+        Bucket (integer) for target value `value` of target `key`. Tuples
+        (ranges) are bucketed element-wise.
+        """
+
+        if isinstance(value, (tuple, list)):
+            return tuple(self.bucket(key, v) for v in value)
+
+        value = float(value)
+
+        if key in self.precision:
+            return int(np.round(value / self.precision[key]))
+
+        if value == 0.0:
+            return 0
+
+        # log-spaced buckets of fractional width `relative_precision`
+        b = int(np.round(np.log(np.abs(value)) / np.log1p(self.relative_precision)))
+
+        return b if value > 0 else ('-', b)
+
+    def make_key(self, tmap, method, start_node, target_values, region = None,
+                       end_node = None, seed = None, params = None):
+        """
+        Key for a request. Returns None if the request can not be cached.
+
+        Parameters:
+        -----------
+        tmap          : (TrailMap) map the request is made on
+        method        : (str) routing method name (e.g. 'multi_find_route')
+        start_node    : (int) start node
+        target_values : (dict) target values (or ranges)
+        region        : (Optional, str) region name. Default : `tmap.name`
+        end_node      : (Optional, int) end node. Default : `start_node`
+        seed          : (Optional, int) random seed. Unseeded requests (None)
+                        should give new routes each time and requests made
+                        with a numpy Generator can not be repeated, so
+                        neither are cached. Default : None
+        params        : (Optional, dict) any other routing arguments. Default : None
+        """
+
+        if params is None:
+            params = {}
+
+        if any(k in params for k in _UNCACHEABLE):
+            return None
+
+        if not isinstance(seed, (int, np.integer)):
+            return None
+
+        if region is None:
+            region = tmap.name
+
+        if end_node is None:
+            end_node = start_node
+
+        targets  = tuple(sorted((k, self.bucket(k, v)) for k, v in target_values.items()))
+        settings = tuple((k, repr(getattr(tmap, k, None))) for k in _ENGINE_SETTINGS)
+        params   = tuple(sorted((k, repr(v)) for k, v in params.items()))
+
+        raw = repr((method, region, tmap.map_version, int(start_node), int(end_node),
+                    targets, settings, params, seed))
+
+        return region, tmap.map_version, hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    #
+    # storage
+    #
+    def get(self, key):
+        """
+        Cached value for `key` (from `make_key`) or None.
+        """
+
+        if key is None:
+            return None
+
+        region, version, digest = key
+        now = self._clock()
+
+        with self._lock:
+            entry = self._entries.get(digest, None)
+
+            if not (entry is None):
+                if (not (entry[0] is None)) and (entry[0] < now):
+                    self._drop(digest)
+                    self._counts['expirations'] += 1
+                else:
+                    self._entries.move_to_end(digest)
+                    self._counts['hits']        += 1
+                    self._counts['memory_hits'] += 1
+                    return pickle.loads(entry[3])
+
+        data = self._disk_get(region, version, digest, now)
+
+        with self._lock:
+            if data is None:
+                self._counts['misses'] += 1
+                return None
+
+            self._counts['hits']      += 1
+            self._counts['disk_hits'] += 1
+            self._store(digest, data[0], region, version, data[1])
+
+        return pickle.loads(data[1])
+
+    def put(self, key, value):
+        """
+        Cache `value` under `key` (from `make_key`).
+        """
+
+        if key is None:
+            return
+
+        region, version, digest = key
+        expires = None if self.ttl is None else self._clock() + self.ttl
+        data    = pickle.dumps(value, protocol = 4)
+
+        with self._lock:
+            self._store(digest, expires, region, version, data)
+            self._counts['puts'] += 1
+
+        self._disk_put(region, version, digest, expires, data)
+
+        return
+
+    def invalidate(self, region = None, current_version = None):
+        """
+        Drop entries for `region` (all regions if None) that do not belong to
+        `current_version` of the map (drops all if None). Entries for old map
+        versions can never be hit, so this just frees up space right away
+        when a map is rebuilt.
+
+        Returns:
+        ----------
+        n       : (int) number of entries dropped from memory
+        """
+
+        with self._lock:
+            drop = [k for k, e in self._entries.items() if ((region is None) or (e[1] == region)) and
+                                                          ((current_version is None) or (e[2] != current_version))]
+            for k in drop:
+                self._drop(k)
+            self._counts['invalidations'] += len(drop)
+
+        if not (self.disk_dir is None):
+            for fname, payload in self._disk_entries():
+                if ((region is None) or (payload[1] == region)) and\
+                   ((current_version is None) or (payload[2] != current_version)):
+                    self._remove(fname)
+
+        return len(drop)
+
+    def clear(self):
+        """
+        Drop everything (memory and disk).
+        """
+        return self.invalidate()
+
+    def _store(self, digest, expires, region, version, data):
+
+        if digest in self._entries:
+            self._drop(digest)
+
+        if len(data) > self.max_bytes:
+            return
+
+        self._entries[digest] = (expires, region, version, data)
+        self._bytes += len(data)
+
+        while self._bytes > self.max_bytes:
+            k = next(iter(self._entries))
+            self._drop(k)
+            self._counts['evictions'] += 1
+
+        return
+
+    def _drop(self, digest):
+        entry = self._entries.pop(digest)
+        self._bytes -= len(entry[3])
+        return
+
+    #
+    # disk tier. One pickle per entry: (expires, region, version, data)
+    #
+    def _disk_name(self, digest):
+        return os.path.join(self.disk_dir, digest + '.pickle')
+
+    def _disk_get(self, region, version, digest, now):
+
+        if self.disk_dir is None:
+            return None
+
+        fname = self._disk_name(digest)
+        if not os.path.isfile(fname):
+            return None
+
+        try:
+            with open(fname, 'rb') as infile:
+                expires, _region, _version, data = pickle.load(infile)
+        except Exception:
+            self._remove(fname)
+            return None
+
+        if (_version != version) or ((not (expires is None)) and (expires < now)):
+            self._remove(fname)
+            with self._lock:
+                self._counts['expirations'] += 1
+            return None
+
+        return expires, data
+
+    def _disk_put(self, region, version, digest, expires, data):
+
+        if self.disk_dir is None:
+            return
+
+        fname = self._disk_name(digest)
+        tmp   = fname + '.%i.tmp'%(os.getpid())
+        with open(tmp, 'wb') as outfile:
+            pickle.dump((expires, region, version, data), outfile, protocol = 4)
+        os.replace(tmp, fname)
+
+        size = os.path.getsize(fname)
+        with self._lock:
+            self._disk_bytes      += size - self._disk_sizes.get(fname, 0)
+            self._disk_sizes[fname] = size
+            over = self._disk_bytes > self.disk_max_bytes
+
+        if over:
+            self._disk_evict()
+
+        return
+
+    def _disk_scan(self):
+        """
+        (Re-)count the files in the disk tier.
+        """
+
+        sizes = {}
+        for f in os.listdir(self.disk_dir):
+            if not f.endswith('.pickle'):
+                continue
+            fname = os.path.join(self.disk_dir, f)
+            try:
+                sizes[fname] = os.path.getsize(fname)
+            except OSError:
+                pass
+
+        with self._lock:
+            self._disk_sizes = sizes
+            self._disk_bytes = sum(sizes.values())
+
+        return
+
+    def _disk_evict(self):
+        """
+        Remove oldest files until under 90% of the size limit, so this
+        (and its re-scan, in case other processes share the directory)
+        does not run on every put.
+        """
+
+        self._disk_scan()
+        target = 0.9 * self.disk_max_bytes
+
+        def _mtime(f):
+            try:
+                return os.path.getmtime(f)
+            except OSError:
+                return 0.0
+
+        with self._lock:
+            for f in sorted(self._disk_sizes.keys(), key = _mtime):
+                if self._disk_bytes <= target:
+                    break
+                self._remove(f)
+
+        return
+
+    def _disk_entries(self):
+        for f in os.listdir(self.disk_dir):
+            if not f.endswith('.pickle'):
+                continue
+            fname = os.path.join(self.disk_dir, f)
+            try:
+                with open(fname, 'rb') as infile:
+                    yield fname, pickle.load(infile)
+            except Exception:
+                self._remove(fname)
+
+    def _remove(self, fname):
+        try:
+            os.remove(fname)
+        except OSError:
+            pass
+
+        with self._lock:
+            self._disk_bytes -= self._disk_sizes.pop(fname, 0)
+
+        return
+
+    #
+    # metrics
+    #
+    @property
+    def hit_rate(self):
+        total = self._counts['hits'] + self._counts['misses']
+        return (self._counts['hits'] / total) if total > 0 else 0.0
+
+    def stats(self):
+        """
+        Dictionary of cache counters, hit rate, and memory (and disk) use.
+        """
+
+        with self._lock:
+            result = dict(self._counts)
+            result['hit_rate']   = self.hit_rate
+            result['entries']    = len(self._entries)
+            result['bytes']      = self._bytes
+            result['disk_bytes'] = self._disk_bytes
+
+        return result
+
+    def __len__(self):
+        return len(self._entries)
+
+    #
+    # cached routing
+    #
+    def multi_find_route(self, tmap, start_node, target_values, region = None, **kwargs):
+        """
+        Cached `tmap.multi_find_route`. kwargs are passed along (and are part
+        of the key, along with `rng` which must be an integer seed for the
+        request to be cached).
+        Returns the same as `multi_find_route`.
+        """
+        return self._cached_call(tmap, 'multi_find_route', start_node, target_values, region, kwargs)
+
+    def find_route_constraint_range(self, tmap, start_node, target_values_range, region = None, **kwargs):
+        """
+        Cached `tmap.find_route_constraint_range`. See `multi_find_route`.
+        """
+        return self._cached_call(tmap, 'find_route_constraint_range', start_node,
+                                 target_values_range, region, kwargs)
+
+    def _cached_call(self, tmap, method, start_node, target_values, region, kwargs):
+
+        kwargs = dict(kwargs)
+        seed   = kwargs.get('rng', None)
+        params = {k : v for k, v in kwargs.items() if not (k in UNKEYED_ARGUMENTS)}
+
+        key = self.make_key(tmap, method, start_node, target_values, region = region,
+                            end_node = kwargs.get('end_node', None), seed = seed,
+                            params = params)
+
+        if key is None:
+            with self._lock:
+                self._counts['uncacheable'] += 1
+            return getattr(tmap, method)(start_node, target_values, **kwargs)
+
+        result = self.get(key)
+
+        if result is None:
+            result = getattr(tmap, method)(start_node, target_values, **kwargs)
+
+            # never cache results of a search that was cut short
+            if not is_cancelled(kwargs.get('cancel', None)):
+                self.put(key, tuple(result[:3]))
+
+            return result
+
+        return self.rescore(tmap, result, target_values)
+
+    @staticmethod
+    def rescore(tmap, result, target_values):
+        """
+        Re-score (and re-sort) cached routes for the exact targets requested.
+        Range requests are returned as-is.
+        """
+
+        totals, routes, errors = result
+
+        if any(isinstance(v, (tuple, list)) for v in target_values.values()):
+            return list(totals), list(routes), errors
+
+        errors = np.array([tmap._route_error(t, target_values) for t in totals])
+        order  = np.argsort(errors)
+
+        return [totals[i] for i in order], [routes[i] for i in order], errors[order]
@@ -0,0 +1,141 @@
+"""
+
+    Author  : Andrew Emerick
+    e-mail  : aemerick11@gmail.com
+    year    : 2020
+
+    LICENSE :GPLv3
+
+    Candidate sampling for choosing the next waypoint in TrailMap.find_route.
+
+    Rather than picking uniformly from all nodes in the search annulus,
+    candidates are weighted by their bearing from home (rotating through
+    bearing sectors each hop so loops actually go around) and by whether or
+    not there is still enough distance left to get home from them.
+
+    The candidates (and weights) change every hop, so each weighted draw is
+    only made once. It is done directly from the cumulative weights (O(n),
+    vectorized) rather than building a sampling table first.
+"""
+
+import numpy as np
+
+
+class LoopSampler():
+    """
+    Direction-aware candidate sampler. Node bearings and great circle
+    distances relative to the home node are computed once (per request)
+    and reused for every hop of every route.
+    """
+
+    def __init__(self, G, home_node, loop = True,
+                       n_sectors = 4, concentration = 2.0, closure_scale = 0.1):
+        """
+        Parameters:
+        ------------
+        G             : (TrailMap) graph (or sub-graph view) being searched.
+        home_node     : (int) node route needs to return to (end node).
+        loop          : (Optional, bool) If True, rotate the preferred bearing
+                        by one sector each hop so that route circles home.
+                        Otherwise only the closure weighting is used. Default : True
+        n_sectors     : (Optional, int) number of bearing sectors in a loop. Default : 4
+        concentration : (Optional, float) how strongly to prefer the current sector
+                        (von Mises concentration). 0 is uniform. Default : 2.0
+        closure_scale : (Optional, float) fraction of the remaining distance used to
+                        soften the penalty on candidates that may be too far from
+                        home to get back. Default : 0.1
+        """
+
+        self.loop          = loop
+        self.n_sectors     = n_sectors
+        self.concentration = concentration
+        self.closure_scale = closure_scale
+
+        nodes = list(G.nodes)
+        self._index = {n : i for i, n in enumerate(nodes)}
+
+        lat  = np.radians(G.reduce_node_data('lat'))
+        long = np.radians(G.reduce_node_data('long'))
+
+        lat0  = np.radians(G.nodes[home_node]['lat'])
+        long0 = np.radians(G.nodes[home_node]['long'])
+
+        # initial bearing from home to each node
+        dlong = long - long0
+        self._bearing = np.arctan2(np.sin(dlong)*np.cos(lat),
+                                   np.cos(lat0)*np.sin(lat) - np.sin(lat0)*np.cos(lat)*np.cos(dlong))
+
+        self._distance = G.great_circle_distance(G.nodes[home_node]['lat'],
+                                                 G.nodes[home_node]['long'],
+                                                 G.reduce_node_data('lat'),
+                                                 G.reduce_node_data('long'))
+
+        self._start_bearing = 0.0
+
+        return
+
+    def reset(self, rng = None):
+        """
+        Start a new route by picking a random initial bearing.
+        """
+
+        if rng is None:
+            rng = np.random
+
+        self._start_bearing = rng.random() * 2.0 * np.pi
+
+        return
+
+    def weights(self, candidates, path_distances, remaining, hop = 0):
+        """
+        Sampling weights for each candidate node.
+
+        Parameters:
+        -----------
+        candidates     : (list) candidate node IDs
+        path_distances : (list) path distance from current node to each candidate
+        remaining      : (float) distance remaining in route before this hop
+        hop            : (Optional, int) hop number in route. Default : 0
+
+        Returns:
+        -----------
+        weights        : (array) un-normalized weights
+        """
+
+        index = np.array([self._index[n] for n in candidates])
+
+        weights = np.ones(len(candidates))
+
+        if self.loop and self.concentration > 0:
+            target  = self._start_bearing + hop * 2.0 * np.pi / self.n_sectors
+            weights = np.exp(self.concentration * (np.cos(self._bearing[index] - target) - 1.0))
+
+        # (lower bound) distance home vs. what would be left after this hop
+        left      = remaining - np.asarray(path_distances)
+        shortfall = np.maximum(self._distance[index] - left, 0.0)
+        weights   = weights * np.exp(-shortfall / (self.closure_scale*max(remaining,1.0)))
+
+        return weights
+
+    def draw(self, candidates, path_distances, remaining, hop = 0, rng = None):
+        """
+        Pick one of the candidates. See `weights`. If all weights are zero,
+        picks uniformly. `rng` is a numpy Generator / RandomState. Uses the
+        global numpy state if not provided.
+        """
+
+        if len(candidates) == 0:
+            raise ValueError("Cannot draw from no candidates")
+
+        if rng is None:
+            rng = np.random
+
+        cumulative = np.cumsum(self.weights(candidates, path_distances, remaining, hop=hop))
+        total      = cumulative[-1]
+
+        if (total <= 0) or not np.isfinite(total):
+            i = int(rng.random() * len(candidates))
+        else:
+            i = int(np.searchsorted(cumulative, rng.random() * total, side = 'right'))
+
+        return candidates[min(i, len(candidates) - 1)]
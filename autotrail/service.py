@@ -0,0 +1,504 @@
+"""
+
+    Author  : Andrew Emerick
+    e-mail  : aemerick11@gmail.com
+    year    : 2020
+
+    LICENSE :GPLv3
+
+    Long-lived local HTTP routing service (FastAPI, along the lines of
+    runtimer/test_api.py).
+
+    Loading a region (unpickling from cache/, ensuring edge attributes,
+    scaling) takes seconds, so decoded regions are kept in memory in an LRU
+    pool with a memory cap and prepared once when loaded. Each request
+    routes on its own small copy of the filtered sub-graph around the start
+    point, so the pooled maps are only ever read and concurrent requests
+    can share them. Copies share their region's edge scalings and cached
+    edge weights (see `TrailMap._edge_weight_cache`), so these are
+    computed once per region rather than on every request.
+
+    The HTTP endpoints go through an AsyncRouter (see async_routing.py),
+    which runs routing in an executor, has identical concurrent requests
+    share one computation, and cancels a request if its client disconnects.
+    By default this is a thread pool, so requests share the GIL. Pass
+    `make_app` a router with a `service_factory` to route in worker processes.
+
+    Endpoints:
+
+        GET /route    lat, long, distance [, elevation_gain, region, ...]
+        GET /range    lat, long, distance_min, distance_max [, elevation_gain_min,
+                      elevation_gain_max, region, ...]
+        POST /requery {lat, long, distance [, elevation_gain, region, seed, budget,
+                      n_routes], previous : earlier /route response}
+        GET /nearest  lat, long [, k, region]
+        GET /status   pool / cache status
+
+    Run with:
+
+        python service.py [host] [port]
+    or
+        uvicorn --factory planit.autotrail.service:make_app
+
+    (the app is not built on import, so importing this module does not
+    set up a service or cache).
+"""
+
+import numpy as np
+import asyncio
+import collections
+import sys
+import threading
+import time
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+from fastapi import FastAPI, HTTPException, Request
+
+from planit.autotrail.route_cache import RouteCache, UNKEYED_ARGUMENTS
+from planit.autotrail.cancellation import is_cancelled
+from planit.autotrail.async_routing import AsyncRouter
+
+
+class _ByteCounter():
+    """
+    File-like object that just counts bytes written.
+    """
+
+    def __init__(self):
+        self.n = 0
+
+    def write(self, b):
+        self.n += len(b)
+
+
+def estimate_bytes(tmap):
+    """
+    Approximate memory footprint of a map as its pickled size (without
+    holding the whole pickle in memory). Actual memory use is larger.
+    """
+
+    counter = _ByteCounter()
+    pickle.dump(tmap, counter, protocol = 4)
+
+    return counter.n
+
+
+def load_osm_region(**kwargs):
+    """
+    Default region loader. kwargs are passed to `osm_process.osmnx_trailmap`.
+    """
+
+    from planit.osm_data import osm_process
+
+    return osm_process.osmnx_trailmap(**kwargs)
+
+
+class MapPool():
+    """
+    LRU pool of decoded, prepared TrailMaps keyed by region, bounded by
+    (approximate) total memory.
+    """
+
+    def __init__(self, max_bytes = 4*1024**3, loader = load_osm_region,
+                       regions = None, default_dist = 40233.6):
+        """
+        Parameters:
+        -----------
+        max_bytes    : (Optional, int) memory cap for all pooled maps (see
+                       `estimate_bytes`). The most recently used map is always
+                       kept. Default : 4 GB
+        loader       : (Optional, callable) function called with region kwargs
+                       returning a TrailMap. Default : `load_osm_region`
+        regions      : (Optional, dict) named regions, mapping name to loader
+                       kwargs (e.g. {'boulder' : {'center_point' : (40.0,-105.3)}}).
+                       Default : None
+        default_dist : (Optional, float) size (m) of regions loaded around a point
+                       not in any pooled region. Default : 40233.6 (25 mi)
+        """
+
+        self.max_bytes    = max_bytes
+        self.loader       = loader
+        self.regions      = {} if regions is None else dict(regions)
+        self.default_dist = default_dist
+
+        self._maps    = collections.OrderedDict() # region -> (tmap, nbytes)
+        self._bytes   = 0
+        self._lock    = threading.Lock()
+        self._loading = {}                        # region -> lock held while loading
+
+        self._counts  = {'hits' : 0, 'loads' : 0, 'evictions' : 0, 'load_time' : 0.0}
+
+        return
+
+    def get(self, region = None, lat = None, long = None):
+        """
+        Get a pooled map, loading it if needed. Either give a `region` name
+        (from `regions`) or a point. For a point, any pooled map containing
+        it is used, otherwise a region of `default_dist` around it is loaded.
+
+        Returns:
+        ----------
+        region     : (str) region name / key
+        tmap       : (TrailMap) prepared map. Treat as read-only.
+        """
+
+        if region is None:
+            if (lat is None) or (long is None):
+                raise ValueError("Must provide region or lat / long")
+
+            region = self.find_region(lat, long)
+
+        with self._lock:
+            if region is None:
+                region = "%.5f_%.5f_%.1f"%(lat, long, self.default_dist)
+                if not (region in self.regions):
+                    self.regions[region] = {'center_point' : (lat, long),
+                                            'dist'         : self.default_dist}
+
+            elif not (region in self.regions) and not (region in self._maps):
+                raise KeyError("Unknown region %s"%(region))
+
+            if region in self._maps:
+                self._maps.move_to_end(region)
+                self._counts['hits'] += 1
+                return region, self._maps[region][0]
+
+            load_lock   = self._loading.setdefault(region, threading.Lock())
+            load_kwargs = dict(self.regions[region])
+
+        # one load per region at a time. Others wait for it
+        with load_lock:
+            with self._lock:
+                if region in self._maps:
+                    self._counts['hits'] += 1
+                    return region, self._maps[region][0]
+
+            t0   = time.perf_counter()
+            tmap = self.prepare(self.loader(**load_kwargs))
+            self.add(region, tmap)
+
+            with self._lock:
+                self._counts['loads']     += 1
+                self._counts['load_time'] += time.perf_counter() - t0
+
+        return region, tmap
+
+    def add(self, region, tmap, nbytes = None):
+        """
+        Put an (already prepared) map in the pool, evicting least recently
+        used maps to stay within `max_bytes`.
+        """
+
+        if nbytes is None:
+            nbytes = estimate_bytes(tmap)
+
+        with self._lock:
+            if region in self._maps:
+                self._bytes -= self._maps.pop(region)[1]
+
+            self._maps[region] = (tmap, nbytes)
+            self._bytes       += nbytes
+
+            while (self._bytes > self.max_bytes) and (len(self._maps) > 1):
+                _, (_, old_bytes) = self._maps.popitem(last=False)
+                self._bytes -= old_bytes
+                self._counts['evictions'] += 1
+
+        return
+
+    def find_region(self, lat, long):
+        """
+        Name of a pooled region whose bounding box contains (lat, long), or None.
+        """
+
+        with self._lock:
+            for region, (tmap, _) in reversed(self._maps.items()):
+                ll = getattr(tmap, 'll', None)
+                rr = getattr(tmap, 'rr', None)
+                if (ll is None) or (rr is None):
+                    continue
+                if (ll[0] <= lat <= rr[0]) and (ll[1] <= long <= rr[1]):
+                    return region
+
+        return None
+
+    @staticmethod
+    def prepare(tmap):
+        """
+        One-time work done on every map when loaded so requests don't have to.
+        """
+
+        tmap.ensure_edge_attributes()
+        tmap.scale_edge_attributes()
+
+        if getattr(tmap, '_components', None) is None:
+            tmap.compute_components()
+
+        return tmap
+
+    def status(self):
+
+        with self._lock:
+            result = dict(self._counts)
+            result['regions']   = list(self._maps.keys())
+            result['bytes']     = self._bytes
+            result['max_bytes'] = self.max_bytes
+
+        return result
+
+
+class RoutingService():
+    """
+    Routing on pooled maps, with an optional result cache. Independent of
+    the HTTP layer.
+    """
+
+    def __init__(self, pool = None, cache = None):
+        """
+        Parameters:
+        -----------
+        pool   : (Optional, MapPool) map pool. Default : new MapPool
+        cache  : (Optional, RouteCache) result cache. None to turn off. Default : None
+        """
+
+        self.pool  = MapPool() if pool is None else pool
+        self.cache = cache
+
+        return
+
+    def nearest(self, lat, long, k = 1, region = None):
+        """
+        Nearest `k` nodes to (lat, long).
+        """
+
+        region, tmap = self.pool.get(region = region, lat = lat, long = long)
+        _, node_ids  = tmap.nearest_node(long, lat, k = k)
+
+        return {'region' : region,
+                'nodes'  : [{'node' : int(n),
+                             'lat'  : float(tmap.nodes[n]['lat']),
+                             'long' : float(tmap.nodes[n]['long'])} for n in node_ids]}
+
+    def route(self, lat, long, target_values, region = None, seed = None, **kwargs):
+        """
+        Routes from the node nearest (lat, long) (see `TrailMap.multi_find_route`).
+        kwargs are passed to `multi_find_route`, including `cancel` (a
+        CancellationToken). Results of cancelled searches are not cached.
+        """
+        return self._route('multi_find_route', lat, long, target_values, region, seed, kwargs)
+
+    def route_range(self, lat, long, target_values_range, region = None, seed = None, **kwargs):
+        """
+        Routes over target ranges (see `TrailMap.find_route_constraint_range`).
+        """
+        return self._route('find_route_constraint_range', lat, long, target_values_range,
+                           region, seed, kwargs)
+
+    def requery(self, lat, long, target_values, previous, region = None, seed = None, **kwargs):
+        """
+        Warm-start re-query (see `TrailMap.requery`) from the routes of a
+        previous response of `route` / `route_range` / `requery` (a dict
+        with 'routes', each with 'nodes'). Results depend on `previous`, so
+        are not cached.
+        """
+
+        region, tmap = self.pool.get(region = region, lat = lat, long = long)
+        start_node   = int(tmap.nearest_node(long, lat)[1][0])
+
+        routes = [r['nodes'] for r in previous.get('routes', [])]
+
+        # sub-graph needs to hold the old routes as well as the new ones
+        distance = target_values['distance']
+        for r in previous.get('routes', []):
+            distance = max(distance, r.get('totals', {}).get('distance', 0.0))
+
+        subG   = tmap.filtered_subgraph(start_node, distance).standalone_copy()
+        result = subG.requery(start_node, target_values, (None, routes, None),
+                              subgraph = subG, rng = seed, **kwargs)
+
+        return self._format(region, tmap, start_node, result, cached = False,
+                            cancelled = is_cancelled(kwargs.get('cancel', None)))
+
+    def _route(self, method, lat, long, target_values, region, seed, kwargs):
+
+        region, tmap = self.pool.get(region = region, lat = lat, long = long)
+        start_node   = int(tmap.nearest_node(long, lat)[1][0])
+
+        key = None
+        if not (self.cache is None):
+            key    = self.cache.make_key(tmap, method, start_node, target_values, region = region,
+                                         end_node = kwargs.get('end_node', None), seed = seed,
+                                         params = {k:v for k,v in kwargs.items() if not (k in UNKEYED_ARGUMENTS)})
+            result = self.cache.get(key)
+
+            if not (result is None):
+                result = self.cache.rescore(tmap, result, target_values)
+                return self._format(region, tmap, start_node, result, cached = True)
+
+        result = self.compute(tmap, method, start_node, target_values, seed = seed, **kwargs)
+
+        cancelled = is_cancelled(kwargs.get('cancel', None))
+
+        if not (key is None) and not cancelled:
+            self.cache.put(key, tuple(result[:3]))
+
+        return self._format(region, tmap, start_node, result, cached = False, cancelled = cancelled)
+
+    @staticmethod
+    def compute(tmap, method, start_node, target_values, seed = None, **kwargs):
+        """
+        Run `method` on a private copy of the sub-graph around `start_node`
+        so the pooled map is never modified.
+        """
+
+        distance = target_values['distance']
+        if isinstance(distance, (tuple, list)):
+            distance = np.max(distance)
+
+        subG = tmap.filtered_subgraph(start_node, distance).standalone_copy()
+
+        if method == 'multi_find_route':
+            return subG.multi_find_route(start_node, target_values, subgraph = subG,
+                                         rng = seed, **kwargs)
+        else:
+            return subG.find_route_constraint_range(start_node, target_values,
+                                                    subgraph_filter = False,
+                                                    rng = seed, **kwargs)
+
+    @staticmethod
+    def _format(region, tmap, start_node, result, cached = False, cancelled = False):
+
+        totals, routes, errors = result[:3]
+
+        output = []
+        for t, r, e in zip(totals, routes, errors):
+            if (t is None) or (r is None) or (len(r) <= 1):
+                continue
+
+            output.append({'error'  : float(e),
+                           'totals' : {k : float(v) for k, v in t.items()},
+                           'nodes'  : [int(n) for n in r],
+                           'coords' : tmap.get_route_coords(nodes = r, coords_only = True)})
+
+        return {'region'     : region,
+                'start_node' : start_node,
+                'cached'     : cached,
+                'cancelled'  : cancelled,
+                'routes'     : output}
+
+    def status(self):
+        return {'pool'  : self.pool.status(),
+                'cache' : None if self.cache is None else self.cache.stats()}
+
+
+async def run_until_disconnect(request, coroutine, poll = 0.25):
+    """
+    Await `coroutine`, cancelling it if the client of `request` disconnects.
+    """
+
+    task = asyncio.ensure_future(coroutine)
+
+    while True:
+        done, _ = await asyncio.wait([task], timeout = poll)
+        if task in done:
+            return task.result()
+
+        if await request.is_disconnected():
+            task.cancel()
+            raise HTTPException(status_code = 499, detail = "Client disconnected")
+
+
+def make_app(service = None, router = None):
+    """
+    FastAPI app serving `service` (default: new RoutingService with a RouteCache)
+    through `router` (default: new AsyncRouter on `service`).
+    """
+
+    if service is None:
+        service = RoutingService(cache = RouteCache())
+
+    if router is None:
+        router = AsyncRouter(service)
+
+    app = FastAPI()
+
+    def _targets(distance, elevation_gain):
+        targets = {'distance' : distance}
+        if not (elevation_gain is None):
+            targets['elevation_gain'] = elevation_gain
+        return targets
+
+    async def _call(request, coroutine):
+        try:
+            return await run_until_disconnect(request, coroutine)
+        except KeyError as e:
+            raise HTTPException(status_code = 404, detail = str(e))
+        except ValueError as e:
+            raise HTTPException(status_code = 400, detail = str(e))
+
+    @app.get("/route")
+    async def route(request : Request, lat : float, long : float, distance : float,
+                    elevation_gain : float = None, region : str = None,
+                    n_routes : int = 5, iterations : int = 10, seed : int = None):
+        return await _call(request, router.route(lat, long, _targets(distance, elevation_gain),
+                                                 region = region, seed = seed,
+                                                 n_routes = n_routes, iterations = iterations))
+
+    @app.get("/range")
+    async def route_range(request : Request, lat : float, long : float,
+                          distance_min : float, distance_max : float,
+                          elevation_gain_min : float = None, elevation_gain_max : float = None,
+                          region : str = None, n_routes : int = 5, n_constraints : int = 3,
+                          iterations : int = 10, seed : int = None):
+
+        targets = {'distance' : (distance_min, distance_max)}
+        if not (elevation_gain_min is None or elevation_gain_max is None):
+            targets['elevation_gain'] = (elevation_gain_min, elevation_gain_max)
+
+        return await _call(request, router.route_range(lat, long, targets, region = region, seed = seed,
+                                                       n_routes = n_routes, n_constraints = n_constraints,
+                                                       iterations = iterations))
+
+    @app.post("/requery")
+    async def requery(request : Request, body : dict):
+
+        try:
+            targets = _targets(float(body['distance']), body.get('elevation_gain', None))
+            kwargs  = {'budget'   : float(body.get('budget', 0.5)),
+                       'n_routes' : int(body.get('n_routes', 5))}
+            coro    = router.requery(float(body['lat']), float(body['long']), targets,
+                                     body['previous'], region = body.get('region', None),
+                                     seed = body.get('seed', None), **kwargs)
+        except (KeyError, TypeError, ValueError) as e:
+            raise HTTPException(status_code = 400, detail = "Bad requery request: %s"%(str(e)))
+
+        return await _call(request, coro)
+
+    @app.get("/nearest")
+    async def nearest(request : Request, lat : float, long : float, k : int = 1, region : str = None):
+        return await _call(request, router.nearest(lat, long, k = k, region = region))
+
+    @app.get("/status")
+    def status():
+        result = service.status()
+        result['router'] = router.stats()
+        return result
+
+    app.state.service = service
+    app.state.router  = router
+
+    return app
+
+
+if __name__ == "__main__":
+
+    import uvicorn
+
+    host = sys.argv[1] if len(sys.argv) > 1 else '127.0.0.1'
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+
+    uvicorn.run(make_app(), host = host, port = port)
@@ -0,0 +1,391 @@
+"""
+
+    Author  : Andrew Emerick
+    e-mail  : aemerick11@gmail.com
+    year    : 2020
+
+    LICENSE :GPLv3
+
+    Offline generation of synthetic TrailMap instances for testing and
+    benchmarking without any network calls or elevation data credentials.
+
+    Networks are built as either perturbed grids or random geometric graphs
+    laid out around a center (lat, long) coordinate, with elevations taken
+    from fractal (diamond-square) terrain. Edge properties are computed with
+    the same `track_properties` used when processing OSM data, so synthetic
+    maps carry exactly the same edge attributes as real ones.
+
+    All generators are deterministic given `seed`.
+
+    Example:
+
+        > tmap = synthetic.synthetic_trailmap('grid', n_edges = 10000, seed = 42)
+        > synthetic.save_fixture(tmap, './fixtures/grid_10k.pickle')
+"""
+
+import numpy as np
+import shapely
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+from planit.autotrail.trailmap import TrailMap
+from planit.autotrail import process_gpx_data as gpx_process
+from planit.autotrail.elevation import ElevationProvider
+
+
+# approx m per degree latitude (matches gpxpy)
+_ONE_DEGREE = 1000.0 * 10000.8 / 90.0
+
+
+def fractal_terrain(n = 7, roughness = 0.55, seed = 0):
+    """
+    Generate fractal terrain using the diamond-square algorithm on a
+    (2**n + 1) x (2**n + 1) grid. Values are normalized to [0,1].
+
+    Parameters:
+    -----------
+    n          : (Optional, int) grid has 2**n + 1 points on a side. Default : 7
+    roughness  : (Optional, float) amplitude decay per level (0-1).
+                 Larger is rougher. Default : 0.55
+    seed       : (Optional, int) random seed. Default : 0
+
+    Returns:
+    -----------
+    z          : (2D array) terrain heights
+    """
+
+    rng  = np.random.RandomState(seed)
+    size = 2**n + 1
+    z    = np.zeros((size,size))
+
+    z[0,0], z[0,-1], z[-1,0], z[-1,-1] = rng.uniform(size=4)
+
+    step  = size - 1
+    scale = 1.0
+    while step > 1:
+        half = step // 2
+
+        # diamond step: centers of squares
+        corners = (z[0:-1:step, 0:-1:step] + z[0:-1:step, step::step] +
+                   z[step::step, 0:-1:step] + z[step::step, step::step])
+        z[half:-1:step, half:-1:step] = 0.25*corners + scale*rng.uniform(-1,1,size=corners.shape)
+
+        # square step: edge midpoints (average of available neighbors)
+        for i in range(0, size, half):
+            for j in range((i + half) % step, size, step):
+                total = 0.0
+                num   = 0
+                for di, dj in [(-half,0),(half,0),(0,-half),(0,half)]:
+                    if (0 <= i+di < size) and (0 <= j+dj < size):
+                        total += z[i+di, j+dj]
+                        num   += 1
+                z[i,j] = total / num + scale*rng.uniform(-1,1)
+
+        step  = half
+        scale = scale * roughness
+
+    z = (z - np.min(z)) / (np.max(z) - np.min(z))
+
+    return z
+
+
+class Terrain(ElevationProvider):
+    """
+    Elevation model over a lat / long bounding box from a height grid.
+    Can be used as an elevation provider (see elevation.py).
+    """
+
+    def __init__(self, z, ll, rr, base = 1600.0, relief = 800.0):
+        """
+        Parameters:
+        -----------
+        z      : (2D array) normalized heights. First axis is latitude.
+        ll     : (lat,long) lower left corner
+        rr     : (lat,long) upper right corner
+        base   : (Optional, float) minimum elevation (m). Default : 1600
+        relief : (Optional, float) max - min elevation (m). Default : 800
+        """
+
+        self.z      = base + relief * np.asarray(z)
+        self.ll     = ll
+        self.rr     = rr
+
+        return
+
+    def get_elevations(self, lat, long):
+        """
+        Bilinear interpolation of elevation at the given coordinates (arrays).
+        """
+
+        lat  = np.asarray(lat, dtype=float)
+        long = np.asarray(long, dtype=float)
+
+        ny, nx = np.shape(self.z)
+
+        y = (lat  - self.ll[0]) / (self.rr[0] - self.ll[0]) * (ny - 1)
+        x = (long - self.ll[1]) / (self.rr[1] - self.ll[1]) * (nx - 1)
+        y = np.clip(y, 0, ny - 1.000001)
+        x = np.clip(x, 0, nx - 1.000001)
+
+        i = y.astype(int)
+        j = x.astype(int)
+        fy = y - i
+        fx = x - j
+
+        return (self.z[i,j]*(1-fy)*(1-fx) + self.z[i+1,j]*fy*(1-fx) +
+                self.z[i,j+1]*(1-fy)*fx   + self.z[i+1,j+1]*fy*fx)
+
+    def get_elevation(self, lat, long):
+        return float(self.get_elevations(lat, long))
+
+
+def perturbed_grid(n_x, n_y, spacing = 400.0, jitter = 0.25,
+                   drop_fraction = 0.15, seed = 0):
+    """
+    Nodes on a regular grid (in m) with randomly displaced positions and
+    a fraction of the grid edges removed.
+
+    Parameters:
+    -----------
+    n_x, n_y       : (int) number of nodes along each axis
+    spacing        : (Optional, float) grid spacing (m). Default : 400
+    jitter         : (Optional, float) max node displacement in units of
+                      `spacing`. Default : 0.25
+    drop_fraction  : (Optional, float) fraction of edges to remove. Default : 0.15
+    seed           : (Optional, int) random seed. Default : 0
+
+    Returns:
+    -----------
+    xy             : (N,2) array of node positions (m)
+    pairs          : (E,2) array of node index pairs (i < j)
+    """
+
+    rng = np.random.RandomState(seed)
+
+    ix, iy = np.meshgrid(np.arange(n_x), np.arange(n_y), indexing='ij')
+    ix = ix.ravel()
+    iy = iy.ravel()
+
+    xy = np.column_stack([ix, iy]).astype(float) * spacing
+    xy = xy + rng.uniform(-jitter, jitter, size=np.shape(xy)) * spacing
+
+    index  = ix * n_y + iy
+    right  = np.column_stack([index[ix < n_x-1], index[ix < n_x-1] + n_y])
+    up     = np.column_stack([index[iy < n_y-1], index[iy < n_y-1] + 1])
+    pairs  = np.concatenate([right, up])
+
+    keep   = rng.uniform(size=len(pairs)) >= drop_fraction
+
+    return xy, pairs[keep]
+
+
+def random_geometric(n_nodes, radius = 500.0, density = 4.0e-6, seed = 0):
+    """
+    Random geometric graph. Nodes uniformly placed in a square (in m) and
+    connected if within `radius` of each other. Uses a cell list so this
+    scales to large graphs.
+
+    Parameters:
+    -----------
+    n_nodes   : (int) number of nodes
+    radius    : (Optional, float) connection radius (m). Default : 500
+    density   : (Optional, float) nodes per m^2, sets size of box. Default : 4.0E-6
+    seed      : (Optional, int) random seed. Default : 0
+
+    Returns:
+    -----------
+    xy        : (N,2) array of node positions (m)
+    pairs     : (E,2) array of node index pairs (i < j)
+    """
+
+    rng  = np.random.RandomState(seed)
+    side = np.sqrt(n_nodes / density)
+    xy   = rng.uniform(0.0, side, size=(n_nodes,2))
+
+    cells = {}
+    cx = (xy[:,0] // radius).astype(int)
+    cy = (xy[:,1] // radius).astype(int)
+    for i in range(n_nodes):
+        cells.setdefault((cx[i],cy[i]), []).append(i)
+
+    pairs = []
+    for (a, b), members in cells.items():
+        members   = np.array(members)
+        neighbors = np.concatenate([np.array(cells.get((a+da,b+db), []), dtype=int)
+                                    for da in (-1,0,1) for db in (-1,0,1)])
+
+        d2 = ((xy[members][:,None,:] - xy[neighbors][None,:,:])**2).sum(axis=2)
+        i, j = np.where(d2 < radius**2)
+        i = members[i]
+        j = neighbors[j]
+        select = i < j
+        pairs.append(np.column_stack([i[select], j[select]]))
+
+    pairs = np.concatenate(pairs) if len(pairs) > 0 else np.zeros((0,2),dtype=int)
+
+    return xy, pairs
+
+
+def build_trailmap(xy, pairs, center_point = (40.0, -105.3),
+                   terrain = None, points_per_edge = 3, wiggle = 0.1,
+                   seed = 0, name = 'synthetic'):
+    """
+    Make a TrailMap from node positions and connections. Edges get
+    intermediate track points (displaced by up to `wiggle` of the edge
+    length), elevations from `terrain`, and all edge properties as
+    computed by `gpx_process.track_properties`. As with OSM maps, edges
+    are added in both directions.
+
+    Parameters:
+    -----------
+    xy              : (N,2) array of node positions (m) relative to `center_point`
+    pairs           : (E,2) array of node indexes to connect
+    center_point    : (Optional, tuple) (lat, long) map center. Default : (40.0, -105.3)
+    terrain         : (Optional, Terrain) elevation model. If None, made from
+                      `fractal_terrain` with `seed`. Default : None
+    points_per_edge : (Optional, int) number of intermediate points on each edge. Default : 3
+    wiggle          : (Optional, float) max sideways displacement of intermediate points
+                      as fraction of edge length. Default : 0.1
+    seed            : (Optional, int) random seed. Default : 0
+    name            : (Optional, str) TrailMap name. Default : 'synthetic'
+
+    Returns:
+    -----------
+    tmap            : TrailMap
+    """
+
+    rng = np.random.RandomState(seed)
+
+    xy  = np.asarray(xy, dtype=float)
+    xy  = xy - 0.5*(np.min(xy,axis=0) + np.max(xy,axis=0))
+
+    lat  = center_point[0] + xy[:,1] / _ONE_DEGREE
+    long = center_point[1] + xy[:,0] / (_ONE_DEGREE * np.cos(np.radians(center_point[0])))
+
+    ll = (np.min(lat), np.min(long))
+    rr = (np.max(lat), np.max(long))
+    if terrain is None:
+        terrain = Terrain(fractal_terrain(seed=seed), ll, rr)
+
+    node_elevations = terrain.get_elevations(lat, long)
+
+    # osmid - like node IDs
+    node_ids = np.arange(len(xy)) + 1000
+    nodes    = [(int(n), {'osmid' : int(n), 'index' : int(n),
+                          'x' : long[i], 'y' : lat[i],
+                          'long' : long[i], 'lat' : lat[i],
+                          'elevation' : node_elevations[i]}) for i, n in enumerate(node_ids)]
+
+    # intermediate points for all edges at once
+    pairs = np.asarray(pairs, dtype=int).reshape(-1,2)
+    frac  = np.linspace(0.0, 1.0, points_per_edge + 2)[1:-1]
+
+    tails = np.min(pairs, axis=1) # tail is lower ID by convention
+    heads = np.max(pairs, axis=1)
+
+    dlat   = lat[heads] - lat[tails]
+    dlong  = long[heads] - long[tails]
+    offset = rng.uniform(-wiggle, wiggle, size=(len(pairs), points_per_edge))
+
+    mid_lat  = lat[tails][:,None]  + frac[None,:]*dlat[:,None]  + offset*dlong[:,None]
+    mid_long = long[tails][:,None] + frac[None,:]*dlong[:,None] - offset*dlat[:,None]
+    mid_elev = terrain.get_elevations(mid_lat, mid_long)
+
+    edges = []
+    for k in range(len(pairs)):
+        t, h   = tails[k], heads[k]
+
+        coords = ([(long[t], lat[t], node_elevations[t])] +
+                  [(mid_long[k,i], mid_lat[k,i], mid_elev[k,i]) for i in range(points_per_edge)] +
+                  [(long[h], lat[h], node_elevations[h])])
+
+        d = gpx_process.track_properties(coords)
+        d['highway'] = 'path'
+
+        u, v = int(node_ids[t]), int(node_ids[h])
+        edges.append( (u, v, d) )
+        edges.append( (v, u, dict(d)) )
+
+    tmap = TrailMap(name = name)
+    tmap.graph['crs'] = 'epsg:4326'
+    tmap.add_nodes_from(nodes)
+    tmap.add_edges_from(edges)
+    tmap.ensure_edge_attributes()
+    tmap.compute_components()
+
+    tmap.center_point = center_point
+    tmap.ll           = ll
+    tmap.rr           = rr
+    tmap.query        = None
+    tmap.dist         = None
+
+    return tmap
+
+
+def synthetic_trailmap(kind = 'grid', n_edges = 1000, seed = 0,
+                       center_point = (40.0, -105.3),
+                       build_hierarchy = False, **kwargs):
+    """
+    Generate a synthetic TrailMap with roughly `n_edges` (undirected) trail
+    segments. TrailMap edge count is twice this since edges are
+    bi-directional.
+
+    Parameters:
+    -----------
+    kind             : (Optional, str) 'grid' (perturbed grid) or 'geometric'
+                       (random geometric graph). Default : 'grid'
+    n_edges          : (Optional, int) approximate number of trail segments. Default : 1000
+    seed             : (Optional, int) random seed. Default : 0
+    center_point     : (Optional, tuple) (lat,long) of map center. Default : (40.0, -105.3)
+    build_hierarchy  : (Optional, bool) build contraction hierarchy. Default : False
+
+    kwargs are passed to `build_trailmap`.
+
+    Returns:
+    -----------
+    tmap             : TrailMap
+    """
+
+    if kind == 'grid':
+        # ~ 2 n^2 (1-drop) edges for n x n grid
+        n       = int(np.ceil(np.sqrt(n_edges / (2.0*0.85)))) + 1
+        xy, pairs = perturbed_grid(n, n, seed=seed)
+
+    elif kind == 'geometric':
+        # mean degree ~ pi r^2 density ~ 3.1 -> ~1.6 edges per node
+        xy, pairs = random_geometric(int(np.ceil(n_edges / 1.57)), seed=seed)
+
+    else:
+        print("Unknown synthetic map kind: ", kind)
+        raise ValueError
+
+    tmap = build_trailmap(xy, pairs, center_point=center_point, seed=seed,
+                          name = '%s_%i_%i'%(kind, n_edges, seed), **kwargs)
+
+    if build_hierarchy:
+        tmap.build_contraction_hierarchy()
+
+    return tmap
+
+
+def save_fixture(tmap, outname):
+    """
+    Pickle a (synthetic) TrailMap to use as a fixture.
+    """
+
+    with open(outname, 'wb') as outfile:
+        pickle.dump(tmap, outfile, protocol = 4)
+
+    return
+
+
+def load_fixture(inname):
+    """
+    Load fixture saved with `save_fixture`.
+    """
+
+    with open(inname, 'rb') as infile:
+        return pickle.load(infile)
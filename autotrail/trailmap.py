@@ -20,17 +20,24 @@ import numpy as np
 import copy
 import networkx as nx
 
-import random
 import shapely
 import gpxpy
 
 import json
+import os
+import time
+import uuid
+import hashlib
+import contextvars
+import concurrent.futures
 
 # FIX THIS
 from planit.autotrail import process_gpx_data as gpx_process
 #import autotrail.autotrail.process_gpx_data as gpx_process
-
-random.seed(12345)
+from planit.autotrail.contraction import ContractionHierarchy
+from planit.autotrail.sampling import LoopSampler
+from planit.autotrail.profiling import ProfileStats, NULL_TIMER
+from planit.autotrail.cancellation import is_cancelled
 
 
 m_to_ft = 3.28084
@@ -40,6 +47,11 @@ m_to_mi = 0.000621371
 # assuming ALL edges are bi-diretional and there is only one path node-to-node
 _IDIR = 0
 
+# ProfileStats of the request running in this thread / task (see
+# `TrailMap._start_stats`). Kept out of the map so concurrent requests on
+# a shared map never mix (or leak) stats.
+_request_stats = contextvars.ContextVar('_request_stats', default = None)
+
 class TrailMap(nx.MultiDiGraph):
     """
     TrailMap class to handle trail Graphs and a
@@ -83,8 +95,31 @@ class TrailMap(nx.MultiDiGraph):
         self._scalings = None
         self._scale_var = None
 
+        # edge weights (without traversal penalties) cached per weighting
+        # (see `_edge_weight_cache`)
+        self._weight_caches     = {}
+        self._max_weight_caches = 32
+
         self._weight_precision = 6
         self._dynamic_weighting = True
+        self._direction_sampling = True # pick next nodes by bearing (see LoopSampler)
+
+        # opt-in instrumentation (see `enable_profiling`)
+        self._profiling = False
+        self._profile_callback = None
+
+        # contraction hierarchy on static distance metric. Built offline
+        # with `build_contraction_hierarchy`
+        self._ch = None
+
+        # connected component labels (and optional landmark distances)
+        # computed once with `compute_components`
+        self._components = None
+        self._landmarks  = None
+        self._components_exact = True
+
+        # identifies this build of the map (see `map_version`)
+        self._map_version = uuid.uuid4().hex
 
         self._assign_default_weights()
 
@@ -95,6 +130,9 @@ class TrailMap(nx.MultiDiGraph):
                                           n_routes = 5,
                                           n_constraints = 3,
                                           route_factor = 1,
+                                          n_cpus = 1,
+                                          return_stats = False,
+                                          rng = None,
                                           **kwargs):
         """
         Uses multiple calls to multi_find_route to choose better routes
@@ -104,6 +142,21 @@ class TrailMap(nx.MultiDiGraph):
         Otherwise samples the range over `n_constraints` times to create
         a larger variety of posible routes.
 
+        The sub-graph filter is computed once (for the widest constraint) and
+        shared by all sub-constraints. Each sub-constraint routes on its own
+        fresh copy of the sub-graph, so they do not see each other's
+        `traversed_count` / `in_another_route` marks (and the map itself is
+        not modified). If `n_cpus` > 1, sub-constraints are computed
+        concurrently in separate processes.
+
+        Each sub-constraint gets its own child random stream spawned from
+        `rng`, so results are reproducible for a given seed, whatever
+        `n_cpus` is.
+
+        A `cancel` token (see cancellation.py) in kwargs is passed on to
+        `multi_find_route`. Worker processes only see its deadline, not an
+        explicit `cancel()`.
+
         Additional kwargs are passed to `multi_find_route`.
 
         Parameters:
@@ -119,56 +172,189 @@ class TrailMap(nx.MultiDiGraph):
         route_factor : Optional, int. Extra factor of route to compute per constraint.
                        Number of routes computed in total is
                        `n_routes*n_constraints*route_factor`. Default : 1
+        n_cpus       : Optional, int. Number of processes to compute sub-constraints
+                       with. Default : 1
+        return_stats : Optional, bool. Also return the ProfileStats for this
+                       request (None if profiling is off). Default : False
+        rng          : Optional, int, SeedSequence, or numpy Generator. Seed / random
+                       state for this request. If None, uses fresh entropy. Default : None
 
         Returns:
         ----------
         all_totals  :  List of dictionaries of total quantities for each route
         all_routes  :  List of routes, defined as an ordered list of connected nodes
         all_errors  :  The scores for each route.
+        stats       :  (if `return_stats`) ProfileStats for this request
         """
 
-        if (target_values_range['distance'][1] - target_values_range['distance'][0]) <\
-           0.10*target_values_range['distance'][1]:
-           n_constraints = 1
+        stats = self._start_stats()
+        try:
+            if (target_values_range['distance'][1] - target_values_range['distance'][0]) <\
+               0.10*target_values_range['distance'][1]:
+               n_constraints = 1
+
+            target_values_array = [None] * n_constraints
+            if n_constraints > 1:
+                factor = (0.8) / (n_constraints - 1.0)
+                ini_factor = 0.1
+            else:
+                factor     = 0.0 # doesn't matter here
+                ini_factor = 0.5 # just hit halfway
 
-        target_values_array = [None] * n_constraints
-        if n_constraints > 1:
-            factor = (0.8) / (n_constraints - 1.0)
-            ini_factor = 0.1
-        else:
-            factor     = 0.0 # doesn't matter here
-            ini_factor = 0.5 # just hit halfway
+            for i in range(n_constraints):
+                target_values_array[i] = copy.deepcopy(target_values_range)
 
-        for i in range(n_constraints):
-            target_values_array[i] = copy.deepcopy(target_values_range)
+                diff = target_values_range['distance'][1] - target_values_range['distance'][0]
+                target_values_array[i]['distance'] = target_values_range['distance'][0] + (ini_factor+factor*i)*diff
 
-            diff = target_values_range['distance'][1] - target_values_range['distance'][0]
-            target_values_array[i]['distance'] = target_values_range['distance'][0] + (ini_factor+factor*i)*diff
+                if 'elevation_gain' in target_values_range:
+                    diff = target_values_range['elevation_gain'][1] - target_values_range['elevation_gain'][0]
+                    target_values_array[i]['elevation_gain'] = target_values_range['elevation_gain'][0] + (ini_factor+factor*i)*diff
 
-            if 'elevation_gain' in target_values_range:
-                diff = target_values_range['elevation_gain'][1] - target_values_range['elevation_gain'][0]
-                target_values_array[i]['elevation_gain'] = target_values_range['elevation_gain'][0] + (ini_factor+factor*i)*diff
+            #
+            # one sub-graph for all constraints using the widest cutoff
+            #
+            if kwargs.pop('subgraph_filter', True) and len(self.nodes) > 50:
+                with self._timer('subgraph_filter'):
+                    subG = self.filtered_subgraph(start_node,
+                                                  np.max([x['distance'] for x in target_values_array]))
+            else:
+                subG = self
 
-        #
-        # Run the route finder three times!
-        #
-        totals = []
-        possible_routes= []
-        error = []
-        for i in range(n_constraints):
-            temp_totals, temp_pr, temp_error = self.multi_find_route(start_node,
-                                                                     target_values_array[i],
-                                                                     n_routes=n_routes*route_factor,
-                                                                     **kwargs)
+            # independent random streams for each sub-constraint
+            child_seeds = _spawn_seeds(rng, n_constraints)
+
+            #
+            # Run the route finder three times!
+            #
+            totals = []
+            possible_routes= []
+            error = []
+
+            if (n_cpus > 1) and (n_constraints > 1):
+                # processes get a copy of the sub-graph to copy again for each
+                # sub-constraint. The contraction hierarchy is only sent along
+                # if this is the full map (the only place it is used)
+                tmap_copy = subG.standalone_copy(keep_hierarchy = not (subG._hierarchy() is None))
+
+                with concurrent.futures.ProcessPoolExecutor(max_workers=min(n_cpus, n_constraints),
+                                                            initializer=_init_route_worker,
+                                                            initargs=(tmap_copy,)) as executor:
+
+                    futures = [executor.submit(_route_worker, start_node, target_values_array[i],
+                                               n_routes*route_factor, child_seeds[i], kwargs) for i in range(n_constraints)]
+
+                    results = []
+                    for f in futures: # keeps constraint order
+                        result, worker_stats = f.result()
+                        results.append(result)
+                        if not (stats is None or worker_stats is None):
+                            stats.merge(worker_stats)
+
+            else:
+                results = []
+                for i in range(n_constraints):
+                    tmap_copy = subG.standalone_copy()
+                    results.append(self.multi_find_route(start_node, target_values_array[i],
+                                                         n_routes=n_routes*route_factor,
+                                                         subgraph=tmap_copy,
+                                                         rng=child_seeds[i],
+                                                         **kwargs))
+
+            for temp_totals, temp_pr, temp_error in results:
+                totals.extend(temp_totals)
+                possible_routes.extend(temp_pr)
+                error.extend(temp_error)
+
+            sorted_index = np.argsort(error)
+
+            result = [totals[x] for x in sorted_index[:n_routes]], [possible_routes[x] for x in sorted_index[:n_routes]], [error[x] for x in sorted_index[:n_routes]]
+        finally:
+            self._finish_stats(stats)
+
+        if return_stats:
+            return result + (stats,)
+        return result
+
+    def filtered_subgraph(self, start_node, target_distance, factor = 0.85):
+        """
+        Pre-filter graph by generating a sub-graph view of all nodes within
+        `factor*target_distance` of `start_node` to speed up computation.
 
-            totals.extend(temp_totals)
-            possible_routes.extend(temp_pr)
-            error.extend(temp_error)
+        CAREFUL HERE. this subgraph is a view with mutable node / edge
+        properties that will be reflected in the parent graph
+        """
+
+        filt_dict, filt_paths =  nx.single_source_dijkstra(self, start_node,
+                                                    weight='distance',
+                                                    cutoff=target_distance*factor)
+        filtered_nodes = list(filt_paths.keys())
+        subG = self.subgraph(filtered_nodes)
+
+        self._print("SubGraph Filter reduced nodes from %i to %i"%(len(self.nodes),len(subG.nodes)), type(subG), type(self))
+
+        self._neg_weight = False
+        self._inherit_settings(subG)
+
+        return subG
+
+    def standalone_copy(self, keep_hierarchy = True):
+        """
+        Copy of this map (or sub-graph view) that does not share node / edge
+        data with the parent and carries over routing settings and edge
+        scalings. Used to route without modifying the parent or to hand off
+        to other processes.
+
+        Parameters:
+        -----------
+        keep_hierarchy : (Optional, bool) share the (read-only) contraction
+                         hierarchy of the parent (only used if this is a copy
+                         of the full map, see `_hierarchy`). Turn off when pickling the
+                         copy for other processes, since the hierarchy covers
+                         the full map. Default : True
+        """
+
+        tmap = self.copy()
+        self._inherit_settings(tmap)
+        if not keep_hierarchy:
+            tmap._ch  = None
 
-        sorted_index = np.argsort(error)
+        return tmap
 
-        return [totals[x] for x in sorted_index[:n_routes]], [possible_routes[x] for x in sorted_index[:n_routes]], error[:n_routes]
+    def _inherit_settings(self, other):
+        """
+        Carry routing settings over to a sub-graph or copy of this map. The
+        contraction hierarchy is shared (it is only read when routing), and
+        the edge scalings are copied so the other map re-uses them rather
+        than re-scaling (sharing the cached edge weights). Component labels and landmark distances are shared
+        as well. On part of the map these are only a necessary condition
+        for connectivity (and still a valid distance lower bound), so
+        they are flagged as not exact (see `is_route_feasible`).
+        """
+
+        for k in ['backtrack', '_ch', '_direction_sampling', '_dynamic_weighting',
+                  '_weight_precision', '_default_weight_factors',
+                  '_profiling', '_map_version']:
+            if hasattr(self, k):
+                setattr(other, k, getattr(self, k))
+
+        if not (getattr(self, '_scalings', None) is None):
+            other._scalings = {k : dict(v) for k,v in self._scalings.items()}
 
+        # same scalings, so the same cached weights (shared, not copied)
+        if getattr(self, '_weight_caches', None) is None:
+            self._weight_caches = {}
+        other._weight_caches = self._weight_caches
+
+        if not (getattr(self, '_components', None) is None):
+            other._components = self._components
+            other._landmarks  = getattr(self, '_landmarks', None)
+            other._components_exact = (getattr(self, '_components_exact', True) and
+                                       (len(other) == len(self._components)))
+
+        other._neg_weight = False
+
+        return
 
     def multi_find_route(self, start_node, target_values,
                                end_node=None,
@@ -179,12 +365,27 @@ class TrailMap(nx.MultiDiGraph):
                                reinitialize = True,                # reset 'traversed' counter each iteration
                                subgraph_filter=True,
                                reset_used_counter = False,  # reset used (binary flag) each iteration
-                               n_cpus=1):
+                               n_cpus=1,
+                               adaptive=False,
+                               patience=5,
+                               tolerance=0.01,
+                               target_error=None,
+                               subgraph=None,
+                               return_stats=False,
+                               rng=None,
+                               cancel=None):
         """
         Loops over algorithm multiple times to find multiple routes.
         Scores the results of these routes and returns the top
         `n_routes` (set to None, or inf to return all).
 
+        In `adaptive` mode, `iterations` is the maximum number of iterations
+        and the loop stops early once the average error of the best `n_routes`
+        routes has not improved by more than `tolerance` in `patience`
+        consecutive iterations, or once all of the best `n_routes` are
+        within `target_error`. The number of iterations used is logged and
+        counted as `iterations_used` in the request stats (see `return_stats`).
+
         Parameters:
         ------------
 
@@ -194,7 +395,7 @@ class TrailMap(nx.MultiDiGraph):
                           `start_node`. Default : None
         n_routes        : (Optional, int) Number of routes to return. Default : 5
         iterations      : (Optional, int) Number of iterations. If iterations <= n_routes,
-                           sets to 2*n_routes. Default : 10
+                           sets to 2*n_routes (unless `adaptive`). Default : 10
         target_methods  : (Optional, dict) Dictionary of what functions to use to
                            evaluate targets (e.g. np.sum for `distance`) along route.
                            Uses default methods if not provided. Default : None
@@ -205,6 +406,25 @@ class TrailMap(nx.MultiDiGraph):
                              Default : True
         n_cpus          : (Optional, int) NOT YET IMPLEMENTED. Wishful thinking to parallelize
                           this with multiple threads / cpus. Does noting. Default : 1
+        adaptive        : (Optional, bool) Stop early on convergence (see above). Default : False
+        patience        : (Optional, int) Number of consecutive iterations without improvement
+                          before stopping in `adaptive` mode. Default : 5
+        tolerance       : (Optional, float) Minimum decrease in the best-`n_routes` average
+                          fractional error to count as an improvement. Default : 0.01
+        target_error    : (Optional, float) In `adaptive` mode, stop once all of the best
+                          `n_routes` have fractional error below this (e.g. 0.05). Default : None
+        subgraph        : (Optional, TrailMap) Already filtered sub-graph (e.g. from
+                          `filtered_subgraph`) to use instead of filtering. Default : None
+        return_stats    : (Optional, bool) Also return the ProfileStats for this
+                          request (None if profiling is off, see `enable_profiling`).
+                          Default : False
+        rng             : (Optional, int, SeedSequence, or numpy Generator) Seed / random
+                          state used for all iterations. The same seed gives the
+                          same routes. If None, uses fresh entropy. Default : None
+        cancel          : (Optional, CancellationToken) checked before each iteration
+                          (and passed to `find_route`). If cancelled, returns the
+                          routes completed so far (possibly none). Check
+                          `cancel.cancelled` to see if this happened. Default : None
 
 
         Returns:
@@ -212,77 +432,324 @@ class TrailMap(nx.MultiDiGraph):
         all_totals  :  List of dictionaries of total quantities for each route
         all_routes  :  List of routes, defined as an ordered list of connected nodes
         all_errors  :  The scores for each route.
+        stats       :  (if `return_stats`) ProfileStats for this request
         """
 
-        if iterations < n_routes:
-            iterations = n_routes*2
+        stats = self._start_stats()
+        try:
+            rng   = np.random.default_rng(rng)
 
+            if adaptive:
+                iterations = max(iterations, n_routes)
+            elif iterations < n_routes:
+                iterations = n_routes*2
 
-        all_totals = [None] * iterations
-        all_routes = [None] * iterations
 
+            all_totals = []
+            all_routes = []
+            all_errors = []
 
-        if subgraph_filter and len(self.nodes) > 50:
-            # pre-filter graph by generating a sub-graph to speed up computation
 
-            # CAREFUL HERE. this subgraph is a view with mutable node / edge
-            # properties that will be reflected in the parent graph
-            filt_dict, filt_paths =  nx.single_source_dijkstra(self, start_node,
-                                                        weight='distance',
-                                                        cutoff=target_values['distance']*0.85)
-            filtered_nodes = list(filt_paths.keys())
-            subG = self.subgraph(filtered_nodes)
+            if not (subgraph is None):
+                subG = subgraph
+            elif subgraph_filter and len(self.nodes) > 50:
+                with self._timer('subgraph_filter'):
+                    subG = self.filtered_subgraph(start_node, target_values['distance'])
+            else:
+                subG = self # placeholder to do prefiltering later !!!
+    
+            # grade limits and node bearings are static over all iterations
+            blocked_edges = subG.grade_blocked_edges(target_values)
+            sampler       = subG.candidate_sampler(start_node, end_node)
+
+            home_node   = start_node if end_node is None else end_node
+
+            best_error  = np.inf
+            no_improve  = 0
+            for niter in range(iterations):
+                if is_cancelled(cancel):
+                    break
 
-            self._print("SubGraph Filter reduced nodes from %i to %i"%(len(self.nodes),len(subG.nodes)), type(subG), type(self))
+                with self._timer('find_route'):
+                    totals, routes = subG.find_route(start_node, target_values,
+                                                     target_methods=target_methods,
+                                                     end_node=end_node,
+                                                     primary_weight=primary_weight,
+                                                     reinitialize=reinitialize,
+                                                     blocked_edges=blocked_edges,
+                                                     sampler=sampler,
+                                                     rng=rng,
+                                                     cancel=cancel)
+                self._count('iterations')
+
+                if is_cancelled(cancel) and (routes is None or routes[-1] != home_node):
+                    # cut short part way through. Not a usable route
+                    break
 
-            subG._neg_weight = False
-            self._neg_weight = False
+                all_totals.append(totals)
+                all_routes.append(routes)
+                all_errors.append(self._route_error(totals, target_values))
 
-            if hasattr(self, 'backtrack'):  # hacking this for now
-                subG.backtrack = self.backtrack
+                if adaptive and (len(all_errors) >= n_routes):
+                    best = np.sort(all_errors)[:n_routes]
+
+                    if (best_error - np.average(best)) > tolerance:
+                        no_improve = 0
+                    else:
+                        no_improve += 1
+                    best_error = min(best_error, np.average(best))
+
+                    if (not (target_error is None)) and np.all(best <= target_error):
+                        self._dprint("Best routes all within target error")
+                        break
+                    elif no_improve >= patience:
+                        self._dprint("Best routes stopped improving")
+                        break
+
+            self._count('iterations_used', len(all_routes))
+            if is_cancelled(cancel):
+                self._count('cancelled')
+                self._print("multi_find_route cancelled after %i of %i iterations"%(len(all_routes),iterations))
+            elif adaptive:
+                self._print("multi_find_route used %i of %i iterations"%(len(all_routes),iterations))
+
+            #
+            # for now, return the best 3
+            #
+            all_errors   = np.array(all_errors)
+            sorted_index = np.argsort(all_errors)
+
+            result = [all_totals[x] for x in sorted_index[:n_routes]], [all_routes[x] for x in sorted_index[:n_routes]], all_errors[sorted_index[:n_routes]]
+        finally:
+            self._finish_stats(stats)
+
+        if return_stats:
+            return result + (stats,)
+        return result
+
+    def requery(self, start_node, target_values, previous,
+                      end_node = None,
+                      n_routes = 5,
+                      budget = 0.5,
+                      max_mutations = 100,
+                      target_methods = None,
+                      rng = None,
+                      cancel = None,
+                      return_stats = False,
+                      **kwargs):
+        """
+        Warm-start re-query for small changes to the targets (e.g. UI sliders).
+        Routes from a previous result are still valid routes, so they are
+        re-scored against the new targets right away. The rest of the time
+        `budget` is spent mutating the best of them rather than starting over:
+        routes that are too long get a section replaced by a shortcut (trim),
+        routes that are too short get an out-and-back spur. Mutations only read
+        the map, so this is safe to run on a shared map.
+
+        If there are no usable previous routes, falls back to `multi_find_route`
+        (with kwargs). Since that modifies edge properties as it goes, it is run
+        on a copy of the filtered sub-graph (or of `subgraph` if given in
+        kwargs), so the map is not modified either way.
+
+        Parameters:
+        -----------
+        start_node     : (int) start node
+        target_values  : (dict) new target values
+        previous       : (tuple) previous (totals, routes, errors) from
+                         `multi_find_route`, `find_route_constraint_range`, or `requery`.
+                         Only the routes are used.
+        end_node       : (Optional, int) end node. Default : start_node
+        n_routes       : (Optional, int) number of routes to return. Default : 5
+        budget         : (Optional, float) time (s) to spend mutating. Default : 0.5
+        max_mutations  : (Optional, int) maximum number of mutations to try. Default : 100
+        target_methods : (Optional, dict) see `find_route`. Default : None
+        rng            : (Optional, int, SeedSequence, or numpy Generator) random state.
+                         Default : None
+        cancel         : (Optional, CancellationToken) stops mutating if cancelled. Default : None
+        return_stats   : (Optional, bool) also return the ProfileStats. Default : False
+
+        Returns:
+        ----------
+        totals         : List of dictionaries of total quantities for each route
+        routes         : List of routes (ordered lists of nodes)
+        errors         : The scores for each route
+        stats          : (if `return_stats`) ProfileStats for this request
+        """
+
+        stats = self._start_stats()
+        try:
+            rng   = np.random.default_rng(rng)
+            start = time.perf_counter()
+
+            if end_node is None:
+                end_node = start_node
+
+            methods = self._default_target_methods()
+            if not (target_methods is None):
+                methods.update(target_methods)
+            methods = {k : methods[k] for k in target_values}
+
+            #
+            # re-score what we have
+            #
+            with self._timer('rescore'):
+                candidates = {}
+                for route in previous[1]:
+                    if (route is None) or (len(route) <= 2) or (route[0] != start_node) or (route[-1] != end_node):
+                        continue
+                    if not all(self.has_edge(u,v) for (u,v) in self.edges_from_nodes(route)):
+                        continue # not on this map (or sub-graph)
+                    route  = list(route)
+                    totals = self._route_totals(route, methods)
+                    candidates[tuple(route)] = (totals, route, self._route_error(totals, target_values))
+
+            if len(candidates) == 0:
+                self._print("requery: no usable previous routes. Starting over")
+
+                subG = kwargs.pop('subgraph', None)
+                if subG is None:
+                    if kwargs.pop('subgraph_filter', True) and len(self.nodes) > 50:
+                        with self._timer('subgraph_filter'):
+                            subG = self.filtered_subgraph(start_node, target_values['distance'])
+                    else:
+                        subG = self
+
+                result = self.multi_find_route(start_node, target_values, end_node = end_node,
+                                               n_routes = n_routes, target_methods = target_methods,
+                                               subgraph = subG.standalone_copy(),
+                                               rng = rng, cancel = cancel, **kwargs)
+
+                if return_stats:
+                    return result + (stats,)
+                return result
+
+            search_weight = self.masked_weight('distance', self.grade_blocked_edges(target_values))
+
+            #
+            # then improve on the best ones while there is time
+            #
+            mutations = 0
+            while (mutations < max_mutations) and (time.perf_counter() - start < budget) and\
+                  not is_cancelled(cancel):
+
+                best   = sorted(candidates.values(), key = lambda x : x[2])[:n_routes]
+                totals, route, _ = best[rng.integers(len(best))]
+
+                with self._timer('mutate'):
+                    new_route = self._mutate_route(route, totals, target_values, search_weight, rng)
+                mutations += 1
+                self._count('mutations')
+
+                if (new_route is None) or (len(new_route) <= 2) or (tuple(new_route) in candidates):
+                    continue
+
+                new_totals = self._route_totals(new_route, methods)
+                candidates[tuple(new_route)] = (new_totals, new_route,
+                                                self._route_error(new_totals, target_values))
+
+            self._dprint("requery: %i mutations in %.3f s"%(mutations, time.perf_counter() - start))
+
+            best   = sorted(candidates.values(), key = lambda x : x[2])[:n_routes]
+            result = [x[0] for x in best], [x[1] for x in best], np.array([x[2] for x in best])
+        finally:
+            self._finish_stats(stats)
+
+        if return_stats:
+            return result + (stats,)
+        return result
+
+    def _route_totals(self, route, methods):
+        """
+        Totals for each target along a route (list of nodes).
+        """
+
+        edges = self.edges_from_nodes(route)
+
+        return {k : self.reduce_edge_data(k, edges = edges, function = f) for k, f in methods.items()}
+
+    def _mutate_route(self, route, totals, target_values, weight, rng,
+                            shift = 0.25, min_change = 0.05):
+        """
+        Trim (if too long) or add a spur to (if too short) a route to move
+        its distance toward the target distance. If the distance is already
+        close, randomly does either by `min_change` of the target distance
+        to explore other routes with the same distance. Returns the new route
+        or None if no mutation was found.
+        """
+
+        if len(route) < 3:
+            return None
+
+        target  = target_values['distance']
+        deficit = target - totals['distance']
+
+        if np.abs(deficit) < min_change * target:
+            deficit = min_change * target * (1.0 if rng.random() < 0.5 else -1.0)
+
+        if deficit > 0:
+            #
+            # spur: out-and-back from a node on the route
+            #
+            i    = int(rng.integers(len(route) - 1))
+            half = 0.5 * deficit
+
+            lengths, paths = nx.single_source_dijkstra(self, route[i], weight = weight,
+                                                       cutoff = (1.0 + shift) * half)
+
+            possible = [k for k, v in lengths.items() if v >= (1.0 - shift) * half]
+            if len(possible) == 0:
+                return None
+
+            path = paths[possible[rng.integers(len(possible))]]
+
+            return route[:i+1] + path[1:] + path[::-1][1:] + route[i+1:]
 
         else:
-            subG = self # placeholder to do prefiltering later !!!
+            #
+            # trim: replace a section of the route with a shorter path
+            #
+            along = np.cumsum(np.concatenate([[0.0], self.reduce_edge_data('distance',
+                                              edges = self.edges_from_nodes(route), function = None)]))
 
+            i = int(rng.integers(len(route) - 2))
 
-        for niter in range(iterations):
-            totals, routes = subG.find_route(start_node, target_values,
-                                             target_methods=target_methods,
-                                             end_node=end_node,
-                                             primary_weight=primary_weight,
-                                             reinitialize=reinitialize)
+            lengths, paths = nx.single_source_dijkstra(self, route[i], weight = weight,
+                                                       cutoff = along[-1] - along[i])
 
+            # how much is saved by cutting from i to each later point on the route
+            # (cutting from the start all the way to the end would leave nothing)
+            last    = len(route) - 1 if i == 0 else len(route)
+            later   = [j for j in range(i + 2, last) if route[j] in lengths]
+            if len(later) == 0:
+                return None
 
-            all_totals[niter], all_routes[niter] = totals, routes
+            savings = np.array([(along[j] - along[i]) - lengths[route[j]] for j in later])
+            j       = later[int(np.argmin(np.abs(savings - (-1.0 * deficit))))]
 
+            if savings[later.index(j)] <= 0:
+                return None
 
-        # score, sort, and return  - do all for now
-        # for now, score on min fractional error
-        num_routes = len(all_routes)
-        fractional_error = {}
-        for k in all_totals[0].keys():
+            return route[:i] + paths[route[j]] + route[j+1:]
 
-            # treat these as limits / ranges not targets to hit for now
-            if k in ['average_grade','average_max_grade','average_min_grade','max_grade','min_grade']:
-                continue
+    def _route_error(self, totals, target_values):
+        """
+        Score route on average fractional error over targets. Grade
+        targets are treated as limits / ranges and are not scored. Routes
+        that failed (None) get infinite error.
+        """
 
-            vals                = np.array([all_totals[i][k] for i in range(num_routes)])
-            fractional_error[k] = np.abs(vals - target_values[k]) / target_values[k]
+        if totals is None:
+            return np.inf
 
-        # now slice it the other way
-        #    better to do average error or max error?
-        average_error = np.zeros(num_routes)
-        total_error = np.zeros(num_routes)
-        for i in range(num_routes):
-            average_error[i] = np.average([ fractional_error[k][i] for k in fractional_error.keys()])
-            total_error[i] = np.sum([ fractional_error[k][i] for k in fractional_error.keys()])
+        # treat these as limits / ranges not targets to hit for now
+        keys = [k for k in totals.keys() if not (k in ['average_grade','average_max_grade','average_min_grade',
+                                                         'max_grade','min_grade'])]
 
-        #
-        # for now, return the best 3
-        #
-        sorted_index = np.argsort(total_error)
+        if len(keys) == 0:
+            return 0.0
 
-        return [all_totals[x] for x in sorted_index[:n_routes]], [all_routes[x] for x in sorted_index[:n_routes]], average_error[:n_routes]
+        #    better to do average error or max error?
+        return np.average([ np.abs(totals[k] - target_values[k]) / target_values[k] for k in keys])
 
     def find_route(self, start_node,
                          target_values,
@@ -291,7 +758,11 @@ class TrailMap(nx.MultiDiGraph):
                          primary_weight = 'distance',
                          reinitialize=True,
                          reset_used_counter = False,
-                         epsilon=0.25):
+                         epsilon=0.25,
+                         blocked_edges=None,
+                         sampler=None,
+                         rng=None,
+                         cancel=None):
         """
         The core piece of Plan-It
 
@@ -333,18 +804,28 @@ class TrailMap(nx.MultiDiGraph):
         epsilon  : (Optional, flot) Parameter for the `get_intermediate_node` algorithm
                    to adjust search method.
 
+        blocked_edges : (Optional, set) Directed edges (u,v,key) to exclude from the
+                        search. If None, computed from the grade limits in
+                        `target_values` (see `grade_blocked_edges`). Default : None
+
+        sampler       : (Optional, LoopSampler) Sampler used to pick the next node.
+                        If None, made with `candidate_sampler`. Default : None
+
+        rng           : (Optional, int, SeedSequence, or numpy Generator) Seed / random
+                        state for all random choices in this route. If None, uses
+                        fresh entropy. Default : None
+
+        cancel        : (Optional, CancellationToken) checked every hop. If cancelled,
+                        returns the (partial) route found so far, which will not
+                        end at `end_node`. Default : None
+
         Returns:
         --------------
 
         totals         : Dictionary of route properties
         possible_route : Ordered list of node IDs route travels along
         """
-        default_target_methods  = {'distance' : np.sum,
-                                   'average_max_grade'      : np.max,
-                                   'average_min_grade' : np.min,
-                                   'average_grade'  : self._max_abs,
-                                   'elevation_gain' : np.sum, 'elevation_loss' : np.sum,
-                                   'traversed_count' : np.sum}
+        default_target_methods  = self._default_target_methods()
 
 
 
@@ -360,17 +841,32 @@ class TrailMap(nx.MultiDiGraph):
         for k in target_values.keys():
             totals_methods[k] = target_methods[k] if k in target_methods.keys() else default_target_methods[k]
 
+        if end_node is None:
+            end_node = start_node
+
         #
         # do some initial error checking to make sure that things CAN work
         #
-        if start_node != end_node:
-            if not (self.is_route_feasible(start_node, end_node, target_values, totals_methods)):
-                self._print("Route not feasible. Please try different input")
-                return None, None
+        if not (self.is_route_feasible(start_node, end_node, target_values, totals_methods)):
+            self._print("Route not feasible. Please try different input")
+            return None, None
 
-        self.scale_edge_attributes()          # needed to do weighting properly
+        with self._timer('scale_edge_attributes'):
+            self.scale_edge_attributes()          # needed to do weighting properly
         self._assign_weights(target_values)   # assigns factors to easily do weighting based on desired constraints
 
+        # grade limits become a mask on the edges used in the searches below
+        if blocked_edges is None:
+            blocked_edges = self.grade_blocked_edges(target_values)
+        path_weight = self.masked_weight('weight', blocked_edges)
+
+        rng = np.random.default_rng(rng)
+
+        if sampler is None:
+            sampler = self.candidate_sampler(start_node, end_node)
+        if not (sampler is None):
+            sampler.reset(rng)
+
 
         # AE: To Do - some way to check if target values are tuples (min,max) or single values!
         #             and then incorporate this into the model optimization (min / max)....
@@ -408,7 +904,8 @@ class TrailMap(nx.MultiDiGraph):
                 e[2]['traversed_count'] = 0
 
 
-            self.recompute_edge_weights(target_values=target_values) # was self
+            with self._timer('recompute_edge_weights'):
+                self.recompute_edge_weights(target_values=target_values) # was self
 
 
         remaining = {k:0 for k in totals_methods.keys()} # dict to get remainders to target
@@ -426,29 +923,42 @@ class TrailMap(nx.MultiDiGraph):
             # can do better sucess / failure here and try once with target values
             # then try a second time without target values, with a error message
             # saying constraints not satisfied.
-            next_node = self.get_intermediate_node(current_node, # was self
-                                                   remaining['distance'],
-                                                   target_values=target_values,
-                                                   epsilon=epsilon, exclude=[start_node])
+            with self._timer('get_intermediate_node'):
+                next_node = self.get_intermediate_node(current_node, # was self
+                                                       remaining['distance'],
+                                                       target_values=target_values,
+                                                       epsilon=epsilon, exclude=[start_node],
+                                                       blocked_edges=blocked_edges,
+                                                       sampler=sampler, hop=count,
+                                                       rng=rng, cancel=cancel)
+
+            if is_cancelled(cancel):
+                self._dprint("Route search cancelled after %i hops"%(count))
+                break
+
             if next_node < 0:
+                self._count('next_node_not_found')
                 self._dprint("Next node not found!")
                 # if epsilon fails I could also just pick a next node at random?
                 # break
-            neg_weights = False
-            if self._neg_weight:
-                neg_weights = True
 
             if (current_node != start_node) or (next_node < 0):
                 # make sure that we can still get home within a reasonable
-                # distance
+                # distance. If the static hierarchy is available, use the
+                # true shortest distance home as the check and only compute
+                # the weighted path home if we actually need it
+                shortest_path_home = None
+                with self._timer('path_home'):
+                    if (primary_weight == 'distance') and not (self._hierarchy() is None):
+                        shortest_primary_home = self.shortest_path_length(current_node, end_node,
+                                                                          weight='distance')
+                    else:
+                        shortest_primary_home = None
 
-
-                if neg_weights:
-                    shortest_path_home = nx.bellman_ford_path(self, current_node, end_node, weight='weight')
-                else:
-                    shortest_path_home = nx.shortest_path(self, current_node, end_node, weight='weight')
-                shortest_edges_home    = self.edges_from_nodes(shortest_path_home) # was self
-                shortest_primary_home  = self.reduce_edge_data(primary_weight,edges=shortest_edges_home) # was self
+                    if shortest_primary_home is None:
+                        shortest_path_home     = self._masked_path(current_node, end_node, path_weight)
+                        shortest_edges_home    = self.edges_from_nodes(shortest_path_home) # was self
+                        shortest_primary_home  = self.reduce_edge_data(primary_weight,edges=shortest_edges_home) # was self
 
                 #
                 # would potentialy be v cool to iterate here and check once with weight
@@ -457,7 +967,14 @@ class TrailMap(nx.MultiDiGraph):
                 # no... but maybe I can generate a new fake weight to do something like
                 # this. or pass flag to recompute weights to ignore some things
 
+                if (shortest_primary_home > remaining[primary_weight]) or (next_node < 0):
+                    if shortest_path_home is None:
+                        with self._timer('path_home'):
+                            shortest_path_home  = self._masked_path(current_node, end_node, path_weight)
+                            shortest_edges_home = self.edges_from_nodes(shortest_path_home)
+
                 if shortest_primary_home > remaining[primary_weight]:
+                    self._count('headed_home')
                     self._dprint("Finding shortest route to get home: ", shortest_path_home, end_node)
                     next_node  = end_node
                     next_path  = shortest_path_home
@@ -465,23 +982,20 @@ class TrailMap(nx.MultiDiGraph):
                 elif (next_node < 0):
                     # likely running out of room
                     # pick one of the nodes along the shortest weighted path home
-                    inext      = np.random.randint(0, len(shortest_path_home))
+                    self._count('fallback_toward_home')
+                    inext      = int(rng.integers(0, len(shortest_path_home)))
                     next_node  = shortest_path_home[inext]
                     next_path  = shortest_path_home[:inext+1] # AJE: bug here?
                     next_edges = self.edges_from_nodes(next_path) # was self
                     self._dprint("Picking route on way to home %i %i"%(inext,next_node),next_path)
                 else:
-                    if neg_weights:
-                        next_path  = nx.bellman_ford_path(self, current_node, next_node, weight='weight')
-                    else:
-                        next_path  = nx.shortest_path(self, current_node, next_node, weight='weight')
+                    with self._timer('next_path'):
+                        next_path  = self._masked_path(current_node, next_node, path_weight)
                     next_edges = self.edges_from_nodes(next_path) # was self
 
             else:
-                if neg_weights:
-                    next_path  = nx.bellman_ford_path(self, current_node, next_node, weight='weight')
-                else:
-                    next_path  = nx.shortest_path(self, current_node, next_node, weight='weight')
+                with self._timer('next_path'):
+                    next_path  = self._masked_path(current_node, next_node, path_weight)
                 next_edges = self.edges_from_nodes(next_path) # was self
 
 
@@ -494,18 +1008,23 @@ class TrailMap(nx.MultiDiGraph):
 
             possible_routes[iroute].extend(next_path[1:])
             # increment totals
-            for k in (totals[iroute]).keys():
-                newval = self.reduce_edge_data(k, edges=next_edges, function=totals_methods[k]) # was self
-                totals[iroute][k] = totals_methods[k]( [totals[iroute][k], newval])
+            with self._timer('reduce_edge_data'):
+                for k in (totals[iroute]).keys():
+                    if len(next_edges) == 0: # staying put (e.g. no node found at start)
+                        break
+                    newval = self.reduce_edge_data(k, edges=next_edges, function=totals_methods[k]) # was self
+                    totals[iroute][k] = totals_methods[k]( [totals[iroute][k], newval])
 
             # recompute weights:
-            self.recompute_edge_weights(target_values=target_values, # was self
-                                        totals=totals[iroute]) # probably need kwargs
+            with self._timer('recompute_edge_weights'):
+                self.recompute_edge_weights(target_values=target_values, # was self
+                                            totals=totals[iroute]) # probably need kwargs
 
             # use edges_to_hide = nx.classes.filters.hide_edges(edges)
             # to filter out based on min / max grade
             current_node = next_node
             count = count + 1
+            self._count('hops')
             if current_node == end_node:
                 self._dprint("We found a successful route! Well... got back home at least ...")
                 keep_looping = False
@@ -515,24 +1034,44 @@ class TrailMap(nx.MultiDiGraph):
                 keep_looping = False
 
 
-        if len(possible_routes[iroute]) <= 1:
+        if (len(possible_routes[iroute]) <= 1) and not is_cancelled(cancel):
             self._print("NO POSSIBLE ROUTE FOUND. Route stays fixed at start node.")
 
 
         return totals[iroute], possible_routes[iroute]
 
+    def _masked_path(self, current_node, end_node, path_weight):
+        """
+        Weighted path. Tries with (possibly) masked weight first, but
+        falls back to all edges since we need to get home (or to the least
+        bad next node, see `get_intermediate_node`) regardless.
+        """
+
+        try:
+            return self.shortest_path(current_node, end_node, weight=path_weight)
+        except nx.NetworkXNoPath:
+            if path_weight == 'weight':
+                raise
+
+            self._dprint("No path within grade limits. Ignoring limits to get there")
+            return self.shortest_path(current_node, end_node, weight='weight')
+
     def is_route_feasible(self, start_node, end_node, target_values, target_method):
         """
         Perform a simple sanity check to see if the route is viable. Uses
-        nx.shortest_path to determine if nodes even connect, returning False if
-        they do not. If they do, prints warnings if the shortest path does
-        not meet the contraints, but only returns False if it cannot meet the
-        distance constraint.
+        the connected component labels to determine if nodes even connect,
+        returning False if they do not. A cheap lower bound on the distance
+        between the nodes is checked against the distance target before
+        doing any path search. The shortest path is only searched for if
+        there is a distance constraint (returning False if it cannot be met
+        and printing warnings for the other constraints), or if the
+        component labels were inherited from the full map and so do not
+        guarantee the nodes connect on this part of it.
 
         Parameters
         -----------
         start_node : (int)   start point
-        end_node   : (int)   end point
+        end_node   : (int)   end point. If None, uses start_node.
         target_values : (dict) dictionary of targets and desired values
         target_method : (dict) dictionary of how to evaluate targets
 
@@ -543,15 +1082,38 @@ class TrailMap(nx.MultiDiGraph):
                     not possible or fails distance constraint.
         """
 
+        if end_node is None:
+            end_node = start_node
+
         if start_node == end_node:
-            if len(self.nodes[start_node]['edges']) > 0:
+            if self.degree(start_node) > 0:
                 return True
             else:
                 self._print("You seem to have picked a start point that does not connect to anything")
                 return False
 
+        if self.component_label(start_node) != self.component_label(end_node):
+            self._print("Start and end points do not connect on a known trail: ", start_node, end_node)
+            return False
+
+        if not ('distance' in target_values.keys()):
+            if getattr(self, '_components_exact', True):
+                return True
+
+            # labels only say the nodes connect on the full map
+            if not nx.has_path(self, start_node, end_node):
+                self._print("Start and end points do not connect on a known trail: ", start_node, end_node)
+                return False
+            return True
+
+        lower_bound = self.distance_lower_bound(start_node, end_node)
+        if lower_bound > target_values['distance']:
+            self._print("Route not possible within desired distance. Please try again with different parameters")
+            self._print("Desired distance is %f, while shortest path is at least %f"%(target_values['distance'],lower_bound))
+            return False
+
         try:
-            route = nx.shortest_path(self, start_node, end_node)
+            route = self.shortest_path(start_node, end_node, weight='distance')
         except nx.NetworkXNoPath:
             self._print("Start and end points do not connect on a known trail: ", start_node, end_node)
             return False
@@ -573,6 +1135,97 @@ class TrailMap(nx.MultiDiGraph):
 
         return True
 
+    def compute_components(self, n_landmarks = 0):
+        """
+        Label all nodes by their connected component so that connectivity
+        checks are a simple label comparison. This should be done once
+        when the map is built or loaded (it is also done lazily on first use)
+        and must be re-done if edges are changed.
+
+        Optionally also computes the full `distance` from `n_landmarks`
+        landmark nodes (chosen by farthest-point selection) which
+        gives a better lower bound on node-node distances than the
+        great circle distance.
+
+        Parameters:
+        ------------
+        n_landmarks : (Optional, int) number of landmarks to compute distances
+                      from. Default : 0
+
+        Returns:
+        ------------
+        components  : dictionary mapping node to component label
+        """
+
+        self._components = {}
+        for label, nodes in enumerate(nx.weakly_connected_components(self)):
+            for n in nodes:
+                self._components[n] = label
+        self._components_exact = True
+
+        self._landmarks = None
+        if n_landmarks > 0 and len(self.nodes) > 0:
+            self._landmarks = []
+
+            # farthest-point selection. Start with the node farthest from
+            # an arbitrary node
+            n0           = next(iter(self.nodes))
+            dist         = nx.single_source_dijkstra_path_length(self, n0, weight='distance')
+            next_landmark = max(dist, key=dist.get)
+            min_dist     = {n : np.inf for n in self.nodes}
+
+            for i in range(n_landmarks):
+                dist = nx.single_source_dijkstra_path_length(self, next_landmark, weight='distance')
+                self._landmarks.append(dist)
+
+                for n, d in dist.items():
+                    min_dist[n] = min(min_dist[n], d)
+
+                # nodes unreachable from all landmarks so far are picked first
+                next_landmark = max(min_dist, key=min_dist.get)
+
+        return self._components
+
+    def component_label(self, node):
+        """
+        Connected component label of the node. Computes labels if not yet done.
+        """
+
+        if getattr(self, '_components', None) is None:
+            self.compute_components()
+
+        return self._components[node]
+
+    def distance_lower_bound(self, u, v):
+        """
+        Cheap lower bound on the `distance` between two nodes. Uses the
+        larger of the great circle distance and the landmark (triangle
+        inequality) bound if landmarks are available. Assumes nodes are connected.
+        """
+
+        bound = self.great_circle_distance(self.nodes[u]['lat'], self.nodes[u]['long'],
+                                           self.nodes[v]['lat'], self.nodes[v]['long'])
+
+        for dist in (getattr(self, '_landmarks', None) or []):
+            if (u in dist) and (v in dist):
+                bound = max(bound, abs(dist[u] - dist[v]))
+
+        return bound
+
+    @staticmethod
+    def great_circle_distance(lat1, long1, lat2, long2):
+        """
+        Haversine distance (in m) between coordinates. Works
+        on scalars or numpy arrays.
+        """
+
+        lat1, long1, lat2, long2 = [np.radians(x) for x in (lat1, long1, lat2, long2)]
+
+        a = np.sin(0.5*(lat2-lat1))**2 + np.cos(lat1)*np.cos(lat2)*np.sin(0.5*(long2-long1))**2
+
+        # use slightly smaller than mean radius to keep this a lower bound
+        return 2.0 * 6.356752E6 * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
     def route_properties(self, nodes=None, edges = None,
                                verbose=True, header=True, units = 'english'):
         """
@@ -659,7 +1312,12 @@ class TrailMap(nx.MultiDiGraph):
                                     weight='distance',
                                     target_values = {},
                                     exclude = None,
-                                    max_iterations = 100):
+                                    max_iterations = 100,
+                                    blocked_edges = None,
+                                    sampler = None,
+                                    hop = 0,
+                                    rng = None,
+                                    cancel = None):
         """
         Search for a node to jump to next in the algorithm given knowledge of
         the ultimate target distance for the route, and the current node.
@@ -680,40 +1338,68 @@ class TrailMap(nx.MultiDiGraph):
                             weighting. Default : 'distance'
         target_values    :  (optional, dict) dictionary of target features and values
                             to (if provided) make better informed routing decisions.
+                            Grade limits are used to mask edges if `blocked_edges`
+                            is not provided.
         exclude          :  List of nodes to exclude from being selected as a next node.
                             Default : None
         max_iterations   :  (optional, int) Maximum number of iterations within loop to find a new node.
                             Default : 100
+        blocked_edges    :  (optional, set) set of directed edges (u,v,key) that can not
+                            be travelled along (see `grade_blocked_edges`). If no
+                            candidate can be reached without them, the least bad
+                            candidate reached using all edges is picked instead.
+                            Default : None
+        sampler          :  (optional, LoopSampler) if provided, used to make a
+                            direction-aware pick among candidates. Otherwise picks
+                            uniformly at random. Default : None
+        hop              :  (optional, int) hop number in the route. Used by `sampler`.
+                            Default : 0
+        rng              :  (optional, int or numpy Generator) random state used to
+                            pick the node. If None, uses fresh entropy. Default : None
+        cancel           :  (optional, CancellationToken) checked before each search.
+                            Returns -1 if cancelled. Default : None
 
         Returns:
         ----------
         next_node        : (int) Node index of next target node
         """
 
+        rng = np.random.default_rng(rng)
+
+        if blocked_edges is None:
+            blocked_edges = self.grade_blocked_edges(target_values)
+
+        min_epsilon = epsilon
+
+        # infeasible steep edges never enter the search
+        search_weight = self.masked_weight('distance', blocked_edges)
+
         next_node = None
 
         failed = False
 
-        all_next_nodes = []
-        next_node_weights = [] # to help choosing least worst if we have to
         iteration_count = -1
-        error_code = ''
         while (next_node is None) and (iteration_count < max_iterations):
             iteration_count += 1
 
+            if is_cancelled(cancel):
+                return -1
+
             # This should ensure that point is actually reachable
             #
             # would be cool to pick the node with opposite (ish) direction vector
             # between current node and home (if round trip)
-            all_possible_points = nx.single_source_dijkstra(self, current_node,
-                                                            weight='distance',     # worth noting that this should be strict distance (or slightly modified) since we are using a cutoff
-                                                            cutoff=(epsilon+shift)*target_distance)[0]
+            with self._timer('candidate_search'):
+                all_possible_points = nx.single_source_dijkstra(self, current_node,
+                                                                weight=search_weight,     # worth noting that this should be strict distance (or slightly modified) since we are using a cutoff
+                                                                cutoff=(epsilon+shift)*target_distance)[0]
 
             if not (exclude is None):
                 all_possible_points = {k:v for (k,v) in all_possible_points.items() if not (k in exclude)}
 
             if len(all_possible_points) == 1:
                 if epsilon > 1.0:
+                    self._count('failed_intermediate_node')
                     self._print("WARNING1: Failed to find an intermediate node. Epsilon maxing out")
                     failed    = True
                     next_node = None
@@ -721,14 +1407,15 @@ class TrailMap(nx.MultiDiGraph):
                     #raise RuntimeError
 
                 epsilon = epsilon + shift
+                self._count('epsilon_retries')
                 continue
 
-            farthest_node = np.max(all_possible_points.values())
             possible_points = [k for (k,v) in all_possible_points.items() if v >= (epsilon-shift)*target_distance]
 
             if len(possible_points) == 0:
                 if epsilon > 1.0:
 
+                    self._count('failed_intermediate_node')
                     self._print("WARNING2: Failed to find an intermediate node. Epsilon maxing out")
                     failed    = True
                     next_node = None
@@ -737,75 +1424,159 @@ class TrailMap(nx.MultiDiGraph):
 
                 #self._dprint("Increasing epsilon in loop %f"%(epsilon))
                 epsilon = epsilon + shift
+                self._count('epsilon_retries')
                 continue
 
             #
-            # select one at random!!!
+            # select one at random!!! (weighted towards closing the loop)
             #
+            if epsilon <= 1.0:
+                if sampler is None:
+                    next_node = possible_points[rng.integers(len(possible_points))]
+                else:
+                    with self._timer('sample_candidate'):
+                        next_node = sampler.draw(possible_points,
+                                                 [all_possible_points[k] for k in possible_points],
+                                                 target_distance, hop=hop, rng=rng)
+            else:
+                self._count('failed_intermediate_node')
+                self._print("WARNING3: Failed to find an intermediate node. Epsilon maxing out")
+                failed = True
+                next_node = None
+                break
+
+
+        if (next_node is None) or (iteration_count > max_iterations):
+            self._print(next_node, iteration_count, epsilon)
             next_node = None
-            random.shuffle(possible_points) # in-place for some reason
-            j = 0
 
+            if blocked_edges and not is_cancelled(cancel):
+                # nothing reachable within the grade limits. Take the
+                # candidate that is cheapest to reach using all edges
+                self._dprint("WARNING4: Unable to satisfy all criteria. Choosing least worst point")
+                next_node = self._least_worst_node(current_node, target_distance,
+                                                   min_epsilon - shift, 1.0 + shift, exclude)
+                if not (next_node is None):
+                    self._count('least_worst_node')
+
+        if next_node is None: # switch to -1 to throw proper error
+            next_node = -1
+
+        return next_node #, error_code
+
+    def _least_worst_node(self, current_node, target_distance, min_factor, max_factor,
+                                exclude = None):
+        """
+        Node between `min_factor` and `max_factor` of `target_distance`
+        (along any edges) from `current_node` with the lowest total `weight`
+        to reach. Used when the grade limits leave no candidates. None if
+        there are no such nodes.
+        """
 
-            neg_weights = False
-            if self._neg_weight:
-                neg_weights = True
+        distances = nx.single_source_dijkstra_path_length(self, current_node, weight='distance',
+                                                          cutoff=max_factor*target_distance)
 
-            while (next_node is None) and (j < len(possible_points)) and (epsilon <= 1.0):
-                next_node = possible_points[j] # choose this
+        possible = [k for (k,v) in distances.items() if (v >= min_factor*target_distance) and
+                                                        (k != current_node) and
+                                                        ((exclude is None) or not (k in exclude))]
+        if len(possible) == 0:
+            return None
 
-                if len(target_values) > 0:
-                    # if target values array exists, then we need to check and see if
-                    # this path violates contraints. FOcusing on min max grade for now
-                    #
-                    value_checks = ['average_max_grade','average_min_grade', 'average_grade']
-                    fdict = {'average_max_grade' : np.max, 'average_min_grade': np.min, 'average_grade' : self._max_abs}
+        weights = nx.single_source_dijkstra_path_length(self, current_node, weight='weight')
 
-                    if neg_weights:
-                        weighted_path  = nx.bellman_ford_path(self, current_node, next_node, weight='weight')
-                    else:
-                        weighted_path  = nx.shortest_path(self, current_node, next_node, weight='weight')
+        return min(possible, key = lambda k : weights.get(k, np.inf))
 
-                    for k in value_checks:
-                        if k in target_values.keys():
-                            if 'grade' in k:
-                                continue
-                                
-#                            if len(weighted_path) == 0:
-#                                self._print(k, current_node, next_node, target_values[k], weighted_path)
-                            reduced       = self.reduce_edge_data(k, nodes = weighted_path, function=fdict[k])
-                            if reduced > target_values[k]:
-                                self._dprint("Next node failing on grade ", next_node, reduced, target_values[k])
+    def candidate_sampler(self, start_node, end_node=None, **kwargs):
+        """
+        Make the direction-aware sampler used to pick next nodes in
+        `get_intermediate_node`. Returns None if direction sampling is
+        turned off (`_direction_sampling`). kwargs are passed to `LoopSampler`.
+        """
 
-                                all_next_nodes.append(next_node)
-                                next_node_weights.append( self.reduce_edge_data('weight',nodes=weighted_path,function=np.sum))
+        if not getattr(self, '_direction_sampling', True):
+            return None
 
-                                next_node = None
-                                error_code = "Target value fail"
-                                break # break out of key for loop
+        if end_node is None:
+            end_node = start_node
 
+        return LoopSampler(self, end_node, loop = (start_node == end_node), **kwargs)
 
+    def grade_edge_mask(self, target_values):
+        """
+        Turn grade limits in `target_values` (`average_max_grade`,
+        `average_min_grade`, `average_grade`) into a boolean mask over
+        all directed edges (each of any parallel edges on its own), True where
+        the edge can be travelled along. Grades are oriented in the direction of travel u -> v (e.g. a steep
+        uphill is a steep downhill in the other direction). As with
+        the weighting, limits are treated by magnitude.
 
-                j = j + 1
-            # end while loop
-            if (epsilon > 1.0) and (next_node is None):
-                self._print("WARNING3: Failed to find an intermediate node. Epsilon maxing out")
-                failed = True
-                next_node = None
+        Parameters:
+        ------------
+        target_values  : (dict) target values. Only grade keys are used.
+
+        Returns:
+        ------------
+        edges          : (E,3) array of directed edges (u,v,key)
+        mask           : (E) boolean array. True if allowed.
+        """
 
+        grade_keys = [k for k in ['average_max_grade','average_min_grade','average_grade'] if k in target_values]
 
-        if (next_node is None) or (iteration_count > max_iterations):
-            self._print(next_node, iteration_count, epsilon, error_code)
-            if (error_code == "Target value fail") or (iteration_count > max_iterations):
-                self._dprint("WARNING4: Unable to satisfy all criteria. Choosing least worst point")
-                next_node = all_next_nodes[np.argmin(next_node_weights)]
+        edges = np.array([(u,v,k) for (u,v,k) in self.edges(keys=True)]).reshape(-1,3)
+        mask  = np.ones(len(edges), dtype=bool)
 
+        if len(grade_keys) == 0 or len(edges) == 0:
+            return edges, mask
 
+        data     = [d for (u,v,k,d) in self.edges(keys=True, data=True)]
+        max_grade = np.array([d['average_max_grade'] for d in data])
+        min_grade = np.array([d['average_min_grade'] for d in data])
 
-        if next_node is None: # switch to -1 to throw proper error
-            next_node = -1
+        # by convention, stored values are for travel from lower to higher node
+        flip     = edges[:,0] > edges[:,1]
+        dir_max  = np.where(flip, -1.0*min_grade, max_grade)
+        dir_min  = np.where(flip, -1.0*max_grade, min_grade)
 
-        return next_node #, error_code
+        if 'average_max_grade' in grade_keys:
+            mask = mask & (dir_max <= np.abs(target_values['average_max_grade']))
+
+        if 'average_min_grade' in grade_keys:
+            mask = mask & (dir_min >= -1.0*np.abs(target_values['average_min_grade']))
+
+        if 'average_grade' in grade_keys:
+            average_grade = np.array([d['average_grade'] for d in data])
+            mask = mask & (np.abs(average_grade) <= np.abs(target_values['average_grade']))
+
+        return edges, mask
+
+    def grade_blocked_edges(self, target_values):
+        """
+        Set of directed edges (u,v,key) that fail the grade limits in `target_values`.
+        See `grade_edge_mask`. Empty if no grade limits are given.
+        """
+
+        edges, mask = self.grade_edge_mask(target_values)
+
+        return set( (u,v,k) for (u,v,k) in edges[np.logical_not(mask)].tolist() )
+
+    @staticmethod
+    def masked_weight(weight, blocked_edges = None):
+        """
+        Weight to pass to networkx searches that hides `blocked_edges`
+        (u,v,key). Parallel edges that are not blocked can still be used.
+        Returns `weight` unchanged if there is nothing to hide.
+        """
+
+        if not blocked_edges:
+            return weight
+
+        def _weight(u, v, d):
+            allowed = [attr[weight] for k, attr in d.items() if not ((u,v,k) in blocked_edges)]
+            if len(allowed) == 0:
+                return None # hidden
+            return min(allowed)
+
+        return _weight
 
     def scale_edge_attributes(self, reset=False):
         """
@@ -818,6 +1589,16 @@ class TrailMap(nx.MultiDiGraph):
 
         Likely do not want to use traversed_count as rescaled (the way weighting
         is done now at least)
+
+        Sub-graphs and copies inherit the scalings of the map they came from
+        (see `_inherit_settings`) rather than re-scaling over their own edges.
+        This is intentional: an edge gets the same weight whatever part of the
+        map a route is searched on (so cached weights can be shared), where
+        before the weights changed with the size of the filtered sub-graph.
+        `traversed_count` and `in_another_route` are never re-scaled as they
+        change during routing. Their scaled values are not used in the
+        weights, which apply the raw counts (see `recompute_edge_weights`).
+        Use `reset` to re-scale over this graph's own edges.
         """
 
         if (self._scalings is None):
@@ -826,17 +1607,27 @@ class TrailMap(nx.MultiDiGraph):
         if (self._scale_var is None):
             self._scale_var = {}
 
-        # compute!
+        # compute! Scalings are kept, so edges are only re-scaled for new
+        # (or reset) attributes
+        new_keys = []
         for k in self.edge_attributes:
             if (not (k in self._scalings.keys())) or reset:
                 self._scalings[k] = {}
                 self._scalings[k]['min_val'] = self.reduce_edge_data(k,function=np.min)
                 self._scalings[k]['max_val'] = self.reduce_edge_data(k,function=np.max)
                 self._scalings[k]['max_min'] = self._scalings[k]['max_val'] - self._scalings[k]['min_val']
+                new_keys.append(k)
+
+        if len(new_keys) > 0:
+            # cached weights were computed with the old scalings. Start new
+            # caches rather than clearing ones shared with other maps
+            self._weight_caches      = {}
+            self._max_tail_distance  = None
 
-        for k in self.edge_attributes: # need error checking for non quantiative values
+        for k in new_keys: # need error checking for non quantiative values
             if (self._scalings[k]['max_min']) == 0.0: # likely no data here - don't rescale
-                e[2][k+'_scaled'] = 0.0
+                for e in self.edges(data=True):
+                    e[2][k+'_scaled'] = 0.0
                 continue
 
             for e in self.edges(data=True):
@@ -867,11 +1658,6 @@ class TrailMap(nx.MultiDiGraph):
         # need a list of what we are considering
         # and how to treat it. Hard code for now
 
-        # weightings:
-        if edges is None:
-            edges = self.edges(data=True)
-
-
         wf = copy.deepcopy(self._weight_factors)
         self._neg_weight = False
 
@@ -933,55 +1719,111 @@ class TrailMap(nx.MultiDiGraph):
                 else:
                     wf[k] = 0.25
 
-        for u,v,d in edges:
-
-            max_tail_distance = np.max([self._adj[u][v][_IDIR]['distance_scaled'] for v in self._adj[u]])
+        def _base_weight(u, v, d):
+            """
+            Weight without the traversal penalties. Depends only on the edge
+            data, weight factors, and grade targets.
+            """
 
             # apply weights for all '_scaled' properties using simple sum for now
             # need to control this better later. Handle traversed coutn separately
 
-            d['weight'] = wf['distance'] * d['distance_scaled']
+            weight = wf['distance'] * d['distance_scaled']
 
             # direction of travel convention, gain is gain when u < v,
             # otherwise it needs to be flipped with loss.
             if u < v:
-                d['weight'] += wf['elevation_gain'] * d['elevation_gain_scaled']
-                d['weight'] += wf['elevation_loss'] * d['elevation_loss_scaled']
-                d['weight'] += _compute_grade_weight('average_max_grade',d) * d['distance_scaled']
-                d['weight'] += _compute_grade_weight('average_min_grade',d) * d['distance_scaled']
-                d['weight'] += _compute_grade_weight('average_grade',d) * d['distance_scaled']
+                weight += wf['elevation_gain'] * d['elevation_gain_scaled']
+                weight += wf['elevation_loss'] * d['elevation_loss_scaled']
+                weight += _compute_grade_weight('average_max_grade',d) * d['distance_scaled']
+                weight += _compute_grade_weight('average_min_grade',d) * d['distance_scaled']
+                weight += _compute_grade_weight('average_grade',d) * d['distance_scaled']
 
             else:
-                d['weight'] += wf['elevation_loss'] * d['elevation_gain_scaled']
-                d['weight'] += wf['elevation_gain'] * d['elevation_loss_scaled']
-                d['weight'] += _compute_grade_weight('average_grade',d) * d['distance_scaled']
+                weight += wf['elevation_loss'] * d['elevation_gain_scaled']
+                weight += wf['elevation_gain'] * d['elevation_loss_scaled']
+                weight += _compute_grade_weight('average_grade',d) * d['distance_scaled']
                 if (wf['average_max_grade'] > 0):
-                    d['weight'] += _compute_grade_weight('average_max_grade',d) *\
-                                   (wf['average_min_grade']/wf['average_max_grade']) * d['distance_scaled']
+                    weight += _compute_grade_weight('average_max_grade',d) *\
+                              (wf['average_min_grade']/wf['average_max_grade']) * d['distance_scaled']
                 if (wf['average_min_grade'] > 0):
-                    d['weight'] += _compute_grade_weight('average_min_grade',d) *\
-                                   (wf['average_max_grade']/wf['average_min_grade']) * d['distance_scaled']
+                    weight += _compute_grade_weight('average_min_grade',d) *\
+                              (wf['average_max_grade']/wf['average_min_grade']) * d['distance_scaled']
 
-            #
-            # Backtrack penalty
-            #
-            d['weight'] += wf['traversed_count']*d['traversed_count']*max_tail_distance
+            return weight
 
-            #
-            # Meta penalty for use when planning multiple routes at once
-            #
-            d['weight'] += wf['in_another_route']*d['in_another_route']*max_tail_distance
+        #
+        # base weights are cached per weighting (see `_edge_weight_cache`)
+        # when reweighting the whole graph, which is done every hop
+        #
+        if edges is None:
+            base_weights = self._edge_weight_cache(wf, target_values)
+            edges        = self.edges(keys=True, data=True)
+        else:
+            base_weights = None
+            edges        = [(u, v, None, d) for u, v, d in edges]
 
+        max_tail = getattr(self, '_max_tail_distance', None)
+        if max_tail is None:
+            max_tail = self._max_tail_distance = {}
 
-            # converting to integers is safer here
-            d['weight'] = int(d['weight']*(10.0**self._weight_precision))
-            d['weight'] = np.max([0.0,d['weight']])
+        precision = 10.0**self._weight_precision
+
+        for u,v,key,d in edges:
+
+            if base_weights is None:
+                weight = _base_weight(u, v, d)
+            else:
+                weight = base_weights.get((u,v,key), None)
+                if weight is None:
+                    weight = base_weights[(u,v,key)] = _base_weight(u, v, d)
 
-            if d['weight'] < 0:
-                self._neg_weight = True
+            if (d['traversed_count'] != 0) or (d['in_another_route'] != 0):
+                if not (u in max_tail):
+                    max_tail[u] = np.max([self._adj[u][x][_IDIR]['distance_scaled'] for x in self._adj[u]])
+
+                #
+                # Backtrack penalty
+                #
+                weight += wf['traversed_count']*d['traversed_count']*max_tail[u]
+
+                #
+                # Meta penalty for use when planning multiple routes at once
+                #
+                weight += wf['in_another_route']*d['in_another_route']*max_tail[u]
+
+            # converting to integers is safer here
+            d['weight'] = max(0.0, float(int(weight*precision)))
 
         return
 
+    def _edge_weight_cache(self, wf, target_values):
+        """
+        Cache of edge weights (without traversal penalties) for the
+        given weight factors and grade targets, keyed by edge (u,v,key).
+        The cache is shared with sub-graphs and copies of this map (see
+        `_inherit_settings`), which have the same edge scalings, so it is
+        filled once per weighting rather than on every hop of every
+        route. Only the last `_max_weight_caches` weightings are kept.
+        Dropped when edges are re-scaled.
+        """
+
+        caches = getattr(self, '_weight_caches', None)
+        if caches is None:
+            caches = self._weight_caches = {}
+
+        signature = (tuple((k, wf[k]) for k in sorted(wf.keys()) if not (k in ['traversed_count', 'in_another_route'])),
+                     tuple((k, target_values.get(k, None)) for k in ['average_grade', 'average_min_grade', 'average_max_grade']),
+                     self._weight_precision)
+
+        cache = caches.get(signature, None)
+        if cache is None:
+            while len(caches) >= getattr(self, '_max_weight_caches', 32):
+                caches.pop(next(iter(caches)), None)
+            cache = caches[signature] = {}
+
+        return cache
+
     def get_route_coords(self, nodes = None, edges = None, elevation=True,
                          coords_only = False, in_json=False):
         """
@@ -1075,6 +1917,140 @@ class TrailMap(nx.MultiDiGraph):
 
         return nearest_indexes, nearest_node_ids
 
+    def build_contraction_hierarchy(self, **kwargs):
+        """
+        Build (or re-build) the contraction hierarchy on the static `distance`
+        metric used to speed up repeated point-to-point queries in
+        `shortest_path` and `shortest_path_length`. This is meant to be done
+        once when a region is built and pickled alongside the map. Must
+        be re-built if edges are changed.
+
+        kwargs are passed to `ContractionHierarchy`.
+        """
+
+        self._ch = ContractionHierarchy(self, weight='distance', **kwargs)
+        self.new_map_version() # shortest paths may change
+
+        self._print("Built contraction hierarchy with %i shortcuts for %i nodes"%(self._ch.num_shortcuts,
+                                                                                   len(self.nodes)))
+
+        return self._ch
+
+    @property
+    def map_version(self):
+        """
+        ID of this build of the map. Results computed on the map (e.g. cached
+        routes) are only valid for the same version. Changed by `new_map_version`
+        whenever the map is rebuilt.
+        """
+
+        if getattr(self, '_map_version', None) is None: # older pickled maps
+            self._map_version = self.content_version()
+
+        return self._map_version
+
+    def content_version(self, source_file = None):
+        """
+        Deterministic version ID from the map's size and total trail
+        distance (and the modification time of `source_file`, if given). Used
+        for maps pickled before versions were kept, so the same file gives the
+        same version each time it is loaded.
+
+        Parameters:
+        -----------
+        source_file : (Optional, str) file the map was loaded from. Default : None
+        """
+
+        total = sum(d.get('distance', 0.0) for u, v, d in self.edges(data=True))
+        raw   = repr((self.name, len(self._node), self.number_of_edges(), '%.3f'%(total)))
+
+        if not (source_file is None):
+            raw += repr(os.path.getmtime(source_file))
+
+        return 'legacy_' + hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def new_map_version(self, version = None):
+        """
+        Mark the map as rebuilt, invalidating any results tied to the old version.
+
+        Parameters:
+        -----------
+        version   : (Optional, str) Version ID to use. Should be deterministic
+                    for the map's content (e.g. see `osm_process.tiles_version`)
+                    so equivalent maps share cached results. Default : None
+                    (random, unique ID)
+        """
+
+        self._map_version = uuid.uuid4().hex if version is None else str(version)
+
+        return self._map_version
+
+    def _hierarchy(self):
+        """
+        The contraction hierarchy, if it can be used for exact queries on this
+        graph, otherwise None. The hierarchy is built on the full map, so on
+        sub-graph views (or copies of them) its paths may leave the graph and
+        its distances are only lower bounds. These use a normal search instead.
+        """
+
+        ch = getattr(self, '_ch', None)
+
+        if (ch is None) or hasattr(self, '_graph'): # sub-graph view
+            return None
+
+        if len(self._node) != len(ch._rank):        # copy of part of the map
+            return None
+
+        return ch
+
+    def shortest_path(self, source, target, weight='weight'):
+        """
+        Shortest path between two nodes. Uses the contraction hierarchy
+        (if built on this graph, see `_hierarchy`) for the static `distance` metric, and networkx otherwise
+        (Bellman-Ford if negative weights are present).
+
+        Parameters:
+        ------------
+        source   : (int) start node
+        target   : (int) end node
+        weight   : (Optional, str) edge property to use for weighting.
+                   Default : 'weight'
+
+        Returns:
+        ------------
+        path     : ordered list of nodes. Raises nx.NetworkXNoPath if no path.
+        """
+
+        ch = self._hierarchy()
+
+        if (weight == 'distance') and not (ch is None):
+            path = ch.path(source, target)
+            if path is None:
+                raise nx.NetworkXNoPath("No path between %s and %s"%(source, target))
+            return path
+
+        if getattr(self, '_neg_weight', False):
+            return nx.bellman_ford_path(self, source, target, weight=weight)
+        else:
+            return nx.shortest_path(self, source, target, weight=weight)
+
+    def shortest_path_length(self, source, target, weight='distance'):
+        """
+        Shortest path length between two nodes on static `distance` metric
+        using the contraction hierarchy if available (see `_hierarchy`).
+        Returns None if the nodes do not connect.
+        """
+
+        ch = self._hierarchy()
+
+        if (weight == 'distance') and not (ch is None):
+            return ch.distance(source, target)
+
+        try:
+            return nx.shortest_path_length(self, source, target, weight=weight)
+        except nx.NetworkXNoPath:
+            return None
+
     def ensure_edge_attributes(self):
         """
         Ensure that edge attributes exist for ALL edges. Just to make sure
@@ -1314,12 +2290,102 @@ class TrailMap(nx.MultiDiGraph):
 
         return
 
+    def _default_target_methods(self):
+        """
+        Default functions used to total up each target along a route.
+        """
+
+        return {'distance'          : np.sum,
+                'average_max_grade' : np.max,
+                'average_min_grade' : np.min,
+                'average_grade'     : self._max_abs,
+                'elevation_gain'    : np.sum, 'elevation_loss' : np.sum,
+                'traversed_count'   : np.sum}
+
     def _max_abs(self, var):
         """
         Helper function. Was a lambda but that can break pickling
         """
         return np.abs(np.max(var))
 
+    def enable_profiling(self, callback = None):
+        """
+        Turn on per-phase timers and counters for route requests. Stats
+        for each request (`multi_find_route` or `find_route_constraint_range`)
+        are saved to `last_stats` and passed to `callback` (a function of
+        one argument, the ProfileStats object) if provided. They can also be
+        returned with the routes using `return_stats=True`.
+        """
+
+        self._profiling        = True
+        self._profile_callback = callback
+
+        return
+
+    def disable_profiling(self):
+        """
+        Turn off profiling. See `enable_profiling`.
+        """
+
+        self._profiling        = False
+        self._profile_callback = None
+
+        return
+
+    def _timer(self, phase):
+        """
+        Timer for `phase` of the current request. Does nothing if profiling is off.
+        """
+
+        profile = _request_stats.get()
+        if profile is None:
+            return NULL_TIMER
+
+        return profile.timer(phase)
+
+    def _count(self, name, n = 1):
+        """
+        Increment counter for current request if profiling.
+        """
+
+        profile = _request_stats.get()
+        if not (profile is None):
+            profile.count(name, n)
+
+        return
+
+    def _start_stats(self):
+        """
+        Start stats for a new request. Returns None if profiling is off,
+        or if already inside a request (stats go to the outer request).
+        The stats are held per thread / task, not on the map, and must be
+        closed with `_finish_stats` (in a `finally`).
+        """
+
+        if not getattr(self, '_profiling', False) or not (_request_stats.get() is None):
+            return None
+
+        stats = ProfileStats()
+        _request_stats.set(stats)
+
+        return stats
+
+    def _finish_stats(self, stats):
+        """
+        Finish request started with `_start_stats`.
+        """
+
+        if stats is None:
+            return
+
+        _request_stats.set(None)
+        self.last_stats  = stats
+
+        if not (getattr(self, '_profile_callback', None) is None):
+            self._profile_callback(stats)
+
+        return
+
     def _print(self, msg, *args, **kwargs):
         """
         Print overload
@@ -1337,6 +2403,56 @@ class TrailMap(nx.MultiDiGraph):
         return
 
 
+def _spawn_seeds(rng, n):
+    """
+    `n` independent child SeedSequences from a seed, SeedSequence, or
+    numpy Generator (None uses fresh entropy).
+    """
+
+    if isinstance(rng, np.random.SeedSequence):
+        seed_seq = rng
+    elif isinstance(rng, np.random.Generator):
+        seed_seq = np.random.SeedSequence(int(rng.integers(0, 2**63)))
+    else:
+        seed_seq = np.random.SeedSequence(rng)
+
+    return seed_seq.spawn(n)
+
+#
+# Helpers for running multi_find_route in other processes
+#
+_worker_tmap = None
+
+def _init_route_worker(tmap):
+    """
+    Process pool initializer. Holds on to this process' copy of the map.
+    """
+    global _worker_tmap
+    _worker_tmap = tmap
+
+    # forked workers inherit the parent's (in-progress) request stats
+    _request_stats.set(None)
+
+    return
+
+def _route_worker(start_node, target_values, n_routes, seed, kwargs):
+    """
+    Run multi_find_route on a fresh copy of this process' map (so tasks do not
+    depend on which ran before in this process). Map is already filtered.
+    `seed` is this task's own (child) SeedSequence.
+    """
+
+    tmap   = _worker_tmap.standalone_copy()
+    result = tmap.multi_find_route(start_node, target_values,
+                                   n_routes=n_routes,
+                                   subgraph=tmap,
+                                   return_stats=True,
+                                   rng=seed,
+                                   **kwargs)
+
+    return result[:3], result[3]
+
+
 class SimpleGraph():
     """
     A soon-to-be defunct class originally made for the trail map graphs.
@@ -1390,6 +2506,66 @@ class SimpleGraph():
 
         return self._G_nx
 
+def test_view_scalings():
+    """
+    Test that sub-graphs and copies use the edge scalings (and so weights) of
+    the full map rather than their own, and that the route counters only
+    enter the weights through the traversal penalties.
+    """
+
+    from planit.autotrail import synthetic
+
+    tmap = synthetic.synthetic_trailmap('grid', n_edges = 400, seed = 1)
+    tmap.verbose = False
+
+    targets = {'distance' : 3000.0, 'elevation_gain' : 100.0}
+    tmap.scale_edge_attributes()
+    tmap._assign_weights(targets)
+    tmap.recompute_edge_weights(target_values = targets)
+
+    start = next(iter(tmap.nodes))
+    subG  = tmap.filtered_subgraph(start, 2000.0)
+    copyG = subG.standalone_copy()
+
+    assert len(subG.nodes) < len(tmap.nodes)
+
+    for G in [subG, copyG]:
+        assert G._weight_caches is tmap._weight_caches
+
+        G.scale_edge_attributes()
+        G._assign_weights(targets)
+        G.recompute_edge_weights(target_values = targets)
+
+        for u, v, k, d in G.edges(keys = True, data = True):
+            full = tmap.edges[(u,v,k)]
+            assert d['distance_scaled'] == full['distance_scaled']
+            assert d['elevation_gain_scaled'] == full['elevation_gain_scaled']
+
+    # same weights as the full map before any routing on the copy
+    for u, v, k, d in copyG.edges(keys = True, data = True):
+        assert d['weight'] == tmap.edges[(u,v,k)]['weight']
+
+    # re-scaling the copy over its own edges gives its own weights
+    copyG.scale_edge_attributes(reset = True)
+    assert not (copyG._weight_caches is tmap._weight_caches)
+
+    # counters only add the traversal penalties
+    u, v, k = next(iter(subG.edges(keys = True)))
+    base    = tmap.edges[(u,v,k)]['weight']
+    tmap.edges[(u,v,k)]['traversed_count'] = 2
+    tmap.recompute_edge_weights(target_values = targets)
+    assert tmap.edges[(u,v,k)]['weight'] > base
+    assert tmap.edges[(u,v,k)]['traversed_count_scaled'] == 0.0
+
+    tmap.edges[(u,v,k)]['traversed_count'] = 0
+    tmap.recompute_edge_weights(target_values = targets)
+    assert tmap.edges[(u,v,k)]['weight'] == base
+
+    print("Sub-graph scalings test passed")
+
+    return
+
+
 def define_graph(graphnum=0):
     """
     Some hand-made example graphs for testing out the code. Select graph
@@ -14,9 +14,17 @@
 """
 
 import numpy as np
+import networkx as nx
 import osmnx
 import os
 
+try:
+    from osmnx._errors import EmptyOverpassResponse
+except ImportError:
+    class EmptyOverpassResponse(Exception):
+        # stand-in so only the "no graph nodes" ValueError is treated as empty
+        pass
+
 try:
     import cPickle as pickle
 except:
@@ -87,7 +95,10 @@ def get_graph(center_point = None,
               query=None,
               dist=40233.6, # 100 km !
               save_to_file=True,
-              allow_cache_load=True
+              allow_cache_load=True,
+              truncate_by_edge=False,
+              allow_empty=False,
+              simplify=True
               ):
     """
     A convenience wrapper around OSMNX's (already convenient) APIs to
@@ -110,10 +121,18 @@ def get_graph(center_point = None,
                         by pickling the graph object.
     allow_cache_load : (optional) If bbox coordinate perfectly match a
                           saved pickle on disk, allow to load this instead
+    truncate_by_edge : (optional) keep edges that cross the bbox edge, including
+                          their nodes outside of it. Default : False
+    allow_empty   : (optional) return None, rather than raising, if there are
+                          no paths in the region. Default : False
+    simplify      : (optional) simplify the graph topology (see osmnx's
+                          simplify_graph). Turn off for regions that will be
+                          stitched together first (see `stitch_graphs`). Default : True
 
     Returns:
     -----------
-    ox_graph      : OSMNX Graph object of the selected region
+    ox_graph      : OSMNX Graph object of the selected region (or None, see
+                    `allow_empty`)
 
     """
     if (center_point is None) and (ll is None) and (rr is None):
@@ -149,9 +168,18 @@ def get_graph(center_point = None,
             print("cannot find file: ", inname)
 
     if call_api:
-        ox_graph = osmnx.graph_from_bbox(north,south,east,west,
-                              retain_all=True, truncate_by_edge=False,
-                              clean_periphery=True, custom_filter='["highway"~"path|track"]')
+        try:
+            ox_graph = osmnx.graph_from_bbox(north,south,east,west,
+                                  retain_all=True, truncate_by_edge=truncate_by_edge, simplify=simplify,
+                                  clean_periphery=True, custom_filter='["highway"~"path|track"]')
+        except (EmptyOverpassResponse, ValueError) as error:
+            # small regions (e.g. cache tiles) may have no trails at all. Any
+            # other error must not be mistaken for an empty region.
+            empty = isinstance(error, EmptyOverpassResponse) or\
+                    ('no graph nodes' in str(error).lower())
+            if (not allow_empty) or (not empty):
+                raise
+            return None
 
         ox_graph.center_point = center_point
         ox_graph.ll = ll
@@ -171,6 +199,27 @@ def get_graph(center_point = None,
     return ox_graph
 
 
+def stitch_graphs(graphs):
+    """
+    Combine unsimplified osmnx graphs of neighboring regions (fetched with
+    `truncate_by_edge` so segments crossing between them are in both) and
+    simplify the result once. Segments in more than one graph are identical,
+    so networkx merges them. Simplifying each region on its own would give
+    different, overlapping edges wherever a trail crosses between them.
+
+    Returns None if all graphs are None (empty regions).
+    """
+
+    graphs = [g for g in graphs if not (g is None)]
+
+    if len(graphs) == 0:
+        return None
+
+    ox_graph = nx.compose_all(graphs) if len(graphs) > 1 else graphs[0].copy()
+
+    return osmnx.simplify_graph(ox_graph)
+
+
 def test():
     """
     Test to make sure this works.
@@ -20,6 +20,9 @@ import numpy as np
 import gpxpy
 import shapely
 import os
+import hashlib
+import concurrent.futures
+import networkx as nx
 
 try:
     import cPickle as pickle
@@ -27,13 +30,24 @@ except:
     import pickle
 
 from planit.autotrail.trailmap import TrailMap
+from planit.autotrail.profiling import ProfileStats, NULL_TIMER
 import planit.autotrail.process_gpx_data as gpx_process
 
 from planit.osm_data import osm_fetch
 
 
+# size (degrees) of the grid tiles processed regions are cached as
+TILE_SIZE = 0.1
 
-def process_ox(osx_graph, hiking_only = True):
+
+def _timer(stats, phase):
+    """
+    Timer for `phase` if `stats` (ProfileStats) is given.
+    """
+    return NULL_TIMER if stats is None else stats.timer(phase)
+
+
+def process_ox(osx_graph, hiking_only = True, stats = None, n_cpus = 1):
     """
     Process the osx_graph object generated from doing something like:
 
@@ -51,6 +65,10 @@ def process_ox(osx_graph, hiking_only = True):
     ------------
     osx_graph    :   an osmnx graph object
     hiking_only  : (optional, bool) Does nothing for now. Default : True
+    stats        : (optional, ProfileStats) if given, time spent in each
+                   processing stage is added to this. Default : None
+    n_cpus       : (optional, int) number of processes to compute edge properties
+                   with (see `compute_osm_edge_properties`). Default : 1
 
     Returns:
     -------------
@@ -72,50 +90,69 @@ def process_ox(osx_graph, hiking_only = True):
     for k in ['path','footway','pedestrian']:
         highway_types[k] = k
 
-    if hiking_only:
-        # because why do a really long list comprehension
-        edges = [(u,v,d) for (u,v,d) in osx_graph.edges(data=True) if all(f in d.keys() for f in mandatory_features) and any(f in d['highway'] for f in ['path','footway','track'])]
-    else:
-        edges = [(u,v,d) for (u,v,d) in osx_graph.edges(data=True) if all(f in d.keys() for f in mandatory_features)]
-
-        #
-        # set ones and zeros for each type of path (really road vs hiking)
-        #
-        for (u,v,d) in edges:
-            for k in highway_types:
-                if not (highway_types[k] in d.keys()) and k in d['highway']:
-                    d[highway_types[k]] = 1
-                else:
-                    d[highway_types[k]] = 0
+    with _timer(stats, 'filter_edges'):
+        if hiking_only:
+            # because why do a really long list comprehension
+            edges = [(u,v,d) for (u,v,d) in osx_graph.edges(data=True) if all(f in d.keys() for f in mandatory_features) and any(f in d['highway'] for f in ['path','footway','track'])]
+        else:
+            edges = [(u,v,d) for (u,v,d) in osx_graph.edges(data=True) if all(f in d.keys() for f in mandatory_features)]
+
+            #
+            # set ones and zeros for each type of path (really road vs hiking)
+            #
+            for (u,v,d) in edges:
+                for k in highway_types:
+                    if not (highway_types[k] in d.keys()) and k in d['highway']:
+                        d[highway_types[k]] = 1
+                    else:
+                        d[highway_types[k]] = 0
+
+    if len(edges) == 0: # nothing to route on here
+        tmap = TrailMap()
+        tmap.graph['crs'] = osx_graph.graph['crs']
+        return tmap
 
     #
     # Get all unique nodes and make the node tuple array
     #
-    nodes = np.unique(np.concatenate([(u,v) for (u,v,d) in edges]).ravel())
-    nodes = [(n, osx_graph._node[n]) for n in nodes]
+    gpx_process.elevation_repair_counts(reset = True)
+
+    with _timer(stats, 'node_elevations'):
+        nodes = np.unique(np.concatenate([(u,v) for (u,v,d) in edges]).ravel())
+        nodes = [(n, osx_graph._node[n]) for n in nodes]
 
-    # set node properties
-    for n,d in nodes:
-        d['lat']  = d['y'] # for compatability with TrailMap
-        d['long'] = d['x'] # for compatability with TrailMap
-        d['elevation'] = gpx_process._elevation_data.get_elevation(d['lat'],d['long'])
-        d['index'] = d['osmid']   # for compatability with TrailMap
+        # all node elevations in one go. These are reused as the edge end points
+        elevations = gpx_process.get_point_elevations([d['y'] for n,d in nodes],
+                                                      [d['x'] for n,d in nodes])
+
+        # set node properties
+        for (n,d), elevation in zip(nodes, elevations):
+            d['lat']  = d['y'] # for compatability with TrailMap
+            d['long'] = d['x'] # for compatability with TrailMap
+            d['elevation'] = float(elevation)
+            d['index'] = d['osmid']   # for compatability with TrailMap
 
     # where most of the work goes, setting edge properties:
-    edges = compute_osm_edge_properties(edges, nodes)
+    with _timer(stats, 'edge_properties'):
+        edges = compute_osm_edge_properties(edges, nodes, stats = stats, n_cpus = n_cpus)
 
     # make the map!
-    tmap = TrailMap()
-    tmap.graph['crs'] = osx_graph.graph['crs']
-    tmap.add_nodes_from(nodes)
-    tmap.add_edges_from(edges)
-#    tmap.add_nodes_from(nodes)
+    with _timer(stats, 'build_map'):
+        tmap = TrailMap()
+        tmap.graph['crs'] = osx_graph.graph['crs']
+        tmap.add_nodes_from(nodes)
+        tmap.add_edges_from(edges)
+        tmap.compute_components()
+
+    if not (stats is None):
+        stats.count('nodes', len(nodes))
+        stats.count('edges', len(edges))
 
     return tmap
 
 
 
-def compute_osm_edge_properties(edges, nodes):
+def compute_osm_edge_properties(edges, nodes, stats = None, n_cpus = 1, chunk_size = 500):
     """
     Given a list of edges and nodes from an OSM graph dataset, compute the
     necessary edge and node properties needed for the TrailMap object to
@@ -134,38 +171,100 @@ def compute_osm_edge_properties(edges, nodes):
     ------------
     edges   :  list of edge tuples [(u,v,{}),....] for the graph
     nodes   :  list of nodes tuples [(u,{}),....] for the graph
+    stats   :  (Optional, ProfileStats) if given, time spent in each stage
+               ('orient', 'elevations', 'track_properties') is added to this.
+               Default : None
+    n_cpus  :  (Optional, int) if > 1, edges are split into chunks of
+               `chunk_size` and computed in a process pool. Each edge is
+               independent and results are merged back in the original edge
+               order, so the result is the same as in serial. Elevation tiles
+               are only read, from the on-disk cache, by each process.
+               Default : 1
+    chunk_size : (Optional, int) number of edges per task when `n_cpus` > 1.
+               Default : 500
 
     Returns:
     ------------
     edges   : the edited edge list with new dictionary items.
     """
 
-    for i in range(len(edges)):
-        tail, head, d = edges[i]
+    # node properties by osmid so each edge is a lookup, not a search
+    node_data = {nd['osmid'] : nd for (ni,nd) in nodes}
+
+    if (n_cpus > 1) and (len(edges) > chunk_size):
+        chunks = [edges[i:i+chunk_size] for i in range(0, len(edges), chunk_size)]
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers = n_cpus,
+                                                    initializer = _init_edge_worker,
+                                                    initargs = (node_data,
+                                                                gpx_process.get_elevation_provider())) as executor:
 
-        #
-        # by convention, lets make it such that the tail of every segment
-        # starts at the node with the lower index (tail < head!)
-        # tail and head are the node IDs, NOT their number in the node list
-        if tail > head:
-            val = head*1
-            head = tail*1
-            tail = val*1
+            futures = [executor.submit(_edge_worker, chunk, stats is not None) for chunk in chunks]
 
-        #
-        # taili and headi are the list indexes NOT the node ID's
-        #
-        taili = [j for j,(ni,nd) in enumerate(nodes) if nd['osmid'] == tail][0]
-        headi = [j for j,(ni,nd) in enumerate(nodes) if nd['osmid'] == head][0]
+            repairs = gpx_process.elevation_repair_counts(reset = True) # from this process
 
-        #print(tail,head, taili, headi)
+            i = 0
+            for f in futures: # keeps edge order
+                results, worker_stats, worker_repairs = f.result()
+                for d in results:
+                    edges[i][2].update(d)
+                    i += 1
+
+                for k, v in worker_repairs.items():
+                    repairs[k] = repairs.get(k, 0) + v
+
+                if not (stats is None):
+                    stats.merge(worker_stats)
+
+    else:
+        for (tail, head, d) in edges:
+            _edge_properties(tail, head, d, node_data, stats)
 
+        repairs = gpx_process.elevation_repair_counts(reset = True)
+
+    if not (stats is None):
+        for k, v in repairs.items():
+            stats.count('elevation_' + k, v)
+
+    if repairs.get('repaired', 0) > 0:
+        print("OSM Process - repaired %i of %i elevations in %i edges / nodes (%i with no data)"%(
+              repairs['repaired'], repairs['points'], repairs['segments'], repairs['all_missing']))
+
+    return edges
+
+
+def _edge_properties(tail, head, d, node_data, stats = None):
+    """
+    Compute the properties of a single edge (see `compute_osm_edge_properties`),
+    updating `d` in place.
+
+    Parameters:
+    ------------
+    tail, head : node IDs (osmid) of the edge
+    d          : edge data dictionary (with 'geometry')
+    node_data  : dictionary of node properties by osmid
+    stats      : (Optional, ProfileStats) stage timing. Default : None
+    """
+
+    #
+    # by convention, lets make it such that the tail of every segment
+    # starts at the node with the lower index (tail < head!)
+    # tail and head are the node IDs, NOT their number in the node list
+    if tail > head:
+        val = head*1
+        head = tail*1
+        tail = val*1
+
+    tail_d = node_data[tail]
+    head_d = node_data[head]
+
+    with _timer(stats, 'orient'):
         if len(d['geometry'].coords[0]) == 2:
-            tail_coords = (nodes[taili][1]['long'], nodes[taili][1]['lat'])
-            head_coords = (nodes[headi][1]['long'], nodes[headi][1]['lat'])
+            tail_coords = (tail_d['long'], tail_d['lat'])
+            head_coords = (head_d['long'], head_d['lat'])
         elif len(d['geometry'].coords[0]) == 3:
-            tail_coords = (nodes[taili][1]['long'], nodes[taili][1]['lat'], nodes[taili][1]['elevation'])
-            head_coords = (nodes[headi][1]['long'], nodes[headi][1]['lat'], nodes[headi][1]['elevation'])
+            tail_coords = (tail_d['long'], tail_d['lat'], tail_d['elevation'])
+            head_coords = (head_d['long'], head_d['lat'], head_d['elevation'])
         else:
             raise RuntimeError
 
@@ -197,90 +296,146 @@ def compute_osm_edge_properties(edges, nodes):
         new_line = (d['geometry']).append(head_coords)
         new_line = new_line.prepend(tail_coords)
 
-        #
-        # Generate a GPX track object from this data to (easily) add in
-        # elevations.
-        #
-        gpx = gpxpy.gpx.GPX()
-        gpx_track = gpxpy.gpx.GPXTrack()
-        gpx.tracks.append(gpx_track)
-
-        gpx_segment = gpxpy.gpx.GPXTrackSegment()
-        gpx_track.segments.append(gpx_segment)
-
-        gpx_points  = [gpxpy.gpx.GPXTrackPoint(x[1],x[0]) for x in new_line.coords]
-        gpx_segment.points.extend(gpx_points)
-
-        # add in elevation data
-        gpx = gpx_process.add_elevations(gpx, smooth=True)
-        gpx_segment = gpx.tracks[0].segments[0]
-
-        # point-point distances and elevations
-        #
-        # NOTE: Elevation gain and elevation loss requires defining a direction
-        #       to travel on the trail. By convention the default direction
-        #       will be from the tail -> head, where the node number of tail <
-        #       the node number of head. So elevation_gain becomes
-        #       elevation_loss when travelling from head to tail!!
-        #
-
-        distances   = gpx_process.gpx_distances(gpx_segment.points)
-        elevations  = np.array([x.elevation for x in gpx_segment.points])
-        dz          = (elevations[1:] - elevations[:-1])  # change in elevations
-        grade       = dz / distances * 100.0            # percent grade!
-        grade[np.abs(distances) < 0.1] = 0.0            # prevent arbitary large grades for short segs with errors
-
-
-        d['geometry']         = shapely.geometry.LineString([(x.longitude,x.latitude,x.elevation) for x in gpx_segment.points])
-        d['distance']         = np.sum(distances)
-        d['elevation_gain']   = np.sum(dz[dz>0])            # see note above!
-        d['elevation_loss']   = np.abs(np.sum( dz[dz<0] ))  # store as pos val
-        d['elevation_change'] = d['elevation_gain'] + d['elevation_loss']
-        d['min_grade']        = np.min(grade)
-        d['max_grade']        = np.max(grade)
-        d['average_grade']    = np.average(grade, weights = distances) # weighted avg!!
-
-        #
-        # Average min and max grade give a BETTER estimate of the conceptual 'how steep is this trail'
-        # with average min meaning the typical steepest downhill (not the steepest possible downhill)
-        # and average max meaning the typical steepest uphill. Reason why its not absolute min/max of
-        # each is becase there could be short sections (e.g. a switchback corner) that is VERY steep.
-        # Want to generally be ok with super short steep sections and constrain more on the 'typical'
-        # grade of the route. If there are no descents, min grade is the average grade of everything
-        # less than the average (I know......) and max is average of everything above max
-        #
-        # This can give a better idea of "runnable"
-        #
-        if np.sum(distances[grade>0]) > 0:
-            d['average_max_grade']    = np.average(grade[grade>0], weights = distances[grade>0]) # weighted avg!!
-        elif np.sum(distances[grade>d['average_grade']]) > 0:
-            d['average_max_grade']    = np.average(grade[grade>d['average_grade']], weights=distances[grade>d['average_grade']])
-        else:
-            d['average_max_grade'] = d['average_grade']
+    with _timer(stats, 'elevations'):
+        coords     = np.array([(x[0],x[1]) for x in new_line.coords]) # long, lat
+        elevations = gpx_process.get_elevations(coords[:,::-1], smooth=True,
+                                                ends = (tail_d['elevation'], head_d['elevation']))
 
-        if np.sum(distances[grade<0]) > 0:
-            d['average_min_grade']    = np.average(grade[grade<0], weights = distances[grade<0]) # w
-        elif np.sum(distances[grade<d['average_grade']]) > 0:
-            d['average_min_grade']    = np.average(grade[grade<d['average_grade']],weights=distances[grade<d['average_grade']])
-        else:
-            d['average_min_grade'] = d['average_grade']
-
-        d['min_altitude']     = np.min(elevations)
-        d['max_altitude']     = np.max(elevations)
-        d['average_altitude'] = np.average(0.5*(elevations[1:]+elevations[:-1]),weights=distances)
-        d['traversed_count']  = 0
-
-        # apparenlty geopandas uses fiona to do writing to file
-        # which DOESN"T support storing lists / np arrays into individual
-        # cells. The below is a workaround (and a sin).. converting to a string
-        #
-        # MAKING ELEVATIONS SAME LENGTH AS DISTANCES!!
-        #
-        d['elevations']  = ','.join(["%6.2E"%(a) for a in 0.5*(elevations[1:]+elevations[:-1])])
-        d['grades']      = ','.join(["%6.2E"%(a) for a in grade])
-        d['distances']   = ','.join(["%6.2E"%(a) for a in distances])
+    with _timer(stats, 'track_properties'):
+        # point-point distances and elevations (see note on direction
+        # in `track_properties`)
+        d.update(gpx_process.track_properties(np.column_stack((coords, elevations))))
 
-    return edges
+    return
+
+
+#
+# Helpers for computing edge properties in other processes
+#
+_worker_node_data = None
+
+def _init_edge_worker(node_data, provider):
+    """
+    Process pool initializer. Holds on to the node properties and uses the
+    parent's elevation provider (which is not inherited with 'spawn').
+    """
+    global _worker_node_data
+    _worker_node_data = node_data
+
+    gpx_process.set_elevation_provider(provider)
+
+    return
+
+def _edge_worker(edges, profile = False):
+    """
+    Compute properties for a chunk of edges. Returns the new edge data
+    dictionaries (in order), the ProfileStats (or None), and the elevation
+    repair counts.
+    """
+
+    stats = ProfileStats() if profile else None
+
+    gpx_process.elevation_repair_counts(reset = True)
+
+    for (tail, head, d) in edges:
+        _edge_properties(tail, head, d, _worker_node_data, stats)
+
+    return [d for (u,v,d) in edges], stats, gpx_process.elevation_repair_counts(reset = True)
+
+
+def tile_indices(ll, rr, tile_size = TILE_SIZE):
+    """
+    Indices (i,j) of all grid tiles covering the bounding box from
+    ll = (lat,long) to rr = (lat,long). Tile (i,j) covers latitudes
+    i*tile_size to (i+1)*tile_size and longitudes j*tile_size to (j+1)*tile_size.
+    """
+
+    eps = 1.0E-9 # so boxes exactly on tile edges do not pick up the next tile
+
+    i0 = int(np.floor(ll[0] / tile_size + eps))
+    j0 = int(np.floor(ll[1] / tile_size + eps))
+    i1 = max(int(np.ceil(rr[0] / tile_size - eps)) - 1, i0)
+    j1 = max(int(np.ceil(rr[1] / tile_size - eps)) - 1, j0)
+
+    return [(i,j) for i in range(i0, i1+1) for j in range(j0, j1+1)]
+
+
+def tile_bounds(i, j, tile_size = TILE_SIZE):
+    """
+    ll = (lat,long) and rr = (lat,long) corners of tile (i,j).
+    """
+    return (i*tile_size, j*tile_size), ((i+1)*tile_size, (j+1)*tile_size)
+
+
+def tile_directory(tile_size = TILE_SIZE):
+    """
+    Cache directory for grid tiles of `tile_size` degrees.
+    """
+    return os.getcwd() + "/cache/tiles_%.3f"%(tile_size)
+
+
+def tile_filename(i, j, tile_size = TILE_SIZE):
+    """
+    Cache file of grid tile (i,j).
+    """
+    return tile_directory(tile_size) + "/%i_%i_osmnx_tile.pickle"%(i,j)
+
+
+def tiles_version(indices, tile_size = TILE_SIZE):
+    """
+    Deterministic version ID for a map stitched from the cached tiles
+    `indices`. Depends on the (sorted) tile indices and the modification
+    times of the tile files, so it only changes when a tile is re-processed.
+    Returns None if any of the tiles are not cached.
+    """
+
+    keys = []
+    for (i,j) in sorted(indices):
+        fname = tile_filename(i, j, tile_size)
+        if not os.path.isfile(fname):
+            return None
+        keys.append((i, j, os.stat(fname).st_mtime_ns))
+
+    raw = repr((float(tile_size), keys))
+
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def load_tile(i, j, tile_size = TILE_SIZE, save_to_file = True, allow_cache_load = True):
+    """
+    Unsimplified osmnx graph of grid tile (i,j), from the cache if there,
+    otherwise fetched from OSM (and cached if `save_to_file`). Segments
+    crossing the tile edge are kept (with both nodes), so neighboring tiles
+    share them and can be stitched together (see `osm_fetch.stitch_graphs`).
+
+    Returns:
+    -------------
+    ox_graph : osmnx graph of the tile (None if there are no trails in it)
+    cached   : True if loaded from the cache
+    """
+
+    tile_dir = tile_directory(tile_size)
+    fname    = tile_filename(i, j, tile_size)
+
+    if allow_cache_load and os.path.isfile(fname):
+        with open(fname,'rb') as infile:
+            return pickle.load(infile), True
+
+    ll, rr   = tile_bounds(i, j, tile_size)
+    ox_graph = osm_fetch.get_graph(ll = ll, rr = rr, save_to_file = False, allow_cache_load = False,
+                                   truncate_by_edge = True, allow_empty = True, simplify = False)
+
+    if save_to_file:
+        if not os.path.isdir(tile_dir):
+            os.makedirs(tile_dir)
+
+        # write then rename so other processes never load a partial tile
+        temp = fname + ".%i.tmp"%(os.getpid())
+        with open(temp,'wb') as outfile:
+            pickle.dump(ox_graph, outfile, protocol = 4)
+        os.replace(temp, fname)
+
+    return ox_graph, False
 
 
 def osmnx_trailmap(center_point = None,
@@ -289,10 +444,30 @@ def osmnx_trailmap(center_point = None,
               query=None,
               dist=40233.6, # 50 miles (in m)
               save_to_file=True,
-              allow_cache_load=True):
+              allow_cache_load=True,
+              build_hierarchy=True,
+              n_cpus=1,
+              tile_size=TILE_SIZE):
     """
     Wrapper around all of the get functions. kwargs match those in
-    osm_fetch
+    osm_fetch. If `build_hierarchy` is True, builds the contraction hierarchy
+    for fast distance queries on newly processed regions before caching.
+    `n_cpus` processes are used to process new regions (see `process_ox`).
+
+    OSM data is cached as fixed grid tiles of `tile_size` degrees (see
+    `load_tile`), and only tiles not already cached are fetched. The map is
+    stitched together from the (unsimplified) tiles covering the region
+    before it is simplified and processed, so trails crossing tile edges
+    become single edges. It covers the full extent of the tiles (`ll`, `rr`),
+    which may be a bit past the requested region. If `tile_size` is None,
+    caches the whole region instead, which is only re-used for the exact
+    same bounding box.
+
+    The processed map (with its contraction hierarchy) is also cached, keyed
+    by the set of tiles it is made of, so re-loading a fully cached region
+    does not re-process it or rebuild the hierarchy. Its `map_version` is
+    deterministic (see `tiles_version`), so results cached against it
+    (e.g. in a `RouteCache`) stay valid across loads.
     """
     print("OSMNX Trailmap: ", center_point, ll, rr, query, dist)
     if (center_point is None) and (ll is None) and (rr is None):
@@ -310,11 +485,93 @@ def osmnx_trailmap(center_point = None,
     else:
         raise RuntimeError
 
-    north,south,east,west = rr[0],ll[0],rr[1],ll[1]
-
     if not os.path.isdir(os.getcwd() + '/cache'):
         os.mkdir(os.getcwd() + '/cache')
 
+    if tile_size is None:
+        return _osmnx_trailmap_bbox(center_point, ll, rr, query, dist, save_to_file,
+                                    allow_cache_load, build_hierarchy, n_cpus)
+
+    stats   = ProfileStats()
+    indices = tile_indices(ll, rr, tile_size)
+
+    tiles    = []
+    n_cached = 0
+    for (i,j) in indices:
+        with stats.timer('load_tiles'):
+            tile, cached = load_tile(i, j, tile_size = tile_size, save_to_file = save_to_file,
+                                     allow_cache_load = allow_cache_load)
+        tiles.append(tile)
+        n_cached += cached
+
+    print("OSM Process - %i of %i tiles loaded from cache"%(n_cached, len(indices)))
+
+    # None unless all tiles are cached
+    version = tiles_version(indices, tile_size) if save_to_file else None
+    fname   = None
+    if not (version is None):
+        fname = tile_directory(tile_size) + "/stitched/%s_TrailMap.pickle"%(version)
+
+    tmap = None
+    if allow_cache_load and (not (fname is None)) and os.path.isfile(fname):
+        with stats.timer('load_stitched'):
+            with open(fname,'rb') as infile:
+                tmap = pickle.load(infile)
+        print("OSM Process - loaded stitched map from cache")
+
+    save_stitched = False
+    if tmap is None:
+        with stats.timer('stitch_tiles'):
+            ox_graph = osm_fetch.stitch_graphs(tiles)
+
+        if ox_graph is None: # no trails anywhere here
+            tmap = TrailMap()
+            tmap.graph['crs'] = 'epsg:4326'
+        else:
+            tmap = process_ox(ox_graph, stats = stats, n_cpus = n_cpus)
+        save_stitched = True
+
+    if build_hierarchy and (getattr(tmap, '_ch', None) is None):
+        with stats.timer('contraction_hierarchy'):
+            tmap.build_contraction_hierarchy()
+        save_stitched = True
+
+    if not (version is None):
+        tmap.new_map_version(version)
+
+    # the map covers the full extent of its tiles
+    ll = tile_bounds(*min(indices), tile_size)[0]
+    rr = tile_bounds(*max(indices), tile_size)[1]
+
+    tmap.center_point = center_point
+    tmap.ll           = ll
+    tmap.rr           = rr
+    tmap.query        = query
+    tmap.dist         = dist
+
+    if save_stitched and (not (fname is None)):
+        if not os.path.isdir(os.path.dirname(fname)):
+            os.makedirs(os.path.dirname(fname))
+
+        temp = fname + ".%i.tmp"%(os.getpid())
+        with open(temp,'wb') as outfile:
+            pickle.dump(tmap, outfile, protocol = 4)
+        os.replace(temp, fname)
+
+    print("OSM Process - processing time by stage:")
+    print(stats.summary())
+
+    return tmap
+
+
+def _osmnx_trailmap_bbox(center_point, ll, rr, query, dist, save_to_file,
+                         allow_cache_load, build_hierarchy, n_cpus):
+    """
+    `osmnx_trailmap` for a single region cached by its exact bounding box.
+    """
+
+    north,south,east,west = rr[0],ll[0],rr[1],ll[1]
+
     fname = os.getcwd() + "/cache/%4.5f_%4.5f_%4.5f_%4.5f_TrailMap_graph.pickle"%(north,south,east,west)
 
     call_api = True
@@ -325,6 +582,14 @@ def osmnx_trailmap(center_point = None,
             with open(fname,'rb') as infile:
                 tmap = pickle.load(infile)
             call_api = False
+
+            # older cached maps may not have component labels
+            if getattr(tmap, '_components', None) is None:
+                tmap.compute_components()
+
+            # or a version
+            if getattr(tmap, '_map_version', None) is None:
+                tmap.new_map_version(tmap.content_version(fname))
         else:
             print("OSM Process cannot find file: ", fname)
 
@@ -332,13 +597,21 @@ def osmnx_trailmap(center_point = None,
         ox_graph = osm_fetch.get_graph(center_point=center_point,ll=ll,rr=rr,
                                        query=query,dist=dist,save_to_file=save_to_file,
                                        allow_cache_load=allow_cache_load)
-        tmap              = process_ox(ox_graph)
+        stats             = ProfileStats()
+        tmap              = process_ox(ox_graph, stats = stats, n_cpus = n_cpus)
         tmap.center_point = ox_graph.center_point
         tmap.ll           = ox_graph.ll
         tmap.rr           = ox_graph.rr
         tmap.query        = ox_graph.query
         tmap.dist         = ox_graph.dist
 
+        if build_hierarchy:
+            with stats.timer('contraction_hierarchy'):
+                tmap.build_contraction_hierarchy()
+
+        print("OSM Process - processing time by stage:")
+        print(stats.summary())
+
         if save_to_file:
             with open(fname,'wb') as fname:
                 pickle.dump(tmap, fname, protocol = 4)
@@ -348,6 +621,67 @@ def osmnx_trailmap(center_point = None,
     return tmap
 
 
+def test_tile_stitching():
+    """
+    Test that a trail crossing a tile edge is stitched back together into a
+    single edge, giving the same map as processing the whole area at once.
+    Uses a synthetic trail and elevations, so needs no network access.
+    """
+
+    from planit.autotrail import synthetic
+
+    edge_lat = 4*TILE_SIZE # tile edge the trail crosses
+
+    # two junctions (each with two dead end spurs), one on either side of the
+    # tile edge, joined by a bending trail that crosses it
+    coords = {1 : (edge_lat - 0.030, -105.250), 2 : (edge_lat - 0.020, -105.240),
+              3 : (edge_lat - 0.005, -105.232), 4 : (edge_lat + 0.005, -105.221),
+              5 : (edge_lat + 0.020, -105.210), 6 : (edge_lat + 0.030, -105.200),
+              7 : (edge_lat - 0.040, -105.260), 8 : (edge_lat - 0.035, -105.240),
+              9 : (edge_lat + 0.040, -105.190), 10: (edge_lat + 0.035, -105.210),
+              11: (edge_lat - 0.035, -105.257), 12: (edge_lat - 0.033, -105.244),
+              13: (edge_lat + 0.035, -105.194), 14: (edge_lat + 0.033, -105.206)}
+    ways   = {100 : [1,2,3,4,5,6], 101 : [1,11,7], 102 : [1,12,8],
+              103 : [6,13,9], 104 : [6,14,10]}
+
+    ox_graph = nx.MultiDiGraph(crs = 'epsg:4326')
+    for n, (lat, long) in coords.items():
+        ox_graph.add_node(n, y = lat, x = long, osmid = n)
+    for osmid, way in ways.items():
+        for u, v in zip(way[:-1], way[1:]):
+            length = gpxpy.geo.haversine_distance(*coords[u], *coords[v])
+            for (a, b) in [(u,v), (v,u)]:
+                ox_graph.add_edge(a, b, osmid = osmid, highway = 'path', oneway = False, length = length)
+
+    def _tile(south, north):
+        # as fetched with truncate_by_edge
+        inside = [n for n, d in ox_graph.nodes(data=True) if south <= d['y'] < north]
+        keep   = set(inside)
+        for n in inside:
+            keep.update(ox_graph.successors(n))
+        return ox_graph.subgraph(keep).copy()
+
+    z = np.random.RandomState(0).random_sample((20,20))
+    gpx_process.set_elevation_provider(synthetic.Terrain(z, (edge_lat - 0.1, -105.3), (edge_lat + 0.1, -105.1)))
+
+    try:
+        whole    = process_ox(osm_fetch.osmnx.simplify_graph(ox_graph))
+        stitched = process_ox(osm_fetch.stitch_graphs([_tile(edge_lat - TILE_SIZE, edge_lat),
+                                                       _tile(edge_lat, edge_lat + TILE_SIZE)]))
+    finally:
+        gpx_process.set_elevation_provider(None)
+
+    assert sorted(stitched.edges()) == sorted(whole.edges())
+    assert stitched.has_edge(1, 6) and stitched.number_of_edges(1, 6) == 1
+
+    for (u, v, d) in whole.edges(data=True):
+        for k in ['distance', 'elevation_gain', 'elevation_loss']:
+            assert abs(stitched.edges[(u, v, 0)][k] - d[k]) < 1.0E-6
+
+    print("Success: stitched %i edges"%(stitched.number_of_edges()))
+    return stitched
+
+
 def test():
     """
     Test